@@ -0,0 +1,351 @@
+"""Load driver of simulated WebGAL viewers
+
+every client follows the chain a WebGAL player does, with the same query parameters:
+`newchat.txt` -> `chat.txt?p=..&pending=1` -> redirect to `next.txt?first_answer=1` ->
+`next.txt` (pending scenes included) until the input scene, and fetches every `voice.mp3`
+of a scene in background. The report has throughput, time to the first line of a turn
+(p50/p99), gaps between sentences and voice fetch latency.
+
+with `--spawn`, the mock LLM, the mock fish-speech and the backend are started locally, so the
+whole run is offline. Run under `backend/`:
+    python -m bench.load --spawn --clients 50 --turns 3
+    python -m bench.load --url http://127.0.0.1:10228 --clients 20   # an already running backend
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import quote
+import httpx
+from yaml import safe_dump as yaml_dump, safe_load as yaml_load
+
+PROMPTS = ("你好", "我的网络连不上了", "能帮我查一下订单吗", "谢谢你", "今天天气怎么样")
+
+
+def parse_scene(script: str) -> dict:
+    """dialogue lines, voice URLs and the next URL of a WebGAL scene"""
+    lines, voices, next_url = [], [], None
+    for line in script.splitlines():
+        if line.startswith("playEffect:"):
+            voices.append(line.split(":", maxsplit=1)[1].split(" ")[0])
+        elif line.startswith("changeScene:"):
+            next_url = line.split(":", maxsplit=1)[1].split(" ")[0]
+        elif line.endswith(" -center") and not line.startswith(";"):
+            lines.append(line)
+    return {"lines": lines, "voices": voices, "next_url": next_url}
+
+
+def percentile(values: list[float], p: float):
+    """nearest rank, None if no values"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+class LoadReport:
+    def __init__(self) -> None:
+        self.turns = 0
+        self.lines = 0
+        self.scenes = 0
+        self.pending = 0
+        self.requests = 0
+        self.errors: dict[str, int] = {}
+        # seconds
+        self.first_line: list[float] = []
+        self.sentence_gaps: list[float] = []
+        self.scene_gaps: list[float] = []
+        self.turn_time: list[float] = []
+        self.voice: list[float] = []
+        self.voice_missing = 0
+
+    def error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def summary(self, elapsed: float, clients: int) -> dict:
+        def stats(values: list[float]):
+            return {
+                "count": len(values),
+                "p50_ms": _ms(percentile(values, 50)),
+                "p99_ms": _ms(percentile(values, 99)),
+                "max_ms": _ms(max(values) if values else None),
+            }
+
+        return {
+            "clients": clients,
+            "elapsed_s": round(elapsed, 3),
+            "turns": self.turns,
+            "turns_per_s": round(self.turns / elapsed, 3),
+            "lines_per_s": round(self.lines / elapsed, 3),
+            "requests_per_s": round(self.requests / elapsed, 3),
+            "scenes": self.scenes,
+            "pending_scenes": self.pending,
+            "voice_missing": self.voice_missing,
+            "errors": self.errors,
+            "time_to_first_line": stats(self.first_line),
+            "sentence_gap": stats(self.sentence_gaps),
+            "scene_gap": stats(self.scene_gaps),
+            "turn_time": stats(self.turn_time),
+            "voice_fetch": stats(self.voice),
+        }
+
+
+def _ms(seconds: float | None):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+async def fetch_voice(client: httpx.AsyncClient, url: str, report: LoadReport):
+    started = time.perf_counter()
+    try:
+        resp = await client.get(url)
+        report.requests += 1
+        if resp.status_code == 200 and resp.content:
+            report.voice.append(time.perf_counter() - started)
+        else:
+            report.voice_missing += 1
+    except httpx.HTTPError as err:
+        report.error(type(err).__name__)
+
+
+async def run_client(
+    client: httpx.AsyncClient, args, report: LoadReport, voice_tasks: set[asyncio.Task]
+):
+    async def get(url: str):
+        resp = await client.get(url)
+        report.requests += 1 + len(resp.history)
+        resp.raise_for_status()
+        return parse_scene(resp.text)
+
+    scene = await get(f"{args.url}/webgal/newchat.txt?bot={args.bot}")
+    chat_url = scene["next_url"]
+
+    for _ in range(args.turns):
+        await asyncio.sleep(args.think * random.uniform(0.5, 1.5))
+        if chat_url is None or "{prompt}" not in chat_url:
+            report.error("no_input_scene")
+            return
+
+        # what WebGAL sends after `getUserInput`
+        url = chat_url.replace("{prompt}", quote(random.choice(PROMPTS))).replace(
+            "{pending}", "1"
+        )
+        started = time.perf_counter()
+        last_scene = None
+        while True:
+            scene = await get(url)
+            now = time.perf_counter()
+            if scene["lines"]:
+                report.scenes += 1
+                report.lines += len(scene["lines"])
+                if last_scene is None:
+                    report.first_line.append(now - started)
+                else:
+                    report.scene_gaps.append(now - last_scene)
+                    report.sentence_gaps.append(now - last_scene)
+                # sentences of a scene are available together
+                report.sentence_gaps.extend([0.0] * (len(scene["lines"]) - 1))
+                last_scene = now
+                for voice_url in scene["voices"]:
+                    task = asyncio.create_task(fetch_voice(client, voice_url, report))
+                    voice_tasks.add(task)
+                    task.add_done_callback(voice_tasks.discard)
+                # the player shows the lines before going on
+                await asyncio.sleep(args.line_time * len(scene["lines"]))
+            else:
+                report.pending += 1
+
+            url = scene["next_url"]
+            if url is None:
+                # exit or bye scene
+                report.error("turn_ended")
+                return
+            if "{prompt}" in url:
+                # the input scene, the turn is over
+                report.turns += 1
+                report.turn_time.append(time.perf_counter() - started)
+                chat_url = url
+                break
+            url = url.replace("{rand}", str(random.random()))
+
+
+async def run_load(args) -> dict:
+    report = LoadReport()
+    voice_tasks: set[asyncio.Task] = set()
+    limits = httpx.Limits(max_connections=args.clients * 4, max_keepalive_connections=args.clients * 2)
+    async with httpx.AsyncClient(
+        follow_redirects=True, timeout=args.timeout, limits=limits
+    ) as client:
+
+        async def one_client(i_client: int):
+            # starts are spread over the ramp
+            await asyncio.sleep(args.ramp * i_client / max(args.clients, 1))
+            try:
+                await run_client(client, args, report, voice_tasks)
+            except httpx.HTTPStatusError as err:
+                report.error(f"http_{err.response.status_code}")
+            except httpx.HTTPError as err:
+                report.error(type(err).__name__)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[one_client(i) for i in range(args.clients)])
+        if voice_tasks:
+            await asyncio.wait(voice_tasks)
+        elapsed = time.perf_counter() - started
+
+    return report.summary(elapsed, args.clients)
+
+
+def write_offline_config(args, tmpdir: str) -> dict[str, str]:
+    """secrets and presets pointing at the mock servers, returned as env of the backend"""
+    llm_url = f"http://127.0.0.1:{args.mock_llm_port}/v1"
+    with open("system_prompt.yml", "r", encoding="utf-8") as fp:
+        presets: dict = yaml_load(fp.read())
+
+    secrets = {}
+    for preset in presets.values():
+        secrets[preset.get("llm_name", "deepseek")] = {
+            "api_key": "sk-bench",
+            "base_url": llm_url,
+            "model": "mock",
+        }
+        if "live2d_model_path" in preset and args.tts != "edge":
+            preset["voice"] = (
+                {
+                    "type": "fish",
+                    "api": f"http://127.0.0.1:{args.mock_fish_port}",
+                    "voice_line": "bench",
+                    "streaming": args.tts == "fish-streaming",
+                }
+                if args.tts != "none"
+                else None
+            )
+
+    secret_path = os.path.join(tmpdir, "secrets.bench.yml")
+    preset_path = os.path.join(tmpdir, "system_prompt.bench.yml")
+    with open(secret_path, "w", encoding="utf-8") as fp:
+        fp.write(yaml_dump(secrets, allow_unicode=True))
+    with open(preset_path, "w", encoding="utf-8") as fp:
+        fp.write(yaml_dump(presets, allow_unicode=True))
+
+    return {
+        "LLM_SECRET_YML": secret_path,
+        "LLM_PRESET_YML": preset_path,
+        "HOST": "127.0.0.1",
+        "PORT": str(args.port),
+    }
+
+
+async def wait_ready(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while True:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} not ready in {timeout}s")
+            await asyncio.sleep(0.2)
+
+
+def spawn(args, tmpdir: str) -> list[subprocess.Popen]:
+    python = sys.executable
+    procs = [
+        subprocess.Popen(
+            [python, "-m", "bench.mock_llm", "--port", str(args.mock_llm_port),
+             "--token-rate", str(args.token_rate),
+             "--first-token-delay", str(args.first_token_delay),
+             "--jitter", str(args.jitter)],
+        ),
+        subprocess.Popen(
+            [python, "-m", "bench.mock_fish", "--port", str(args.mock_fish_port),
+             "--jitter", str(args.jitter)],
+        ),
+        subprocess.Popen(
+            [python, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+             "--port", str(args.port), "--workers", str(args.workers),
+             "--log-level", "warning"],
+            env=dict(os.environ, **write_offline_config(args, tmpdir)),
+        ),
+    ]
+    return procs
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--url", "-u", type=str, default="", help="backend to test, default the spawned one"
+    )
+    parser.add_argument("--bot", "-b", type=str, default="sakiko", help="preset")
+    parser.add_argument("--clients", "-c", type=int, default=20, help="concurrent viewers")
+    parser.add_argument("--turns", "-t", type=int, default=3, help="turns per viewer")
+    parser.add_argument(
+        "--think", type=float, default=1.0, help="mean seconds before a viewer speaks"
+    )
+    parser.add_argument(
+        "--line-time", type=float, default=0.0, help="seconds a viewer reads a line"
+    )
+    parser.add_argument(
+        "--ramp", type=float, default=2.0, help="seconds to start all viewers"
+    )
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds per request")
+    parser.add_argument("--output", "-o", type=str, default="", help="save report as json")
+
+    spawned = parser.add_argument_group("offline run")
+    spawned.add_argument(
+        "--spawn", action="store_true", help="start mock servers and backend locally"
+    )
+    spawned.add_argument("--port", type=int, default=18000, help="backend port")
+    spawned.add_argument("--workers", type=int, default=1, help="backend workers")
+    spawned.add_argument("--mock-llm-port", type=int, default=18001)
+    spawned.add_argument("--mock-fish-port", type=int, default=18002)
+    spawned.add_argument(
+        "--tts",
+        choices=["fish", "fish-streaming", "edge", "none"],
+        default="fish",
+        help="voice of presets, edge keeps the preset (needs network)",
+    )
+    spawned.add_argument("--token-rate", type=float, default=30.0)
+    spawned.add_argument("--first-token-delay", type=float, default=0.5)
+    spawned.add_argument("--jitter", type=float, default=0.2)
+
+    return parser.parse_args()
+
+
+async def main(args):
+    procs = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            if args.spawn:
+                procs = spawn(args, tmpdir)
+                args.url = args.url or f"http://127.0.0.1:{args.port}"
+                await wait_ready(f"{args.url}/webgal/")
+            elif not args.url:
+                args.url = "http://127.0.0.1:10228"
+
+            summary = await run_load(args)
+        finally:
+            for proc in procs:
+                proc.terminate()
+            for proc in procs:
+                proc.wait()
+
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(summary, fp, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    """
+    """
+    args = parse_arg()
+    asyncio.run(main(args))
@@ -0,0 +1,107 @@
+"""Local fish-speech `/v1/tts` server for load tests
+
+audio is silence whose length follows the text, produced after a first-chunk delay at a
+configurable synthesis speed. `"streaming": true` requests get wav streamed in chunks like
+fish-speech does, others get a whole mp3-like body.
+
+run under `backend/`:
+    python -m bench.mock_fish --port 18002 --first-chunk-delay 0.3 --speed 8
+"""
+
+import argparse
+import asyncio
+import random
+import struct
+from fastapi import FastAPI, Request
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+
+SAMPLE_RATE = 16000
+# seconds of speech per character
+SECONDS_PER_CHAR = 0.25
+# an mp3 frame header (MPEG-1 layer III, 128 kbps, 44.1 kHz) and its frame length
+MP3_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+MP3_FRAMES_PER_SECOND = 38
+
+
+class MockFishConfig(BaseModel):
+    first_chunk_delay: float = 0.3
+    # seconds of audio synthesized per second
+    speed: float = 8.0
+    jitter: float = 0.2
+    # seconds of audio per streamed chunk
+    chunk_seconds: float = 0.5
+
+
+def wav_header(n_samples: int):
+    data_size = n_samples * 2
+    return (
+        b"RIFF"
+        + struct.pack("<I", 36 + data_size)
+        + b"WAVEfmt "
+        + struct.pack("<IHHIIHH", 16, 1, 1, SAMPLE_RATE, SAMPLE_RATE * 2, 2, 16)
+        + b"data"
+        + struct.pack("<I", data_size)
+    )
+
+
+def create_app(config: MockFishConfig = None) -> FastAPI:
+    config = config or MockFishConfig()
+    app = FastAPI()
+    app.state.requests = 0
+
+    def jittered(seconds: float):
+        return max(0.0, seconds * random.uniform(1 - config.jitter, 1 + config.jitter))
+
+    @app.post("/v1/tts")
+    async def tts(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        duration = max(len(body.get("text", "")), 1) * SECONDS_PER_CHAR
+
+        if not body.get("streaming"):
+            await asyncio.sleep(jittered(config.first_chunk_delay + duration / config.speed))
+            n_frames = int(duration * MP3_FRAMES_PER_SECOND) + 1
+            return Response(content=MP3_FRAME * n_frames, media_type="audio/mpeg")
+
+        async def stream():
+            await asyncio.sleep(jittered(config.first_chunk_delay))
+            n_samples = int(duration * SAMPLE_RATE)
+            yield wav_header(n_samples)
+            chunk_samples = int(config.chunk_seconds * SAMPLE_RATE)
+            for i_sample in range(0, n_samples, chunk_samples):
+                n = min(chunk_samples, n_samples - i_sample)
+                await asyncio.sleep(jittered(n / SAMPLE_RATE / config.speed))
+                yield bytes(n * 2)
+
+        return StreamingResponse(stream(), media_type="audio/wav")
+
+    return app
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", "-p", type=int, default=18002)
+    parser.add_argument(
+        "--first-chunk-delay", type=float, default=0.3, help="seconds"
+    )
+    parser.add_argument(
+        "--speed", type=float, default=8.0, help="seconds of audio synthesized per second"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.2, help="relative jitter of delays"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_arg()
+    config = MockFishConfig(
+        first_chunk_delay=args.first_chunk_delay, speed=args.speed, jitter=args.jitter
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,188 @@
+"""Local OpenAI-compatible chat completions server for load tests
+
+answers are streamed as SSE at a configurable token rate, after a first-token delay with jitter.
+Non-streamed requests (the mood analyzer) are answered with a mood, or one mood per numbered
+line for the batched analyzer. No network access or API key needed.
+
+run under `backend/`:
+    python -m bench.mock_llm --port 18001 --token-rate 40 --first-token-delay 0.6 --jitter 0.3
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+ANSWER_SENTENCES = (
+    "您好，工号0214，客服小祥为您服务。",
+    "请问有什么可以帮您的吗？",
+    "这个问题我已经记录下来了，会尽快为您处理。",
+    "真是非常抱歉给您带来了不便！",
+    "我明白您的意思，请您稍等一下。",
+    "根据您的描述，可能是网络连接的问题。",
+    "您可以先尝试重启一下设备，再看看是否恢复正常。",
+    "如果还有问题，欢迎随时再联系我们。",
+)
+MOODS = ("高兴", "生气", "悲伤", "无奈", "坚定", "害羞", "惊讶", "害怕")
+
+match_numbered_line = re.compile(r"^\s*(\d+)\.\s", re.MULTILINE)
+
+
+class MockLLMConfig(BaseModel):
+    # tokens per second of the answer stream, a token is 1-3 characters
+    token_rate: float = 30.0
+    first_token_delay: float = 0.5
+    # relative jitter of every delay, 0.2 means x0.8 to x1.2
+    jitter: float = 0.2
+    # sentences in every answer
+    sentences: int = 4
+    # latency of non-streamed (mood) requests
+    mood_delay: float = 0.3
+
+
+def _jittered(seconds: float, jitter: float):
+    return max(0.0, seconds * random.uniform(1 - jitter, 1 + jitter))
+
+
+def _tokens(text: str):
+    i = 0
+    while i < len(text):
+        n = random.randint(1, 3)
+        yield text[i : i + n]
+        i += n
+
+
+def _usage(prompt: int, completion: int):
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+    }
+
+
+def _prompt_tokens(messages: list[dict]):
+    return sum(len(str(msg.get("content", ""))) for msg in messages)
+
+
+def create_app(config: MockLLMConfig = None) -> FastAPI:
+    config = config or MockLLMConfig()
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        messages = body.get("messages", [])
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            await asyncio.sleep(_jittered(config.mood_delay, config.jitter))
+            content = messages[-1].get("content", "") if messages else ""
+            numbered = match_numbered_line.findall(content)
+            answer = (
+                "\n".join(f"{i}:{random.choice(MOODS)}" for i in numbered)
+                if numbered
+                else random.choice(MOODS)
+            )
+            return JSONResponse(
+                {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": answer},
+                            "finish_reason": "stop",
+                        }
+                    ],
+                    "usage": _usage(_prompt_tokens(messages), len(answer)),
+                }
+            )
+
+        answer = "".join(random.choices(ANSWER_SENTENCES, k=config.sentences))
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        def chunk(delta: dict, finish_reason=None, usage=None):
+            data = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": []
+                if usage is not None
+                else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            if usage is not None:
+                data["usage"] = usage
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(_jittered(config.first_token_delay, config.jitter))
+            yield chunk({"role": "assistant", "content": ""})
+            n_tokens = 0
+            for token in _tokens(answer):
+                if n_tokens:
+                    await asyncio.sleep(_jittered(1 / config.token_rate, config.jitter))
+                n_tokens += 1
+                yield chunk({"content": token})
+            yield chunk({}, finish_reason="stop")
+            if include_usage:
+                yield chunk({}, usage=_usage(_prompt_tokens(messages), n_tokens))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", "-p", type=int, default=18001)
+    parser.add_argument(
+        "--token-rate", type=float, default=30.0, help="tokens per second"
+    )
+    parser.add_argument(
+        "--first-token-delay", type=float, default=0.5, help="seconds"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0.2, help="relative jitter of delays"
+    )
+    parser.add_argument(
+        "--sentences", type=int, default=4, help="sentences per answer"
+    )
+    parser.add_argument(
+        "--mood-delay", type=float, default=0.3, help="seconds of a mood query"
+    )
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    args = parse_arg()
+    config = MockLLMConfig(
+        token_rate=args.token_rate,
+        first_token_delay=args.first_token_delay,
+        jitter=args.jitter,
+        sentences=args.sentences,
+        mood_delay=args.mood_delay,
+    )
+    uvicorn.run(create_app(config), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,72 @@
+"""Microbenchmark of scene building: jinja2 templates vs `web.scenes` builders
+
+run under `backend/`:
+    python -m client.bench_scenes -n 20000
+"""
+
+import argparse
+import timeit
+from web import scenes
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--number", "-n", type=int, default=20000, help="renders per case"
+    )
+    parser.add_argument(
+        "--lines", "-l", type=int, default=4, help="sentences in a scene"
+    )
+
+    return parser.parse_args()
+
+
+def main(args):
+    common = dict(
+        sess_id="0123456789abcdef0123456789abcdef",
+        bg_pic="N（主角相关工作地点）/N9.jpg",
+        l2d_path="mygo_avemujica_v6/sakiko/341_casual-2023_rip/model.json",
+        speaker="客服小祥",
+        next_url="http://127.0.0.1:10228/webgal/next.txt/0123456789abcdef0123456789abcdef/2?bot=sakiko",
+    )
+    lines = [
+        (
+            "您好，工号0214，客服小祥为您服务，请问有什么可以帮您的吗？" * (i % 3 + 1),
+            "smile03",
+            "smile01",
+            f"http://127.0.0.1:10228/webgal/voice.mp3/0123/{i:012x}",
+        )
+        for i in range(args.lines)
+    ]
+    listening = ["thinking02", "thinking01"]
+
+    answer_template = scenes.jinja2_env.get_template("answer.txt")
+    new_input_template = scenes.jinja2_env.get_template("new_input.txt")
+    cases = {
+        "answer (jinja2, get_template)": lambda: scenes.jinja2_env.get_template(
+            "answer.txt"
+        ).render(msg_motion_expression_list=lines, **common),
+        "answer (jinja2, compiled)": lambda: answer_template.render(
+            msg_motion_expression_list=lines, **common
+        ),
+        "answer (builder)": lambda: scenes.answer_scene(lines=lines, **common),
+        "new_input (jinja2, compiled)": lambda: new_input_template.render(
+            msg_motion_expression_list=lines, listening=listening, **common
+        ),
+        "new_input (builder)": lambda: scenes.new_input_scene(
+            lines=lines, listening=listening, **common
+        ),
+    }
+
+    print(f"{args.number} renders per case, {args.lines} sentences per scene")
+    for name, func in cases.items():
+        elapsed = min(timeit.repeat(func, number=args.number, repeat=3))
+        print(f"{name:32s} {elapsed / args.number * 1e6:8.2f} us/scene")
+
+
+if __name__ == "__main__":
+    """
+    """
+    args = parse_arg()
+    main(args)
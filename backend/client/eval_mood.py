@@ -0,0 +1,137 @@
+"""Offline evaluation of local mood engines against LLM `mood_analyzer` labels
+
+run under `backend/`:
+    python -m client.eval_mood -i sentences.txt -o labeled.jsonl   # query LLM once and save labels
+    python -m client.eval_mood -i labeled.jsonl                     # evaluate offline afterwards
+
+input is either plain text (one sentence per line, answers are split into sentences) or
+jsonl of `{"sentence": ..., "mood": ...}` where mood is the LLM label.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from web.mood import MOOD_LABELS, get_mood_classifier
+from web.mood_engine import MOOD_ENGINES, get_mood_engine
+from web.webgal_utils import text_split_sentence
+
+
+def parse_arg():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--input",
+        "-i",
+        type=str,
+        required=True,
+        help="sentences (.txt) or LLM labeled sentences (.jsonl)",
+    )
+
+    parser.add_argument(
+        "--output",
+        "-o",
+        type=str,
+        default="",
+        help="save LLM labeled sentences as jsonl, for later offline runs",
+    )
+
+    parser.add_argument(
+        "--engine",
+        "-e",
+        type=str,
+        default="lexicon",
+        choices=list(MOOD_ENGINES),
+        help="local mood engine to evaluate",
+    )
+
+    parser.add_argument(
+        "--thresholds",
+        "-t",
+        type=str,
+        default="0,0.3,0.4,0.5,0.6,0.7,0.8",
+        help="confidence thresholds of hybrid tier to report",
+    )
+
+    return parser.parse_args()
+
+
+def load_samples(input_path: str) -> list[dict]:
+    with open(input_path, "r", encoding="utf-8") as fp:
+        if input_path.endswith(".jsonl"):
+            return [json.loads(line) for line in fp if line.strip()]
+
+        return [
+            {"sentence": sent, "mood": None}
+            for line in fp
+            for sent in text_split_sentence(line.strip())
+            if sent.strip()
+        ]
+
+
+async def label_with_llm(samples: list[dict], concurrency: int = 4):
+    """fill missing labels with the LLM mood analyzer"""
+    classifier = get_mood_classifier()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def label(sample: dict):
+        async with semaphore:
+            sample["mood"] = await classifier.classify(sample["sentence"])
+
+    await asyncio.gather(*[label(s) for s in samples if s.get("mood") is None])
+
+
+def evaluate(samples: list[dict], engine_name: str, thresholds: list[float]):
+    engine = get_mood_engine(engine_name)
+
+    start = time.perf_counter()
+    predictions = [engine.classify(s["sentence"]) for s in samples]
+    elapsed = time.perf_counter() - start
+
+    n = len(samples)
+    print(f"samples: {n}, engine: {engine_name}, {elapsed / max(n, 1) * 1e6:.1f} us/sentence")
+    print(f"LLM labels: {dict(Counter(s['mood'] for s in samples))}")
+    print()
+    print("threshold | local coverage | agreement on covered | escalated to LLM")
+    for threshold in thresholds:
+        covered = [
+            (pred, sample["mood"])
+            for (pred, conf), sample in zip(predictions, samples)
+            if pred is not None and conf >= threshold
+        ]
+        agree = sum(pred == label for pred, label in covered)
+        print(
+            f"{threshold:9.2f} | {len(covered) / max(n, 1):14.1%} | "
+            f"{agree / max(len(covered), 1):20.1%} | {1 - len(covered) / max(n, 1):16.1%}"
+        )
+
+    print()
+    print("confusion (LLM label -> local prediction), all predictions:")
+    confusion = Counter(
+        (sample["mood"], pred or "-") for (pred, _), sample in zip(predictions, samples)
+    )
+    for label in MOOD_LABELS:
+        row = {pred: c for (lbl, pred), c in confusion.items() if lbl == label}
+        if row:
+            print(f"  {label}: {row}")
+
+
+async def main(args):
+    samples = load_samples(args.input)
+    if any(s.get("mood") is None for s in samples):
+        await label_with_llm(samples)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            for sample in samples:
+                fp.write(json.dumps(sample, ensure_ascii=False) + "\n")
+
+    evaluate(samples, args.engine, [float(t) for t in args.thresholds.split(",")])
+
+
+if __name__ == "__main__":
+    """
+    """
+    args = parse_arg()
+    asyncio.run(main(args))
@@ -5,17 +5,46 @@ from fastapi.staticfiles import StaticFiles
 # from .chat.bot_agent import ChatBot
 # from .chat import chat as chat_bp, webgal
 import logging
-from .logger import log_setup
-from .routes.webgal_route import webgal_route
+from .logger import log_setup, web_logger
+from .routes.webgal_route import webgal_route, warmup_presets
 from .routes.api import api_route
+from .routes.admin import admin_route, metrics_route
 from .config import get_settings
-from .dependencies import init_cache
+from .dependencies import init_cache, get_cache
+from .llm_client import init_llm_clients, close_llm_clients
+from .tts import tts_jobs
+from .audio_store import init_audio_store
+from .notify import readiness
+from .session_store import session_writes, session_l1
+from .lifecycle import start_cache_sweeper, stop_cache_sweeper
+from .usage import run_usage_flusher
 from contextlib import asynccontextmanager
+import asyncio
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await init_cache()
+    await readiness.start(get_cache())
+    await start_cache_sweeper(get_cache())
+    await init_llm_clients()
+    init_audio_store()
+    # requests are served during warm-up, scenes fall back to synthesizing on demand
+    warmup = asyncio.create_task(warmup_presets(get_settings(), get_cache()))
+    usage_flusher = asyncio.create_task(
+        run_usage_flusher(get_cache(), get_settings().usage_flush_interval)
+    )
     yield
+    warmup.cancel()
+    # flushed once more when cancelled
+    usage_flusher.cancel()
+    await asyncio.gather(warmup, usage_flusher, return_exceptions=True)
+    # buffered session saves must not be lost
+    await session_writes.flush()
+    web_logger.info(f"session writes: {session_writes.stats()}, L1: {session_l1.stats()}")
+    tts_jobs.cancel_all()
+    await readiness.stop()
+    await stop_cache_sweeper()
+    await close_llm_clients()
 
 
 def create_app():
@@ -36,6 +65,8 @@ def create_app():
 
     app.include_router(webgal_route)
     app.include_router(api_route)
+    app.include_router(admin_route)
+    app.include_router(metrics_route)
     # staticfile in current fastapi 0.115.5 seems buggy on APIrouters
     # https://github.com/fastapi/fastapi/discussions/9070
     app.mount("/static", StaticFiles(directory="web/static"), name="static")
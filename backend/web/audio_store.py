@@ -0,0 +1,219 @@
+"""Content addressed store of synthesized voices on local disk
+
+a voice is keyed by the hash of its text and the voice preset (provider, voice line and
+params), so the same line is synthesized once for all sessions and stored once. Files are
+written to a temporary name and renamed into place, workers sharing the directory never see
+partial audio. The size is capped by evicting least recently used files.
+
+an empty file marks a line that can't be synthesized, it is retried after `MISSING_TTL`.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+from collections import OrderedDict
+from .config import get_settings
+from .logger import web_logger
+from .metrics import registry
+from .models.voice import VoicePreset
+
+AUDIO_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}\.(mp3|wav)$")
+# seconds an empty file (failed synthesis) is trusted
+MISSING_TTL = 60.0
+
+
+def audio_key(text: str, voice_preset: VoicePreset) -> str:
+    """`{hash}.{ext}` of a line said by a voice, the server address is not part of it"""
+    params = voice_preset.model_dump(exclude={"api"})
+    digest = hashlib.sha256(
+        json.dumps([text, params], ensure_ascii=False, sort_keys=True).encode()
+    ).hexdigest()[:32]
+    # fish-speech only streams wav
+    ext = "wav" if voice_preset.type == "fish" and voice_preset.streaming else "mp3"
+    return f"{digest}.{ext}"
+
+
+def is_audio_key(voice_key: str) -> bool:
+    return AUDIO_KEY_PATTERN.match(voice_key) is not None
+
+
+def audio_media_type(voice_key: str) -> str:
+    return "audio/wav" if voice_key.endswith(".wav") else "audio/mpeg"
+
+
+class DiskAudioStore:
+    """audio files under `root/{key[:2]}/{key}`, with an in-process LRU index of sizes
+
+    files of other workers are indexed when they are first looked up, every worker evicts by
+    its own index, so the cap is kept approximately.
+    """
+
+    def __init__(self, root: str, max_bytes: int) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        # key -> size, least recently used first
+        self._index: OrderedDict[str, int] = OrderedDict()
+        self._total = 0
+        # warm voices of fixed lines are never evicted
+        self._pinned: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def load(self):
+        """index files left by the last run, oldest first"""
+        os.makedirs(self.root, exist_ok=True)
+        entries = []
+        for sub in os.scandir(self.root):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and is_audio_key(entry.name):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._add(key, size)
+        self._unlink(self._evict())
+
+    def _add(self, key: str, size: int):
+        self._total += size - self._index.get(key, 0)
+        self._index[key] = size
+        self._index.move_to_end(key)
+
+    def _evict(self) -> list[str]:
+        """drop least recently used keys from the index, returns paths to unlink"""
+        evicted = []
+        for key in list(self._index):
+            if self._total <= self.max_bytes:
+                break
+            if key in self._pinned:
+                continue
+            self._total -= self._index.pop(key)
+            self.evictions += 1
+            evicted.append(self.path(key))
+        return evicted
+
+    @staticmethod
+    def _unlink(paths: list[str]):
+        for path in paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def pin(self, key: str):
+        self._pinned.add(key)
+
+    @staticmethod
+    def _stat_and_touch(path: str) -> os.stat_result | None:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        if stat.st_size > 0:
+            try:
+                # recency for the index of the next start and of other workers
+                os.utime(path)
+            except OSError:
+                pass
+        return stat
+
+    async def get(self, key: str) -> str | None:
+        """path of the audio, "" if it failed recently, None if it is not stored"""
+        path = self.path(key)
+        # file system calls are off the event loop
+        stat = await asyncio.to_thread(self._stat_and_touch, path)
+        if stat is None:
+            # might be evicted by another worker
+            self._total -= self._index.pop(key, 0)
+            self.misses += 1
+            return None
+
+        if stat.st_size == 0:
+            if time.time() - stat.st_mtime > MISSING_TTL:
+                # to be synthesized again
+                self.misses += 1
+                return None
+            return ""
+
+        self.hits += 1
+        self._add(key, stat.st_size)
+        return path
+
+    def _write(self, key: str, content: bytes):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(content)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    async def put(self, key: str, content: bytes):
+        """atomic write, empty content marks a failed synthesis"""
+        await asyncio.to_thread(self._write, key, content)
+        self._add(key, len(content))
+        evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(self._unlink, evicted)
+
+    def stats(self) -> dict:
+        return {
+            "root": self.root,
+            "files": len(self._index),
+            "bytes": self._total,
+            "max_bytes": self.max_bytes,
+            "pinned": len(self._pinned),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_audio_store: DiskAudioStore | None = None
+
+
+def init_audio_store() -> DiskAudioStore | None:
+    """disk store of `AUDIO_STORE_DIR`, None if disabled or not writable (voices stay in cache)"""
+    global _audio_store
+    settings = get_settings()
+    _audio_store = None
+    if not settings.audio_store_dir:
+        return None
+
+    store = DiskAudioStore(
+        settings.audio_store_dir, int(settings.audio_store_max_mb * 1024 * 1024)
+    )
+    try:
+        store.load()
+    except OSError as err:
+        web_logger.warning(f"audio store {store.root} unavailable ({err}), voices are cached")
+        return None
+
+    web_logger.info(f"audio store: {store.stats()}")
+    _audio_store = store
+    return store
+
+
+def get_audio_store() -> DiskAudioStore | None:
+    return _audio_store
+
+
+registry.gauge(
+    "audio_store_bytes",
+    "bytes of voices indexed by the disk audio store of this process",
+    lambda: {(): _audio_store._total} if _audio_store is not None else {},
+)
@@ -0,0 +1,119 @@
+"""Binary codec of cache values
+
+`CacheCodecSerializer` replaces aiocache's `JsonSerializer`. A value is stored as
+`[version byte][compression byte][payload]`, the payload is msgpack:
+- bytes (voice audio) are stored raw instead of a85 text, and never compressed
+- other values above `cache_compress_min_bytes` are compressed by zlib, or zstd if the
+  `zstandard` package is installed and `CACHE_COMPRESSION=zstd`
+
+JSON entries written by older versions never start with the version byte, they are still
+decoded as JSON, so a rollout needs no migration. `CACHE_CODEC=json` writes JSON again.
+"""
+
+import json
+import zlib
+from typing import Any
+import ormsgpack
+from aiocache.serializers import BaseSerializer
+from .config import get_settings
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CODEC_VERSION = 1
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_ZSTD = 2
+COMPRESSIONS = {"none": COMPRESS_NONE, "zlib": COMPRESS_ZLIB, "zstd": COMPRESS_ZSTD}
+
+
+def packb(value: Any) -> bytes:
+    return ormsgpack.packb(value)
+
+
+def unpackb(data: bytes) -> Any:
+    return ormsgpack.unpackb(data)
+
+
+def _compress(payload: bytes, compression: int) -> bytes:
+    if compression == COMPRESS_ZLIB:
+        return zlib.compress(payload, 1)
+    if compression == COMPRESS_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(payload)
+    return payload
+
+
+def _decompress(payload: bytes, compression: int) -> bytes:
+    if compression == COMPRESS_ZLIB:
+        return zlib.decompress(payload)
+    if compression == COMPRESS_ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compressed cache value, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if compression != COMPRESS_NONE:
+        raise ValueError(f"unknown compression of cache value: {compression}")
+    return payload
+
+
+def encode(value: Any, compression: str = "zlib", compress_min_bytes: int = 2048) -> bytes:
+    payload = packb(value)
+    method = COMPRESSIONS.get(compression, COMPRESS_NONE)
+    if method == COMPRESS_ZSTD and zstandard is None:
+        method = COMPRESS_ZLIB
+    if (
+        method == COMPRESS_NONE
+        or isinstance(value, bytes)
+        or compress_min_bytes <= 0
+        or len(payload) < compress_min_bytes
+    ):
+        method = COMPRESS_NONE
+    else:
+        payload = _compress(payload, method)
+    return bytes((CODEC_VERSION, method)) + payload
+
+
+def is_encoded(data: bytes | str) -> bool:
+    """written by this codec, not a JSON entry of older versions"""
+    return isinstance(data, bytes) and len(data) >= 2 and data[0] == CODEC_VERSION
+
+
+def decode(data: bytes | str | None) -> Any:
+    if data is None:
+        return None
+    if not is_encoded(data):
+        # JSON of older versions
+        return json.loads(data)
+    return unpackb(_decompress(data[2:], data[1]))
+
+
+class CacheCodecSerializer(BaseSerializer):
+    """aiocache serializer of `encode`/`decode`, values are bytes"""
+
+    DEFAULT_ENCODING = None
+
+    def __init__(
+        self, *args, compression: str = "zlib", compress_min_bytes: int = 2048, **kwargs
+    ):
+        self.compression = compression
+        self.compress_min_bytes = compress_min_bytes
+        super().__init__(*args, **kwargs)
+
+    def dumps(self, value: Any) -> bytes:
+        return encode(value, self.compression, self.compress_min_bytes)
+
+    def loads(self, value: bytes | str | None) -> Any:
+        return decode(value)
+
+
+def serializer_config() -> dict:
+    """serializer of `init_cache` by `CACHE_CODEC`"""
+    settings = get_settings()
+    if settings.cache_codec == "json":
+        return {"class": "aiocache.serializers.JsonSerializer"}
+    return {
+        "class": CacheCodecSerializer,
+        "compression": settings.cache_compression,
+        "compress_min_bytes": settings.cache_compress_min_bytes,
+    }
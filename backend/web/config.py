@@ -10,11 +10,65 @@ class AppSettings(BaseSettings):
     debug: bool = False
     llm_secret: BotSecret = BotSecret()
     enable_mood: bool = True
+    # max number of concurrent mood queries of one answer
+    mood_concurrency: int = 4
+    # sentences per batched mood query (`mood_analyzer_batch`), 1 to disable batching, 0 for no limit
+    mood_batch_size: int = 1
+    # max seconds a sentence waits in the batch before the query is sent
+    mood_batch_wait: float = 0.2
+    # cross-session memo of analyzed moods, 0 to disable
+    mood_cache_ttl: int = 7 * 24 * 3600
+    mood_cache_l1_size: int = 1024
+    # seconds a voice request waits for background tts
+    tts_wait_timeout: float = 20.0
+    tts_poll_interval: float = 0.2
+    # content addressed voices on local disk, shared by sessions and workers, "" to keep in cache
+    audio_store_dir: str = "data/voices"
+    audio_store_max_mb: float = 1024.0
+    # sentences ready within this window after the first one are published in one scene
+    scene_coalesce_window: float = 0.3
+    # max sentences in a scene, 1 to publish every sentence separately
+    scene_max_lines: int = 4
+    # saves of a session within this window are merged into one write, 0 to write through
+    session_write_window: float = 1.0
+    # live sessions kept in process, 0 to disable
+    session_l1_size: int = 256
+    # seconds between flushes of token usage counters to cache
+    usage_flush_interval: float = 10.0
+    # TTL (seconds) of cache key families, 0 for no expiry
+    scene_ttl: int = 3600
+    voice_ttl: int = 6 * 3600
+    session_ttl: int = 7 * 24 * 3600
+    # housekeeping of the memory cache fallback, 0 to disable
+    cache_sweep_interval: float = 60.0
+    memory_cache_max_mb: float = 256.0
+    # required as `?token=` by /admin endpoints, which are disabled if not set
+    admin_token: str = ""
+    # bearer token (or `?token=`) of /metrics for the scraper, open if not set
+    metrics_token: str = ""
+    # keys scanned by /admin/cache on redis, counts beyond are extrapolated by DBSIZE
+    admin_scan_max_keys: int = 10000
+    # `msgpack` (binary, see web/codec.py) or `json` for cache values
+    cache_codec: str = "msgpack"
+    # `zlib`, `zstd` (needs zstandard) or `none`, for values of at least cache_compress_min_bytes
+    cache_compression: str = "zlib"
+    cache_compress_min_bytes: int = 2048
+    # turns kept by the tracer of each worker, 0 to disable
+    trace_buffer_size: int = 200
+    # max seconds next.txt waits for its scene before returning a pending scene
+    next_wait_timeout: float = 2.5
+    # max seconds to synthesize a fixed line in warm-up
+    warmup_timeout: float = 30.0
 
     host: str = "127.0.0.1"
     port: int = 10228
     webgal_baseurl: str = "http://localhost:3000"
     proxy_url: str = ""
+    # pooled LLM clients, shared by all sessions
+    llm_max_connections: int = 100
+    llm_max_keepalive: int = 20
+    llm_keepalive_expiry: float = 60.0
+    llm_warmup: bool = False
     # preset and secrets path
     llm_secret_yml: str = "secrets.yml:secrets.dev.yml"
     llm_preset_yml: str = "system_prompt.yml:system_prompt.dev.yml"
@@ -6,6 +6,7 @@ from fastapi import Depends, Query
 from aiocache import Cache, caches
 from contextlib import asynccontextmanager
 from .config import get_settings, AppSettings
+from .codec import serializer_config
 from .models.chat import ChatSession
 from uuid import UUID
 from .logger import web_logger
@@ -31,7 +32,7 @@ async def init_cache():
                     "port": settings.redis_port,
                     "password": settings.redis_password,
                     "timeout": 1,
-                    "serializer": {"class": "aiocache.serializers.JsonSerializer"},
+                    "serializer": serializer_config(),
                     "plugins": [],
                 }
             }
@@ -51,7 +52,7 @@ async def init_cache():
             {
                 "default": {
                     "cache": "aiocache.SimpleMemoryCache",
-                    "serializer": {"class": "aiocache.serializers.JsonSerializer"},
+                    "serializer": serializer_config(),
                 }
             }
         )
@@ -71,9 +72,12 @@ class DependChatSession:
         self,
         create=False,
         save=True,
+        flush=False,
     ) -> None:
         self.create = create
         self.save = save
+        # write the session out at once instead of merging with later saves
+        self.flush = flush
 
     async def __call__(
         self,
@@ -102,12 +106,12 @@ class DependChatSession:
         # save to cache
         if save and (bot is not None):
             web_logger.debug(f"get_chatsession teardown save cache: {bot.meta.id}")
-            await bot.save_to_redis_cache(cache=cache)
+            await bot.save_to_redis_cache(cache=cache, flush=self.flush)
 
 
 depend_chat_session = DependChatSession(create=False, save=True)
 depend_chat_session_nosave = DependChatSession(create=False, save=False)
-depend_chat_session_new = DependChatSession(create=True, save=True)
+depend_chat_session_new = DependChatSession(create=True, save=True, flush=True)
 depend_chat_session_onetime = DependChatSession(create=True, save=False)
 
 
@@ -127,7 +131,7 @@ def get_chatsession(
     @asynccontextmanager
     async def get_bot() -> AsyncIterator[ChatSession | None]:
         """ """
-        async for bot in DependChatSession(create=create, save=save)(
+        async for bot in DependChatSession(create=create, save=save, flush=create)(
             cache=cache,
             settings=settings,
             sess_id=sess_id,
@@ -152,8 +156,8 @@ async def get_lastmood(
     # elif msg_id == 1:
     #     # first mood should be happy
     #     last_mood = "高兴"
-    elif await cache.exists(last_cache_key):
-        last_mood = (await cache.get(last_cache_key)).get("last_mood")
+    elif (last_scene := await cache.get(last_cache_key)) is not None:
+        last_mood = last_scene.get("last_mood")
     else:
         # choose random
         last_mood = ""
@@ -0,0 +1,218 @@
+"""Lifecycle of cache keys
+
+Keys are grouped into families by prefix, every family has a TTL applied at write time
+(`key_ttl`), so redis doesn't grow without bound:
+- `scene`: `msgmood:{sess}:{id}`, only needed while WebGAL plays the turn
+- `voice`: `voice:{sess}:{hash}`, audio of a session
+- `voice_shared`: `voice:shared:{key}`, warm voices of presets, kept
+- `session`: `sess:{id}` meta and history
+- `mood`: `moodmemo:...`, TTL by `mood_cache_ttl`
+
+With the SimpleMemoryCache fallback, `CacheSweeper` also expires keys written without TTL and
+evicts scenes/voices (oldest first) when the cache is over its size budget.
+"""
+
+import asyncio
+import random
+import time
+from aiocache import Cache, RedisCache, SimpleMemoryCache
+from .config import AppSettings, get_settings
+from .logger import web_logger
+
+# longest prefix first
+KEY_FAMILIES: dict[str, str] = {
+    "voice:shared:": "voice_shared",
+    "msgmood:": "scene",
+    "voice:": "voice",
+    "sess:": "session",
+    "moodmemo:": "mood",
+    # sessions of older versions, migrated on load
+    "session:": "legacy_session",
+    "history:": "legacy_session",
+}
+
+# evicted first when memory cache is over budget
+EVICTABLE_FAMILIES = ("voice", "scene")
+
+
+def key_family(key: str) -> str:
+    for prefix, family in KEY_FAMILIES.items():
+        if key.startswith(prefix):
+            return family
+    return "other"
+
+
+def family_ttl(family: str, settings: AppSettings = None) -> int | None:
+    """seconds, None for no expiry"""
+    settings = settings or get_settings()
+    ttl = {
+        "scene": settings.scene_ttl,
+        "voice": settings.voice_ttl,
+        "session": settings.session_ttl,
+        "mood": settings.mood_cache_ttl,
+    }.get(family, 0)
+    return ttl if ttl > 0 else None
+
+
+def key_ttl(key: str, settings: AppSettings = None) -> int | None:
+    """TTL to write the key with"""
+    return family_ttl(key_family(key), settings)
+
+
+def _sizeof(value) -> int:
+    # values are serialized bytes (or strings with JsonSerializer)
+    return len(value) if isinstance(value, (str, bytes)) else len(str(value))
+
+
+async def cache_usage(cache: Cache, redis_sample: int = 200, max_scan_keys: int = 10000) -> dict:
+    """number of keys and bytes per family
+
+    memory cache is counted exactly. For redis, keys are counted by SCAN and bytes are estimated
+    from `MEMORY USAGE` of up to `redis_sample` keys per family. The scan stops after
+    `max_scan_keys` keys, counts are then scaled up to `DBSIZE`.
+    """
+    families: dict[str, dict] = {}
+
+    def family_stats(family: str):
+        if family not in families:
+            families[family] = {"keys": 0, "bytes": 0, "ttl": family_ttl(family)}
+        return families[family]
+
+    if isinstance(cache, RedisCache):
+        client = cache.client
+        samples: dict[str, list] = {}
+        scanned = 0
+        truncated = False
+        async for key in client.scan_iter(count=1000):
+            if scanned >= max_scan_keys > 0:
+                truncated = True
+                break
+            scanned += 1
+            family = key_family(key.decode())
+            family_stats(family)["keys"] += 1
+            samples.setdefault(family, [])
+            if len(samples[family]) < redis_sample:
+                samples[family].append(key)
+
+        if truncated:
+            # the scanned keys are taken as a sample of the whole keyspace
+            scale = await client.dbsize() / scanned
+            for stats in families.values():
+                stats["keys"] = int(stats["keys"] * scale)
+
+        for family, keys in samples.items():
+            async with client.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    pipe.memory_usage(key)
+                sizes = [size or 0 for size in await pipe.execute()]
+            stats = family_stats(family)
+            stats["bytes"] = int(sum(sizes) / max(len(sizes), 1) * stats["keys"])
+            stats["estimated"] = truncated or stats["keys"] > len(keys)
+
+    elif isinstance(cache, SimpleMemoryCache):
+        for key, value in list(cache._cache.items()):
+            stats = family_stats(key_family(key))
+            stats["keys"] += 1
+            stats["bytes"] += _sizeof(value)
+
+    return {
+        "backend": type(cache).__name__,
+        "total_bytes": sum(stats["bytes"] for stats in families.values()),
+        "families": families,
+    }
+
+
+class CacheSweeper:
+    """periodic housekeeping of the SimpleMemoryCache fallback, redis expires keys by itself"""
+
+    def __init__(self, cache: SimpleMemoryCache, interval: float, max_bytes: int) -> None:
+        self.cache = cache
+        self.interval = interval
+        self.max_bytes = max_bytes
+        # key -> first time seen without expiry timer
+        self._no_ttl_since: dict[str, float] = {}
+        self.counters = {"expired": 0, "evicted": 0}
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval * random.uniform(0.9, 1.1))
+            try:
+                await self.sweep()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                web_logger.warning(f"cache sweep failed: {err}", exc_info=True)
+
+    async def sweep(self):
+        now = time.monotonic()
+        store: dict = self.cache._cache
+        handlers: dict = self.cache._handlers
+
+        # keys of expiring families written without TTL
+        for key in list(store):
+            ttl = key_ttl(key)
+            if ttl is None or key in handlers:
+                self._no_ttl_since.pop(key, None)
+                continue
+            since = self._no_ttl_since.setdefault(key, now)
+            if now - since >= ttl:
+                await self.cache.delete(key)
+                self._no_ttl_since.pop(key, None)
+                self.counters["expired"] += 1
+        for key in list(self._no_ttl_since):
+            if key not in store:
+                del self._no_ttl_since[key]
+
+        # size budget, oldest written first (dict keeps insertion order)
+        if self.max_bytes > 0:
+            total = sum(_sizeof(value) for value in store.values())
+            for key in list(store):
+                if total <= self.max_bytes:
+                    break
+                if key_family(key) in EVICTABLE_FAMILIES:
+                    total -= _sizeof(store[key])
+                    await self.cache.delete(key)
+                    self.counters["evicted"] += 1
+
+        web_logger.debug(f"cache sweep: {len(store)} keys, {self.counters}")
+
+
+_sweeper: CacheSweeper | None = None
+
+
+async def start_cache_sweeper(cache: Cache):
+    global _sweeper
+    settings = get_settings()
+    if not isinstance(cache, SimpleMemoryCache) or settings.cache_sweep_interval <= 0:
+        return
+
+    _sweeper = CacheSweeper(
+        cache,
+        interval=settings.cache_sweep_interval,
+        max_bytes=int(settings.memory_cache_max_mb * 1024 * 1024),
+    )
+    _sweeper.start()
+
+
+async def stop_cache_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        await _sweeper.stop()
+        _sweeper = None
+
+
+def sweeper_stats():
+    return dict(_sweeper.counters) if _sweeper is not None else None
@@ -0,0 +1,110 @@
+"""Process-wide registry of LLM clients
+
+One `AsyncOpenAI` (with its own pooled httpx client) is kept per `secret_pool` entry,
+so every chat turn and every mood query reuse the same keep-alive connections
+instead of doing a new TCP+TLS handshake.
+"""
+
+import asyncio
+import time
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import httpx
+from .config import AppSettings, get_settings
+from .models.bot import BotSecret
+from .logger import web_logger
+
+
+class LLMClientPool:
+    """clients keyed by the name of `secret_pool` entry (i.e. `llm_name` of presets)"""
+
+    def __init__(self, settings: AppSettings) -> None:
+        self.settings = settings
+        self._clients: dict[str, AsyncOpenAI] = {}
+
+    def _create_client(self, secret: BotSecret) -> AsyncOpenAI:
+        settings = self.settings
+        http_client = DefaultAsyncHttpxClient(
+            proxy=settings.proxy_url if settings.proxy_url else None,
+            limits=httpx.Limits(
+                max_connections=settings.llm_max_connections,
+                max_keepalive_connections=settings.llm_max_keepalive,
+                keepalive_expiry=settings.llm_keepalive_expiry,
+            ),
+        )
+        return AsyncOpenAI(
+            api_key=secret.api_key,
+            base_url=secret.base_url,
+            http_client=http_client,
+        )
+
+    def get(self, llm_name: str) -> AsyncOpenAI:
+        """get (or lazily create) the client of a secret"""
+        client = self._clients.get(llm_name)
+        if client is None:
+            secret = self.settings.secret_pool.get(llm_name)
+            if secret is None:
+                raise KeyError(f"llm {llm_name} not found in secret pool")
+
+            client = self._create_client(secret)
+            self._clients[llm_name] = client
+            web_logger.debug(f"llm client created: {llm_name} -> {secret.base_url}")
+
+        return client
+
+    async def warmup(self):
+        """open a connection to every provider in advance, so the first turn don't pay the handshake"""
+
+        async def _warmup_one(llm_name: str):
+            start = time.perf_counter()
+            try:
+                await self.get(llm_name).models.list()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                web_logger.warning(f"llm client warmup failed: {llm_name} ({err})")
+            else:
+                web_logger.info(
+                    f"llm client warmup: {llm_name} in {time.perf_counter() - start:.3f}s"
+                )
+
+        await asyncio.gather(*[_warmup_one(name) for name in self.settings.secret_pool])
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for llm_name, client in clients.items():
+            await client.close()
+            web_logger.debug(f"llm client closed: {llm_name}")
+
+
+_client_pool: LLMClientPool | None = None
+
+
+async def init_llm_clients():
+    global _client_pool
+    settings = get_settings()
+
+    _client_pool = LLMClientPool(settings)
+    for llm_name in settings.secret_pool:
+        _client_pool.get(llm_name)
+
+    if settings.llm_warmup:
+        await _client_pool.warmup()
+
+    web_logger.info(f"LLM clients setup: {list(_client_pool._clients)}")
+    return True
+
+
+def get_llm_client(llm_name: str) -> AsyncOpenAI:
+    """shared client of `llm_name`, the registry is created on demand if lifespan is not run (e.g. tests)"""
+    global _client_pool
+    if _client_pool is None:
+        _client_pool = LLMClientPool(get_settings())
+
+    return _client_pool.get(llm_name)
+
+
+async def close_llm_clients():
+    global _client_pool
+    if _client_pool is not None:
+        await _client_pool.aclose()
+        _client_pool = None
@@ -0,0 +1,206 @@
+"""In-process metrics in Prometheus text format, served at `/metrics`
+
+No dependency on prometheus_client. An observation is a bisect and a few list updates, cheap
+enough to stay on in production. Every worker process exposes its own metrics.
+"""
+
+import bisect
+import math
+from typing import Callable
+
+# seconds, from a cache hit to a slow LLM answer
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: tuple[str, ...], labels: tuple[str, ...], extra: str = ""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str):
+        return self._values.get(labels, 0)
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        # a counter without labels is shown before its first increment
+        values = self._values or ({(): 0} if not self.labelnames else {})
+        for labels, value in sorted(values.items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [count of every bucket (not cumulative) + overflow, sum]
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str):
+        series = self._series.get(labels)
+        return sum(series[0]) if series is not None else 0
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip((*self.buckets, math.inf), counts):
+                cumulative += n
+                le = f'le="{_format_value(bound)}"'
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {_format_value(total)}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """value read by a callback at exposition"""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[tuple[str, ...], float]],
+        labelnames: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def expose(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for labels, value in sorted(self.collect().items()):
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            )
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Counter | Histogram | Gauge] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[tuple[str, ...], float]],
+        labelnames: tuple[str, ...] = (),
+    ) -> Gauge:
+        return self._register(Gauge(name, help, collect, labelnames))
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+llm_first_token_seconds = registry.histogram(
+    "llm_time_to_first_token_seconds",
+    "time from chat request to the first streamed content",
+    ("preset", "llm_name"),
+)
+llm_stream_seconds = registry.histogram(
+    "llm_stream_seconds",
+    "time from chat request to the end of stream",
+    ("preset", "llm_name"),
+    buckets=(0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0),
+)
+llm_prompt_tokens = registry.histogram(
+    "llm_prompt_tokens",
+    "prompt tokens of chat requests, estimated when sent and as reported by usage",
+    ("preset", "llm_name", "source"),
+    buckets=(128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65536),
+)
+mood_seconds = registry.histogram(
+    "mood_latency_seconds",
+    "time from a sentence submitted to its mood ready",
+    ("tier",),
+)
+tts_first_chunk_seconds = registry.histogram(
+    "tts_first_chunk_seconds", "time to the first audio chunk", ("provider",)
+)
+tts_seconds = registry.histogram(
+    "tts_seconds", "time to synthesize the whole audio", ("provider",)
+)
+scene_fetch_delay_seconds = registry.histogram(
+    "scene_publish_to_fetch_seconds",
+    "time from a scene published to fetched by next.txt",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+next_wait_seconds = registry.histogram(
+    "next_wait_seconds", "time next.txt waited for its scene"
+)
+next_pending_total = registry.counter(
+    "next_pending_scenes_total",
+    "pending scenes returned by next.txt because the scene is not ready",
+)
+cache_lookups_total = registry.counter(
+    "cache_lookups_total",
+    "lookups of sessions, scenes and voices by result",
+    ("kind", "result"),
+)
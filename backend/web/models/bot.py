@@ -1,4 +1,5 @@
-from pydantic import BaseModel, constr
+from pydantic import BaseModel, constr, field_validator
+from typing import Literal
 from .voice import VoicePreset
 from ..logger import model_logger
 import random
@@ -24,6 +25,8 @@ class BotPreset(BaseModel):
     system_prompt: str = ""
     welcome_message: str = ""
     llm_params: BotParams = BotParams()
+    # max estimated tokens of a chat request (system prompt and history), 0 for no limit
+    context_budget: int = 0
 
 
 # class L2dAction(BaseModel):
@@ -38,7 +41,27 @@ class L2dBotPreset(BotPreset):
     bg_picture_path: str
     mood: dict[str, list[constr(pattern="^[a-zA-Z0-9]+?\\:[a-zA-Z0-9]+?$")]]
     bye_message: str = ""
+    # said when WebGAL fails to get answers too many times
+    hangup_message: str = "看来您那里信号很不好呢，我这边先挂了，祝您生活愉快。"
+    # pre-render fixed scenes and voices at startup
+    warmup: bool = True
     voice: VoicePreset | None = None
+    # how moods of answers are analyzed: `llm`, `local` engine only, or `hybrid`
+    # (local engine first, escalate to llm when confidence < mood_threshold)
+    mood_tier: Literal["llm", "local", "hybrid"] = "llm"
+    mood_threshold: float = 0.6
+    mood_engine: str = "lexicon"
+
+    @field_validator("mood_engine")
+    @classmethod
+    def check_mood_engine(cls, mood_engine: str):
+        """a typo fails when presets are loaded, not in a chat turn"""
+        # imported here, the engine module depends on config which loads presets
+        from ..mood_engine import MOOD_ENGINES
+
+        if mood_engine not in MOOD_ENGINES:
+            raise ValueError(f"unknown mood_engine {mood_engine!r}, choose from {list(MOOD_ENGINES)}")
+        return mood_engine
 
     def random_motion(self, test_mood: str = None):
         """choose a set of motion (motion:expression to be exact)
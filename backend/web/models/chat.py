@@ -1,14 +1,21 @@
-from pydantic import BaseModel, constr, Field, ConfigDict
+from pydantic import BaseModel, constr, Field, ConfigDict, PrivateAttr
 from fastapi import Depends
-from openai import AsyncOpenAI
-import httpx
 from .bot import BotParams, BotPreset, BotSecret
 from ..config import AppSettings, get_settings
+from ..llm_client import get_llm_client
+from ..usage import usage_meter
+from ..metrics import llm_first_token_seconds, llm_prompt_tokens, llm_stream_seconds
+from ..tokens import estimate_message_tokens
+from ..tracing import trace_event
+from ..codec import packb, unpackb
+from ..session_store import get_session_store, session_writes, session_l1
 from ..logger import model_logger, bot_logger
 from uuid import UUID, uuid4
 from datetime import datetime
 from enum import Enum
 import random
+import time
+import asyncio
 from aiocache import RedisCache, SimpleMemoryCache
 
 
@@ -23,6 +30,12 @@ class ChatSingleMessage(BaseModel):
     content: str
 
 
+# first field of message records, changed if the tuple layout changes
+# 2: tokens appended, records of 1 are read with tokens unknown
+MESSAGE_RECORD_VERSION = 2
+MESSAGE_RECORD_FIELDS = ("id", "role", "msg", "session", "mood", "others", "time", "tokens")
+
+
 class ChatMessage(BaseModel):
     id: UUID = Field(default_factory=uuid4)
     role: ChatRole
@@ -31,14 +44,46 @@ class ChatMessage(BaseModel):
     mood: str = ""
     others: str = ""
     time: datetime = Field(default_factory=datetime.now)
+    # estimated tokens in a request, 0 if unknown (saved by older versions)
+    tokens: int = 0
 
     model_config = ConfigDict(from_attributes=True)
 
+    def count_tokens(self) -> int:
+        """estimated tokens in a request, counted once"""
+        if not self.tokens:
+            self.tokens = estimate_message_tokens(self.msg)
+        return self.tokens
+
     def export_message(self):
         return ChatSingleMessage.model_validate(
             {"role": self.role, "content": self.msg}
         ).model_dump(mode="json")
 
+    def to_record(self) -> bytes:
+        """compact msgpack tuple of the message, read by `from_record`"""
+        return packb(
+            (
+                MESSAGE_RECORD_VERSION,
+                self.id.bytes,
+                ChatRole(self.role).value,
+                self.msg,
+                self.session.bytes,
+                self.mood,
+                self.others,
+                self.time.isoformat(),
+                self.tokens,
+            )
+        )
+
+    @classmethod
+    def from_record(cls, record: bytes | str):
+        """a message of `to_record`, or JSON saved by older versions"""
+        if isinstance(record, str) or record[:1] == b"{":
+            return cls.model_validate_json(record)
+        # uuid bytes and iso time are validated as they are
+        return cls.model_validate(dict(zip(MESSAGE_RECORD_FIELDS, unpackb(record)[1:])))
+
 
 class ChatSessionMeta(BaseModel):
     """only contains non expanding informations"""
@@ -72,6 +117,10 @@ class ChatSession(BaseModel):
     # we keep this messages ordered by time
     messages: list[ChatMessage] = []
     non_cached: int = 0
+    # meta as last saved, meta is only written if changed
+    _saved_meta: dict | None = PrivateAttr(default=None)
+    # store version this object is in sync with, 0 if never stored, None if unknown
+    _version: int | None = PrivateAttr(default=0)
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -88,7 +137,12 @@ class ChatSession(BaseModel):
         self, role: ChatRole, message: str, mood: str = "", others: str = ""
     ):
         new_msg = ChatMessage(
-            role=role, msg=message, session=self.meta.id, mood=mood, others=others
+            role=role,
+            msg=message,
+            session=self.meta.id,
+            mood=mood,
+            others=others,
+            tokens=estimate_message_tokens(message),
         )
         self.messages.append(new_msg)
         self.meta.current_msg_length += 1
@@ -117,16 +171,61 @@ class ChatSession(BaseModel):
     async def load_from_redis_cache(
         cls, sess_id: UUID, cache: RedisCache | SimpleMemoryCache
     ):
-        # check exists
         if isinstance(sess_id, str):
             sess_id = UUID(sess_id)
 
+        # buffered saves of this process are read back
+        await session_writes.flush(sess_id.hex)
+        store = get_session_store(cache)
+        sess = await session_l1.get(store, sess_id.hex)
+        if sess is not None:
+            return sess
+
+        loaded = await store.load(sess_id.hex)
+        if loaded is None:
+            # saved by older versions, moved to the new layout
+            sess = await cls._load_legacy_cache(sess_id, cache)
+            # written before the old keys are gone, not left in the write buffer
+            await sess.save_to_redis_cache(cache, flush=True)
+            await sess._delete_legacy_cache(cache)
+            model_logger.info(f"session migrated: {sess_id.hex}")
+            return sess
+
+        meta, history, version = loaded
+        sess = ChatSession(
+            meta=ChatSessionMeta.model_validate(meta),
+            messages=[ChatMessage.from_record(d) for d in history],
+        )
+        sess._saved_meta = sess.meta.model_dump(mode="json")
+        sess._version = version
+        session_l1.put(sess_id.hex, version, sess)
+        return sess
+
+    def _on_written(self, version: int):
+        """kept live in this process only if nobody else wrote the session since it was loaded,
+        every write of this object increments the version by one
+        """
+        if self._version is not None and version == self._version + 1:
+            self._version = version
+            session_l1.put(self.meta.id.hex, version, self)
+        else:
+            self.forget_live()
+
+    def forget_live(self):
+        """this object is no longer the stored session (written by others, or a failed turn)"""
+        self._version = None
+        session_l1.discard(self.meta.id.hex)
+
+    @classmethod
+    async def _load_legacy_cache(cls, sess_id: UUID, cache: RedisCache | SimpleMemoryCache):
+        """`session:{id}` meta and `history:{id}:{i}` messages"""
         sess_cache_key = f"session:{sess_id.hex}"
-        if not await cache.exists(sess_cache_key):
-            model_logger.warning(f"try reading {sess_cache_key} from cache, not found")
+        sess_meta_json = await cache.get(sess_cache_key)
+        if sess_meta_json is None:
+            model_logger.warning(f"try reading {sess_id.hex} from cache, not found")
             raise IndexError(f"{sess_id.hex} not found in cache")
 
-        sess_meta = ChatSessionMeta.model_validate_json(await cache.get(sess_cache_key))
+        sess_meta = ChatSessionMeta.model_validate_json(sess_meta_json)
 
         history_keys = [
             f"history:{sess_id.hex}:{msg_id}"
@@ -139,58 +238,77 @@ class ChatSession(BaseModel):
             [
                 ChatMessage.model_validate_json(d)
                 for d in (await cache.multi_get(history_keys))
+                if d is not None
             ]
             if history_keys
             else []
         )
 
-        return ChatSession(meta=sess_meta, messages=sess_his)
+        # all messages are written to the new layout
+        return ChatSession(meta=sess_meta, messages=sess_his, non_cached=len(sess_his))
 
-    async def save_to_redis_cache(self, cache: RedisCache | SimpleMemoryCache):
+    async def _delete_legacy_cache(self, cache: RedisCache | SimpleMemoryCache):
         sess_id = self.meta.id
+        legacy_keys = [f"session:{sess_id.hex}"] + [
+            f"history:{sess_id.hex}:{msg_id}"
+            for msg_id in range(self.meta.current_msg_length)
+        ]
+        await asyncio.gather(*[cache.delete(key) for key in legacy_keys])
 
-        sess_cache_key = f"session:{sess_id.hex}"
-        await cache.set(sess_cache_key, self.meta.model_dump_json())
-        model_logger.debug(f"session save to cache: {sess_cache_key}")
-
-        if self.non_cached > 0:
-            # cache.multi_set cannot be called with empty list
-            msg_to_cache = [
-                (
-                    f"history:{sess_id.hex}:{self.meta.current_msg_length + imsg}",
-                    self.messages[imsg].model_dump_json(),
-                )
-                for imsg in range(-self.non_cached, 0)
-            ]
-            await cache.multi_set(msg_to_cache)
-            model_logger.debug(
-                f"msg save to cache: {[pair[0] for pair in msg_to_cache]}"
-            )
+    async def save_to_redis_cache(
+        self, cache: RedisCache | SimpleMemoryCache, flush: bool = False
+    ):
+        """save changed meta and new messages, merged with other saves of this session in a short
+        window unless flush (e.g. the end of a turn)
+        """
+        sess_id = self.meta.id
 
+        # JSON if cache values are JSON, so a rollback still reads them
+        encode = (
+            ChatMessage.model_dump_json
+            if get_settings().cache_codec == "json"
+            else ChatMessage.to_record
+        )
+        # taken before any await, so every message is appended exactly once and in order
+        new_messages = (
+            [encode(msg) for msg in self.messages[-self.non_cached :]]
+            if self.non_cached > 0
+            else []
+        )
         self.non_cached = 0
+        if self.meta.max_memory > 0:
+            # same as what a reload gets, live sessions don't grow
+            del self.messages[: -self.meta.max_memory]
+        meta = self.meta.model_dump(mode="json")
+        meta_changed = meta != self._saved_meta
+        self._saved_meta = meta
+
+        await session_writes.save(
+            get_session_store(cache),
+            sess_id.hex,
+            meta if meta_changed else None,
+            new_messages,
+            max_memory=self.meta.max_memory,
+            # kept live in this process, valid until written by others
+            on_written=self._on_written,
+        )
+        if flush:
+            await session_writes.flush(sess_id.hex)
+        model_logger.debug(
+            f"session save: {sess_id.hex}, meta changed: {meta_changed}, {len(new_messages)} new messages"
+        )
 
         return True
 
-    async def get_answer_a(
-        self, settings: AppSettings, prompt: str = "", preset_name: str = "sakiko"
-    ):
-        """
-        async gen that return pieces of answers
-        """
-        self.add_message("user", prompt)
-
-        secret = settings.secret_pool.get(settings.bot_preset.get(preset_name).llm_name)
-        client = AsyncOpenAI(
-            api_key=secret.api_key,
-            base_url=secret.base_url,
-            http_client=httpx.AsyncClient(proxy=settings.proxy_url)
-            if settings.proxy_url
-            else None,
-        )
+    def build_request(self, context_budget: int = 0) -> tuple[list[dict], int]:
+        """messages of a chat request and their estimated tokens
 
-        # construct messages
-        message_request = (
-            [self.meta.export_system_prompt()] if self.meta.system_prompt else []
+        the newest messages (at most `max_memory`) are sent. With a context_budget, older
+        messages beyond the budget are dropped too, the newest message is always sent.
+        """
+        system_prompt = self.meta.export_system_prompt()
+        prompt_tokens = (
+            estimate_message_tokens(self.meta.system_prompt) if system_prompt else 0
         )
         history = []
         for _, msg in zip(range(self.meta.max_memory), self.messages[::-1]):
@@ -199,10 +317,33 @@ class ChatSession(BaseModel):
             if msg.role == "clear":
                 break
 
+            msg_tokens = msg.count_tokens()
+            if context_budget > 0 and history and prompt_tokens + msg_tokens > context_budget:
+                break
+            prompt_tokens += msg_tokens
             history.append(msg.export_message())
 
+        message_request = [system_prompt] if system_prompt else []
         message_request.extend(history[::-1])
-        bot_logger.debug(f"new chat request: {message_request}")
+        return message_request, prompt_tokens
+
+    async def get_answer_a(
+        self, settings: AppSettings, prompt: str = "", preset_name: str = "sakiko"
+    ):
+        """
+        async gen that return pieces of answers
+        """
+        self.add_message("user", prompt)
+
+        preset = settings.bot_preset.get(preset_name)
+        llm_name = preset.llm_name
+        secret = settings.secret_pool.get(llm_name)
+        # shared client, keep-alive connections are reused among turns
+        client = get_llm_client(llm_name)
+
+        message_request, prompt_tokens = self.build_request(preset.context_budget)
+        llm_prompt_tokens.observe(prompt_tokens, preset_name, llm_name, "estimated")
+        bot_logger.debug(f"new chat request ({prompt_tokens} tokens): {message_request}")
 
         model_params = self.meta.llm_params.model_dump(mode="json")
         # try to set stream_options > include_usage
@@ -213,25 +354,64 @@ class ChatSession(BaseModel):
         ):
             model_params["stream_options"]["include_usage"] = True
 
-        stream = await client.chat.completions.create(
-            model=secret.model,
-            messages=message_request,
-            stream=True,
-            **self.meta.llm_params.model_dump(mode="json"),
+        # saves during the turn are written once by the flush at its end
+        session_writes.hold(self.meta.id.hex)
+        started = time.perf_counter()
+        try:
+            stream = await client.chat.completions.create(
+                model=secret.model,
+                messages=message_request,
+                stream=True,
+                **model_params,
+            )
+        except BaseException:
+            # the turn failed, the prompt added above is not saved
+            self.forget_live()
+            session_writes.release(self.meta.id.hex)
+            raise
+        trace_event(
+            "llm.request",
+            "llm",
+            dur=time.perf_counter() - started,
+            prompt_tokens=prompt_tokens,
+            messages=len(message_request),
         )
 
         async def resp_gen(cache=None):
             resp = []
-            total_tokens = 0
-            async for chunk in stream:
-                chunk_piece = chunk.choices[0].delta.content or ""
-                if chunk.usage is not None:
-                    total_tokens += chunk.usage.total_tokens
-                yield chunk_piece
-                resp.append(chunk_piece)
-
+            first_token = True
+            try:
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage_meter.record(
+                            chunk.usage, scope="chat", preset_name=preset_name, llm_name=llm_name
+                        )
+                        sent_tokens = getattr(chunk.usage, "prompt_tokens", None)
+                        if sent_tokens:
+                            llm_prompt_tokens.observe(sent_tokens, preset_name, llm_name, "usage")
+                        model_logger.debug(f"usage: {chunk.usage}, estimated prompt: {prompt_tokens}")
+                    # the usage chunk has no choices
+                    if not chunk.choices:
+                        continue
+                    chunk_piece = chunk.choices[0].delta.content or ""
+                    if first_token and chunk_piece:
+                        first_token = False
+                        llm_first_token_seconds.observe(
+                            time.perf_counter() - started, preset_name, llm_name
+                        )
+                        trace_event("llm.first_token", "llm")
+                    yield chunk_piece
+                    resp.append(chunk_piece)
+            except BaseException:
+                # the turn is not finished, the prompt is not saved
+                self.forget_live()
+                session_writes.release(self.meta.id.hex)
+                raise
+
+            elapsed = time.perf_counter() - started
+            llm_stream_seconds.observe(elapsed, preset_name, llm_name)
+            trace_event("llm.stream", "llm", dur=elapsed, chunks=len(resp))
             resp_text = "".join(resp)
-            model_logger.debug(f"total_token: {total_tokens}")
             model_logger.debug(f"resp_gen: before add_message: {resp_text}")
             self.add_message("assistant", resp_text)
             model_logger.debug(f"resp_gen: after add_message: {resp_text}")
@@ -241,15 +421,8 @@ class ChatSession(BaseModel):
                 model_logger.debug(
                     f"resp_gen: save to cache: {self.meta.id}, msg={self.meta.current_msg_length}"
                 )
-                await self.save_to_redis_cache(cache)
-
-                if total_tokens > 0:
-                    if await cache.exists("total_token"):
-                        prev_token = await cache.get("total_token", total_tokens)
-                        await cache.set("total_token", prev_token + total_tokens)
-                    else:
-                        await cache.set("total_token", total_tokens)
-
+                # the turn is finished, write everything of this turn at once
+                await self.save_to_redis_cache(cache, flush=True)
 
             yield None
 
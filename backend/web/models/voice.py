@@ -43,4 +43,6 @@ class ServeTTSRequest(BaseModel):
 class VoicePreset(BaseModel):
     type: str | None = None
     api: str = ""
-    voice_line: str = ""
\ No newline at end of file
+    voice_line: str = ""
+    # fish-speech only: stream audio chunks while synthesizing (wav instead of mp3)
+    streaming: bool = False
\ No newline at end of file
@@ -0,0 +1,509 @@
+"""Mood analysis of answer sentences
+
+sentences are classified concurrently while the main LLM stream keeps going,
+but results are always handed out in the order they are submitted.
+"""
+
+import asyncio
+import hashlib
+import re
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable
+from aiocache import Cache
+from .config import AppSettings, get_settings
+from .llm_client import get_llm_client
+from .usage import usage_meter
+from .metrics import mood_seconds
+from .tracing import trace_event
+from .logger import bot_logger
+from .webgal_utils import remove_parathesis
+
+# moods that `mood_analyzer` presets are allowed to answer
+MOOD_LABELS = ("高兴", "生气", "悲伤", "无奈", "坚定", "害羞", "惊讶", "害怕")
+
+# a line of batched answer, like `2:高兴` or `2. 【高兴】`
+match_batch_mood_line = re.compile(r"^\s*(\d+)\s*[:：.、]\s*【?([^】\s]+)】?\s*$")
+
+
+def format_batch_mood_prompt(sentences: list[str]):
+    """number the sentences one per line, as `mood_analyzer_batch` expects"""
+    return "\n".join(
+        f"{i_sent + 1}. {sent.strip().replace(chr(10), ' ')}"
+        for i_sent, sent in enumerate(sentences)
+    )
+
+
+def parse_batch_moods(answer: str, n_sentences: int) -> list[str | None]:
+    """parse `序号:评价` lines of a batched answer
+
+    sentences without a valid mood get None, so that they can fallback
+    """
+    moods: list[str | None] = [None] * n_sentences
+    for line in answer.splitlines():
+        m = match_batch_mood_line.match(line)
+        if m is None:
+            continue
+
+        i_sent, mood = int(m.group(1)) - 1, m.group(2)
+        if 0 <= i_sent < n_sentences and mood in MOOD_LABELS:
+            moods[i_sent] = mood
+
+    return moods
+
+
+def normalize_mood(answer: str) -> str:
+    """take the first known mood in answer like `【高兴】。`, or the stripped answer if none"""
+    answer = answer.strip()
+    positions = [(answer.find(mood), mood) for mood in MOOD_LABELS if mood in answer]
+    return min(positions)[1] if positions else answer
+
+
+class MoodClassifier:
+    """stateless client of `mood_analyzer` presets
+
+    only the fixed system prompt plus the current sentence(s) are sent, there is no ChatSession
+    bookkeeping and no history. The system message is built once, so every request starts with a
+    byte-identical prefix and provider side prompt caching can hit.
+    """
+
+    def __init__(
+        self,
+        settings: AppSettings,
+        preset_name: str = "mood_analyzer",
+        batch_preset_name: str = "mood_analyzer_batch",
+    ) -> None:
+        self.settings = settings
+        self.preset_name = preset_name
+        self.batch_preset_name = batch_preset_name
+        self._single = self._prepare(preset_name)
+        self._batch = self._prepare(batch_preset_name)
+
+    @property
+    def available(self):
+        return self._single is not None
+
+    @property
+    def batch_available(self):
+        return self._batch is not None
+
+    @property
+    def model(self) -> str:
+        """internal model name of the single sentence analyzer"""
+        return self._single[1] if self._single is not None else ""
+
+    @property
+    def batch_model(self) -> str:
+        """internal model name of the batch analyzer"""
+        return self._batch[1] if self._batch is not None else ""
+
+    def _prepare(self, preset_name: str):
+        """(llm_name, model, fixed message prefix, llm params) of a preset"""
+        preset = self.settings.bot_preset.get(preset_name)
+        if preset is None:
+            return None
+
+        secret = self.settings.secret_pool.get(preset.llm_name)
+        if secret is None:
+            bot_logger.warning(f"mood preset {preset_name}: llm {preset.llm_name} not found")
+            return None
+
+        prefix = (
+            ({"role": "system", "content": preset.system_prompt},)
+            if preset.system_prompt
+            else ()
+        )
+        return (
+            preset.llm_name,
+            secret.model,
+            prefix,
+            preset.llm_params.model_dump(mode="json"),
+        )
+
+    async def _query(self, prepared: tuple, content: str, preset_name: str) -> str:
+        llm_name, model, prefix, params = prepared
+        resp = await get_llm_client(llm_name).chat.completions.create(
+            model=model,
+            messages=[*prefix, {"role": "user", "content": content}],
+            stream=False,
+            **params,
+        )
+        # counted apart from chat answers
+        usage_meter.record(
+            getattr(resp, "usage", None),
+            scope="mood",
+            preset_name=preset_name,
+            llm_name=llm_name,
+        )
+        return resp.choices[0].message.content or ""
+
+    async def classify(self, sentence: str) -> str:
+        answer = await self._query(self._single, sentence, self.preset_name)
+        bot_logger.debug(f"mood query: {sentence}|{answer}|")
+        return normalize_mood(answer)
+
+    async def classify_batch(self, sentences: list[str]) -> list[str | None]:
+        prompt = format_batch_mood_prompt(sentences)
+        answer = await self._query(self._batch, prompt, self.batch_preset_name)
+        bot_logger.debug(f"batched mood query: {prompt}|{answer}|")
+        return parse_batch_moods(answer, len(sentences))
+
+
+_mood_classifiers: dict[tuple[str, str], MoodClassifier] = {}
+
+
+def get_mood_classifier(
+    preset_name: str = "mood_analyzer", batch_preset_name: str = "mood_analyzer_batch"
+) -> MoodClassifier:
+    """process-wide classifier, so the prepared prefix is shared"""
+    key = (preset_name, batch_preset_name)
+    if key not in _mood_classifiers:
+        _mood_classifiers[key] = MoodClassifier(
+            get_settings(), preset_name=preset_name, batch_preset_name=batch_preset_name
+        )
+
+    return _mood_classifiers[key]
+
+
+class MoodMemo:
+    """cross-session memo of analyzed moods, in the shared cache with an in-process LRU in front
+
+    openings, apologies and catch-phrases are the same in many sessions, so they are analyzed once.
+    keys are hash of normalized sentence, scoped by analyzer preset and model.
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        scope: str,
+        ttl: int = 7 * 24 * 3600,
+        l1_size: int = 1024,
+    ) -> None:
+        self.cache = cache
+        self.scope = scope
+        self.ttl = ttl
+        self.l1_size = l1_size
+        self._l1: OrderedDict[str, str] = OrderedDict()
+        self.hits_l1 = 0
+        self.hits_l2 = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(sentence: str) -> str:
+        """（） stripped and whitespaces collapsed"""
+        return " ".join(remove_parathesis(sentence).split())
+
+    def cache_key(self, sentence: str) -> str | None:
+        normalized = self.normalize(sentence)
+        if not normalized:
+            # nothing left to tell the mood
+            return None
+        digest = hashlib.sha1(normalized.encode()).hexdigest()
+        return f"moodmemo:{self.scope}:{digest}"
+
+    def _l1_put(self, key: str, mood: str):
+        self._l1[key] = mood
+        self._l1.move_to_end(key)
+        while len(self._l1) > self.l1_size:
+            self._l1.popitem(last=False)
+
+    def stats(self):
+        return {
+            "hits_l1": self.hits_l1,
+            "hits_l2": self.hits_l2,
+            "misses": self.misses,
+        }
+
+    async def multi_get(self, sentences: list[str]) -> list[str | None]:
+        keys = [self.cache_key(sent) for sent in sentences]
+        moods: list[str | None] = [None] * len(keys)
+
+        l2_index = []
+        for i_key, key in enumerate(keys):
+            if key is None:
+                continue
+            if key in self._l1:
+                self._l1.move_to_end(key)
+                moods[i_key] = self._l1[key]
+                self.hits_l1 += 1
+            else:
+                l2_index.append(i_key)
+
+        if l2_index:
+            try:
+                l2_moods = await self.cache.multi_get([keys[i] for i in l2_index])
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                bot_logger.warning(f"mood memo read failed: {err}")
+                l2_moods = [None] * len(l2_index)
+
+            for i_key, mood in zip(l2_index, l2_moods):
+                if mood is not None:
+                    moods[i_key] = mood
+                    self._l1_put(keys[i_key], mood)
+                    self.hits_l2 += 1
+
+        self.misses += sum(
+            mood is None for key, mood in zip(keys, moods) if key is not None
+        )
+        return moods
+
+    async def get(self, sentence: str) -> str | None:
+        return (await self.multi_get([sentence]))[0]
+
+    async def multi_set(self, pairs: list[tuple[str, str]]):
+        # only valid moods are remembered
+        to_cache = []
+        for sentence, mood in pairs:
+            key = self.cache_key(sentence)
+            if key is not None and mood in MOOD_LABELS:
+                self._l1_put(key, mood)
+                to_cache.append((key, mood))
+
+        if to_cache:
+            try:
+                await self.cache.multi_set(to_cache, ttl=self.ttl)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                bot_logger.warning(f"mood memo write failed: {err}")
+
+    async def set(self, sentence: str, mood: str):
+        await self.multi_set([(sentence, mood)])
+
+
+_mood_memos: dict[str, MoodMemo] = {}
+
+
+def get_mood_memo(cache: Cache, classifier: MoodClassifier, batch: bool = False) -> MoodMemo:
+    """process-wide memo of a classifier, scoped by its analyzer preset/model
+
+    `batch` for the memo of the batch analyzer, which may answer differently.
+    """
+    settings = classifier.settings
+    if batch:
+        scope = f"{classifier.batch_preset_name}:{classifier.batch_model}"
+    else:
+        scope = f"{classifier.preset_name}:{classifier.model}"
+    memo = _mood_memos.get(scope)
+    if memo is None or memo.cache is not cache:
+        memo = MoodMemo(
+            cache,
+            scope=scope,
+            ttl=settings.mood_cache_ttl,
+            l1_size=settings.mood_cache_l1_size,
+        )
+        _mood_memos[scope] = memo
+
+    return memo
+
+
+class MoodPipeline:
+    """bounded concurrent mood stage that preserves sentence order
+
+    producer calls `submit` for every finished sentence and `close` at the end of stream,
+    consumer iterates `results` to get `(sentence, mood, final)` in submission order.
+
+    if `classify_batch` is given and `batch_size != 1`, sentences are buffered and classified
+    in one query when `batch_size` sentences are buffered (0 for no limit), `batch_wait` seconds
+    passed since the first buffered one, or the final sentence comes.
+    Sentences whose batched mood is None fallback to `classify` one by one.
+
+    `local_classify` is an optional in-process tier tried first, it returns None to escalate.
+    `memo` is an optional cross-session cache of LLM answered moods, `batch_memo` the one of
+    batched answers.
+    """
+
+    def __init__(
+        self,
+        classify: Callable[[str], Awaitable[str]],
+        concurrency: int = 4,
+        classify_batch: Callable[[list[str]], Awaitable[list[str | None]]] = None,
+        batch_size: int = 1,
+        batch_wait: float = 0.2,
+        local_classify: Callable[[str], str | None] = None,
+        memo: "MoodMemo" = None,
+        batch_memo: "MoodMemo" = None,
+    ) -> None:
+        self._classify = classify
+        self._local_classify = local_classify
+        self._memo = memo
+        self._batch_memo = batch_memo
+        self._classify_batch = classify_batch
+        self._batch_size = batch_size
+        self._batch_wait = batch_wait
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        # FIFO of (sentence, mood awaitable, final), None marks the end
+        self._queue: asyncio.Queue[tuple[str, Awaitable[str], bool] | None] = (
+            asyncio.Queue()
+        )
+        self._tasks: list[asyncio.Task] = []
+        # buffered sentences for batch mode
+        self._batch: list[tuple[str, asyncio.Future]] = []
+        self._batch_timer: asyncio.TimerHandle | None = None
+
+    @property
+    def batched(self):
+        return self._classify_batch is not None and self._batch_size != 1
+
+    async def _run(self, sentence: str, lookup_memo: bool = True) -> str:
+        if not sentence.strip():
+            # won't query mood for empty sentence
+            return ""
+
+        if self._memo is not None and lookup_memo:
+            mood = await self._memo.get(sentence)
+            if mood is not None:
+                return mood
+
+        async with self._semaphore:
+            try:
+                mood = await self._classify(sentence)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                # mood is not essential, random motion would be chosen
+                bot_logger.warning(f"mood analyze failed: {sentence}|{err}")
+                return ""
+
+        if self._memo is not None:
+            await self._memo.set(sentence, mood)
+        return mood
+
+    async def _run_batch(self, batch: list[tuple[str, asyncio.Future]]):
+        try:
+            to_query = batch
+            if self._batch_memo is not None:
+                # repeated lines are answered by memo
+                memo_moods = await self._batch_memo.multi_get([sent for sent, _ in batch])
+                to_query = []
+                for (sent, fut), mood in zip(batch, memo_moods):
+                    if mood is None:
+                        to_query.append((sent, fut))
+                    else:
+                        fut.set_result(mood)
+
+                if not to_query:
+                    return
+
+            sentences = [sent for sent, _ in to_query]
+            moods = [None] * len(to_query)
+            async with self._semaphore:
+                try:
+                    moods = await self._classify_batch(sentences)
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except Exception as err:
+                    bot_logger.warning(f"batched mood analyze failed: {err}")
+
+            if len(moods) != len(to_query):
+                bot_logger.warning(
+                    f"batched mood analyze returns {len(moods)} moods for {len(to_query)} sentences"
+                )
+                moods = [None] * len(to_query)
+
+            fallback = []
+            for (sent, fut), mood in zip(to_query, moods):
+                if mood is None:
+                    fallback.append((sent, fut))
+                else:
+                    fut.set_result(mood)
+
+            if self._batch_memo is not None:
+                await self._batch_memo.multi_set(
+                    [(sent, mood) for sent, mood in zip(sentences, moods) if mood is not None]
+                )
+
+            if fallback:
+                # malformed results are queried again one by one
+                bot_logger.debug(f"batched mood fallback: {[sent for sent, _ in fallback]}")
+                fallback_moods = await asyncio.gather(
+                    *[self._run(sent, lookup_memo=False) for sent, _ in fallback]
+                )
+                for (_, fut), mood in zip(fallback, fallback_moods):
+                    fut.set_result(mood)
+
+        finally:
+            # never leave the consumer waiting
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_result("")
+
+    def _flush_batch(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+
+        if self._batch:
+            batch, self._batch = self._batch, []
+            self._tasks.append(asyncio.create_task(self._run_batch(batch)))
+
+    def submit(self, sentence: str, final: bool = False):
+        """start classifying a sentence right away (or buffer it in batch mode)"""
+        started = time.perf_counter()
+        local_mood = (
+            self._local_classify(sentence)
+            if self._local_classify is not None and sentence.strip()
+            else None
+        )
+
+        if local_mood is not None:
+            # answered by the local tier, no LLM query
+            result = asyncio.get_running_loop().create_future()
+            result.set_result(local_mood)
+            tier = "local"
+
+        elif not self.batched:
+            result = asyncio.create_task(self._run(sentence))
+            self._tasks.append(result)
+            tier = "llm"
+
+        else:
+            result = asyncio.get_running_loop().create_future()
+            tier = "batch"
+            if sentence.strip():
+                self._batch.append((sentence, result))
+                if 0 < self._batch_size <= len(self._batch):
+                    self._flush_batch()
+                elif self._batch_timer is None:
+                    self._batch_timer = asyncio.get_running_loop().call_later(
+                        self._batch_wait, self._flush_batch
+                    )
+            else:
+                # won't query mood for empty sentence
+                result.set_result("")
+
+        if sentence.strip():
+
+            def observe_latency(fut: asyncio.Future):
+                if not fut.cancelled():
+                    elapsed = time.perf_counter() - started
+                    mood_seconds.observe(elapsed, tier)
+                    trace_event("mood", "mood", dur=elapsed, tier=tier, chars=len(sentence))
+
+            result.add_done_callback(observe_latency)
+
+        if final and self.batched:
+            # the remaining answer goes together
+            self._flush_batch()
+
+        self._queue.put_nowait((sentence, result, final))
+
+    def close(self):
+        """no more sentences"""
+        if self.batched:
+            self._flush_batch()
+        self._queue.put_nowait(None)
+
+    def cancel(self):
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        for task in self._tasks:
+            task.cancel()
+
+    async def results(self) -> AsyncIterator[tuple[str, str, bool]]:
+        while (item := await self._queue.get()) is not None:
+            sentence, result, final = item
+            yield sentence, await result, final
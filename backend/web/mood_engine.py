@@ -0,0 +1,140 @@
+"""In-process mood engines, a zero-latency tier before the LLM `mood_analyzer`
+
+An engine scores a sentence against the moods in `MOOD_LABELS` and returns the best mood with
+a confidence in [0, 1]. Presets choose the tier by `mood_tier`:
+- `llm`: always ask the LLM (default)
+- `local`: only use the local engine
+- `hybrid`: use the local engine, escalate to the LLM when confidence < `mood_threshold`
+"""
+
+import re
+from typing import Callable
+from .mood import MOOD_LABELS
+
+# keyword -> weight for every mood, keywords are matched as substrings
+DEFAULT_MOOD_LEXICON: dict[str, dict[str, float]] = {
+    "高兴": {
+        "高兴": 2, "开心": 2, "太好了": 2, "哈哈": 2, "嘻嘻": 2, "真棒": 2, "喜欢": 1.5,
+        "谢谢": 1, "感谢": 1, "欢迎": 1.5, "很乐意": 2, "乐意": 1, "愉快": 2, "祝您": 1.5,
+        "为您服务": 1.5, "您好": 1, "有什么可以帮": 1.5, "不错": 1, "好消息": 2, "恭喜": 2,
+        "期待": 1, "微笑": 1.5, "笑": 1, "~": 0.5, "♪": 1,
+    },
+    "生气": {
+        "生气": 2, "可恶": 2, "混蛋": 2.5, "闭嘴": 2.5, "滚": 2, "烦死": 2, "气死": 2.5,
+        "凭什么": 2, "怎么可以": 1.5, "不可理喻": 2.5, "过分": 2, "岂有此理": 2.5,
+        "够了": 1.5, "别再": 1, "不许": 1.5, "愤怒": 2, "瞪": 1.5, "咬牙": 1.5, "！！": 1,
+    },
+    "悲伤": {
+        "悲伤": 2, "难过": 2, "伤心": 2, "哭": 2, "眼泪": 2, "泪": 1.5, "遗憾": 1.5,
+        "可惜": 1.5, "失去": 1.5, "孤独": 1.5, "寂寞": 1.5, "痛苦": 2, "心痛": 2,
+        "再也": 1, "对不起": 1, "抱歉": 0.5, "低下头": 1.5, "哽咽": 2,
+    },
+    "无奈": {
+        "无奈": 2, "叹气": 2, "叹了口气": 2, "唉": 2, "算了": 1.5, "没办法": 2, "只好": 1.5,
+        "只能": 1, "罢了": 1.5, "随便": 1, "也许吧": 1.5, "疲惫": 1.5, "揉了揉": 1,
+        "太阳穴": 1.5, "苦笑": 2, "……": 0.5, "...": 0.5,
+    },
+    "坚定": {
+        "坚定": 2, "一定": 1.5, "必须": 1.5, "绝对": 1.5, "决不": 2, "绝不": 2, "请放心": 2,
+        "放心": 1, "负责": 1, "保证": 1.5, "承诺": 1.5, "会处理": 1.5, "请您": 0.5,
+        "按照规定": 1.5, "规定": 1, "坚持": 1.5, "专注": 1, "目标": 1, "任务": 1,
+        "我会": 1, "不会放弃": 2,
+    },
+    "害羞": {
+        "害羞": 2, "脸红": 2.5, "不好意思": 2, "羞": 2, "别看": 1.5, "讨厌啦": 2,
+        "小声": 1.5, "低声": 1, "支支吾吾": 2, "那个……": 1.5, "才不是": 2, "人家": 1,
+    },
+    "惊讶": {
+        "惊讶": 2, "诶": 2, "欸": 2, "咦": 2, "居然": 2, "竟然": 2, "真的吗": 2,
+        "怎么会": 1.5, "不会吧": 2, "没想到": 2, "什么？": 1.5, "天哪": 2, "哇": 1.5,
+        "？！": 1.5, "!?": 1.5, "瞪大": 1.5,
+    },
+    "害怕": {
+        "害怕": 2, "可怕": 2, "恐怖": 2, "吓": 2, "不要过来": 2.5, "救命": 2.5, "发抖": 2,
+        "颤抖": 2, "担心": 1.5, "不安": 1.5, "危险": 1.5, "慌": 1.5, "紧张": 1,
+    },
+}
+
+
+class LexiconMoodEngine:
+    """keyword scorer, one compiled regex pass per sentence
+
+    confidence is `top / (total + smoothing)`: a sentence with a single weak cue or
+    mixed cues has low confidence and would be escalated in `hybrid` tier.
+    """
+
+    def __init__(
+        self,
+        lexicon: dict[str, dict[str, float]] = None,
+        smoothing: float = 1.0,
+    ) -> None:
+        lexicon = DEFAULT_MOOD_LEXICON if lexicon is None else lexicon
+        self.smoothing = smoothing
+        # keyword -> [(mood, weight), ...]
+        self._keywords: dict[str, list[tuple[str, float]]] = {}
+        for mood, keywords in lexicon.items():
+            for keyword, weight in keywords.items():
+                self._keywords.setdefault(keyword, []).append((mood, weight))
+
+        # longest first, so that `叹了口气` wins over `叹气`-like shorter overlaps
+        self._match_keywords = re.compile(
+            "|".join(
+                re.escape(k) for k in sorted(self._keywords, key=len, reverse=True)
+            )
+        )
+
+    def scores(self, sentence: str) -> dict[str, float]:
+        scores = dict.fromkeys(MOOD_LABELS, 0.0)
+        for m in self._match_keywords.finditer(sentence):
+            for mood, weight in self._keywords[m.group(0)]:
+                scores[mood] = scores.get(mood, 0.0) + weight
+        return scores
+
+    def classify(self, sentence: str) -> tuple[str | None, float]:
+        """(best mood, confidence), mood is None if nothing matched"""
+        scores = self.scores(sentence)
+        total = sum(scores.values())
+        if total <= 0:
+            return None, 0.0
+
+        mood = max(scores, key=scores.get)
+        return mood, scores[mood] / (total + self.smoothing)
+
+
+MOOD_ENGINES = {
+    "lexicon": LexiconMoodEngine,
+}
+
+_mood_engines: dict[str, LexiconMoodEngine] = {}
+
+
+def get_mood_engine(name: str = "lexicon"):
+    """process-wide engine instance"""
+    if name not in _mood_engines:
+        _mood_engines[name] = MOOD_ENGINES[name]()
+    return _mood_engines[name]
+
+
+def make_local_classify(
+    tier: str = "llm", threshold: float = 0.6, engine: str = "lexicon"
+) -> Callable[[str], str | None] | None:
+    """local tier of `MoodPipeline` according to preset
+
+    returns None for `llm` tier. The returned function gives a mood, or None to escalate to LLM.
+    """
+    if tier == "llm":
+        return None
+
+    mood_engine = get_mood_engine(engine)
+
+    def local_classify(sentence: str) -> str | None:
+        mood, confidence = mood_engine.classify(sentence)
+        if tier == "local":
+            # unknown mood would fallback to random motions
+            return mood or ""
+        elif mood is not None and confidence >= threshold:
+            return mood
+        else:
+            return None
+
+    return local_classify
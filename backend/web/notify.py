@@ -0,0 +1,107 @@
+"""Readiness notification of cache keys
+
+`next.txt` waits for its scene instead of polling the cache. The producer publishes the key
+after the scene is cached:
+- in-process waiters are woken by an `asyncio.Event` of the key
+- with redis, the key is also published to a channel, so waiters in other workers wake up too
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable
+from aiocache import Cache
+from .logger import web_logger
+
+
+class ReadinessBus:
+    def __init__(self, channel: str = "llm_webgal:ready") -> None:
+        self.channel = channel
+        # key -> (event, number of waiters)
+        self._events: dict[str, tuple[asyncio.Event, int]] = {}
+        self._redis = None
+        self._listener: asyncio.Task | None = None
+
+    async def start(self, cache: Cache):
+        """subscribe to redis channel if cache is redis, otherwise in-process only"""
+        client = getattr(cache, "client", None)
+        if client is None or not hasattr(client, "pubsub"):
+            return
+
+        self._redis = client
+        self._listener = asyncio.create_task(self._listen())
+        web_logger.info(f"readiness bus subscribed: {self.channel}")
+
+    async def stop(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        self._listener = None
+        self._redis = None
+
+    async def _listen(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") != "message":
+                        continue
+                    key = message["data"]
+                    self._set(key.decode() if isinstance(key, bytes) else key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                # waiters still return at their deadline, so just retry
+                web_logger.warning(f"readiness bus error: {err}, resubscribe")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    def _set(self, key: str):
+        event_waiters = self._events.get(key)
+        if event_waiters is not None:
+            event_waiters[0].set()
+
+    def has_waiter(self, key: str) -> bool:
+        """whether a request of this process is waiting for the key"""
+        return key in self._events
+
+    async def publish(self, key: str):
+        """wake up waiters of the key, call after the value is cached"""
+        self._set(key)
+        if self._redis is not None:
+            try:
+                await self._redis.publish(self.channel, key)
+            except Exception as err:
+                web_logger.warning(f"readiness bus publish failed: {key} ({err})")
+
+    async def wait(
+        self, key: str, fetch: Callable[[], Awaitable[Any]], timeout: float
+    ) -> Any:
+        """fetch the value, wait for its publish if not ready. None if not ready before timeout"""
+        event, n_waiters = self._events.get(key, (asyncio.Event(), 0))
+        # registered before fetching, so a publish in between is not missed
+        self._events[key] = (event, n_waiters + 1)
+        try:
+            value = await fetch()
+            if value is not None:
+                return value
+
+            try:
+                await asyncio.wait_for(event.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                # a publish from a worker can still be missed when redis is down
+                pass
+            return await fetch()
+
+        finally:
+            event, n_waiters = self._events[key]
+            if n_waiters <= 1:
+                del self._events[key]
+            else:
+                self._events[key] = (event, n_waiters - 1)
+
+
+readiness = ReadinessBus()
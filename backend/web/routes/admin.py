@@ -0,0 +1,77 @@
+import secrets
+from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
+from typing import Annotated, Literal
+from uuid import UUID
+from ..dependencies import Cache, get_cache
+from ..config import AppSettings, get_settings
+from ..lifecycle import cache_usage, sweeper_stats
+from ..metrics import registry
+from ..tracing import tracer
+from ..audio_store import get_audio_store
+
+admin_route = APIRouter(prefix="/admin")
+# scraped at the conventional path
+metrics_route = APIRouter()
+
+
+async def check_admin_token(
+    settings: Annotated[AppSettings, Depends(get_settings)],
+    token: Annotated[str, Query()] = "",
+):
+    """admin endpoints are disabled unless ADMIN_TOKEN is set"""
+    if not settings.admin_token:
+        raise HTTPException(404, "admin endpoints are disabled, set ADMIN_TOKEN")
+    if not secrets.compare_digest(token.encode(), settings.admin_token.encode()):
+        raise HTTPException(403, "invalid admin token")
+
+
+async def check_metrics_token(
+    settings: Annotated[AppSettings, Depends(get_settings)],
+    authorization: Annotated[str, Header()] = "",
+    token: Annotated[str, Query()] = "",
+):
+    """/metrics is open unless METRICS_TOKEN is set, then `Authorization: Bearer` or `?token=`"""
+    if not settings.metrics_token:
+        return
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() == "bearer":
+        token = credentials.strip()
+    if not secrets.compare_digest(token.encode(), settings.metrics_token.encode()):
+        raise HTTPException(
+            401, "invalid metrics token", headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+@admin_route.get("/cache", dependencies=[Depends(check_admin_token)])
+async def get_cache_usage(
+    cache: Annotated[Cache, Depends(get_cache)],
+    settings: Annotated[AppSettings, Depends(get_settings)],
+):
+    """keys and bytes of every key family"""
+    usage = await cache_usage(cache, max_scan_keys=settings.admin_scan_max_keys)
+    usage["sweeper"] = sweeper_stats()
+    audio_store = get_audio_store()
+    usage["audio_store"] = audio_store.stats() if audio_store is not None else None
+    return usage
+
+
+@metrics_route.get("/metrics", dependencies=[Depends(check_metrics_token)])
+async def get_metrics():
+    """metrics of this worker in prometheus text format"""
+    return Response(
+        content=registry.expose(),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+@admin_route.get("/traces", dependencies=[Depends(check_admin_token)])
+async def get_traces(
+    sess_id: Annotated[UUID | None, Query()] = None,
+    format: Annotated[Literal["json", "chrome"], Query()] = "json",
+    limit: Annotated[int, Query()] = 20,
+):
+    """latest turns traced by this worker, `format=chrome` for chrome://tracing or Perfetto"""
+    traces = tracer.traces(sess_id.hex if sess_id is not None else None, limit=limit)
+    if format == "chrome":
+        return tracer.chrome(traces)
+    return [trace.to_dict() for trace in traces]
@@ -11,11 +11,12 @@ from typing import Annotated
 from ..dependencies import Cache, get_cache, get_chatsession
 from ..config import AppSettings, get_settings
 from ..logger import web_logger
-import jinja2
+from ..scenes import jinja2_env
+from ..usage import usage_meter
+from ..tokens import estimate_message_tokens
 from uuid import UUID
 
 api_route = APIRouter(prefix="/api")
-jinja2_env = jinja2.Environment(loader=jinja2.FileSystemLoader("web/templates"))
 
 
 @api_route.get("/newchat")
@@ -40,6 +41,7 @@ async def new_session(
             if bot.messages:
                 # change already added messages
                 bot.messages[-1].msg = welcome
+                bot.messages[-1].tokens = estimate_message_tokens(welcome)
                 bot.non_cached = 1
             else:
                 # add new welcome messages
@@ -76,4 +78,10 @@ async def continue_chat(
                 if chunk is not None:
                     yield chunk
                     
-        return StreamingResponse(stream_answer(), )
\ No newline at end of file
+        return StreamingResponse(stream_answer(), )
+
+
+@api_route.get("/usage")
+async def get_usage(cache: Annotated[Cache, Depends(get_cache)]):
+    """token usage of all workers, by scope (chat/mood), preset and llm"""
+    return await usage_meter.read(cache)
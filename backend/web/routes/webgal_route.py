@@ -7,7 +7,7 @@ from fastapi import (
     HTTPException,
     Response
 )
-from fastapi.responses import RedirectResponse
+from fastapi.responses import FileResponse, RedirectResponse, StreamingResponse
 from typing import AsyncIterator
 from fastapi.responses import PlainTextResponse
 from typing import Annotated
@@ -16,16 +16,29 @@ from ..models.chat import ChatSession
 from ..models.bot import L2dBotPreset
 from ..config import AppSettings, get_settings
 from ..logger import web_logger
-from ..webgal_utils import TEXT_SPLIT_PUNCTUATIONS, text_split_sentence, remove_parathesis
-from ..tts import tts
-import jinja2
+from ..webgal_utils import TEXT_SPLIT_PUNCTUATIONS, IncrementalSentenceSplitter, remove_parathesis
+from ..tts import tts_jobs, guess_audio_media_type, decode_voice, pending_key
+from ..audio_store import audio_key, audio_media_type, get_audio_store, is_audio_key
+from ..notify import readiness
+from ..lifecycle import key_ttl
+from ..usage import usage_meter
+from ..metrics import (
+    cache_lookups_total,
+    next_pending_total,
+    next_wait_seconds,
+    scene_fetch_delay_seconds,
+)
+from ..tracing import tracer, activate_trace, trace_event
+from ..mood import MoodPipeline, get_mood_classifier, get_mood_memo
+from ..mood_engine import make_local_classify
+from ..scenes import jinja2_env, answer_scene, new_input_scene, pending_scene
 import asyncio
 import hashlib
-import base64
+import random
+import time
 from uuid import UUID
 
 webgal_route = APIRouter(prefix="/webgal")
-jinja2_env = jinja2.Environment(loader=jinja2.FileSystemLoader("web/templates"))
 
 
 @webgal_route.get("/")
@@ -37,23 +50,38 @@ def exit_script():
     return jinja2_env.get_template("error.txt").render()
 
 
-async def bye_script(preset: L2dBotPreset, last_mood: str = "", bye_message:str=""):
-    # random motion/expression based on last_mood
-    motion, expression = preset.random_motion(last_mood).split(":")
-    # if bye message is not given
-    if not bye_message:
-        bye_message = preset.bye_message
-
+def render_bye_script(
+    preset: L2dBotPreset, bye_message: str, motion: str, expression: str, voice: str = ""
+):
     template = jinja2_env.get_template("bye.txt")
-    script = template.render(
+    return template.render(
         msg=bye_message,
         motion=motion,
         expression=expression,
         l2d_path=preset.live2d_model_path,
         speaker=preset.speaker,
+        voice=voice,
     )
 
-    return script
+
+async def bye_script(
+    preset: L2dBotPreset, last_mood: str = "", bye_message: str = "", preset_name: str = ""
+):
+    # if bye message is not given
+    if not bye_message:
+        bye_message = preset.bye_message
+
+    # pre-rendered in warm-up, with voice
+    assets = warm_assets.get(preset_name)
+    warm_scripts = assets.bye_scripts.get(bye_message) if assets is not None else None
+    if warm_scripts:
+        if last_mood not in warm_scripts:
+            last_mood = random.choice(list(warm_scripts.keys()))
+        return random.choice(warm_scripts[last_mood])
+
+    # random motion/expression based on last_mood
+    motion, expression = preset.random_motion(last_mood).split(":")
+    return render_bye_script(preset, bye_message, motion, expression)
 
 
 async def pending_script(
@@ -73,25 +101,120 @@ async def pending_script(
             f"http://{settings.host}:{settings.port}/webgal/next.txt/{sess_id.hex}/{msg_id}?bot={preset_name}"
         )
 
-    template = jinja2_env.get_template("pending.txt")
-    script = template.render(
+    return pending_scene(
         sess_id=sess_id.hex,
+        l2d_path=preset.live2d_model_path,
         motion=motion,
         expression=expression,
-        l2d_path=preset.live2d_model_path,
         next_url=next_jump_url,
     )
 
-    return script
-
 
 def get_voice_cachekey(sess_id: str, msg: str = '', length=12, hash=None):
     if hash is None:
         hash = hashlib.md5(msg.encode()).hexdigest()[:length]
 
+    if hash.startswith(WARM_VOICE_PREFIX):
+        # voices of fixed lines are shared by all sessions
+        sess_id = "shared"
+
     return f"voice:{sess_id}:{hash}"
 
 
+def get_voice_url(settings: AppSettings, sess_id: str, voice_key: str):
+    return f"http://{settings.host}:{settings.port}/webgal/voice.mp3/{sess_id}/{voice_key}"
+
+
+def prepare_voice(
+    settings: AppSettings,
+    preset: L2dBotPreset,
+    preset_name: str,
+    sess_id: UUID,
+    msg: str,
+    cache: Cache = None,
+):
+    """voice URL of a message, synthesis is started in background if it is not warmed up"""
+    assets = warm_assets.get(preset_name)
+    if assets is not None and msg in assets.voices:
+        return get_voice_url(settings, sess_id.hex, assets.voices[msg])
+
+    # （）represent mental activity, so stripped off
+    msg_aloud = remove_parathesis(msg, replace='……')
+    if preset.voice is None or not msg_aloud:
+        # nothing to say aloud
+        return ""
+
+    audio_store = get_audio_store()
+    if audio_store is not None:
+        # the same line is synthesized once for every session
+        voice_key = audio_key(msg_aloud, preset.voice)
+        # a stored voice is looked up by the job, off the event loop
+        tts_jobs.submit(voice_key, msg_aloud, preset.voice, cache, audio_store)
+        return get_voice_url(settings, sess_id.hex, voice_key)
+
+    voice_cachekey = get_voice_cachekey(msg=msg, sess_id=sess_id.hex)
+    # tts runs in background, the scene is published without waiting for the voice
+    tts_jobs.submit(voice_cachekey, msg_aloud, preset.voice, cache)
+
+    return get_voice_url(settings, sess_id.hex, voice_cachekey.split(':', maxsplit=2)[2])
+
+
+def render_scene(
+    settings: AppSettings,
+    preset: L2dBotPreset,
+    preset_name: str,
+    sess_id: str,
+    msg_id: int,
+    msg_motion_expression_list: list[tuple[str, str, str, str]],
+    listening: list[str],
+    require_input=False,
+):
+    """render (msg, motion, expression, voice) tuples to a webgal script"""
+    if require_input:
+        next_endpoint = "chat.txt"
+    else:
+        next_endpoint = "next.txt"
+
+    next_jump_url = f"http://{settings.host}:{settings.port}/webgal/{next_endpoint}/{sess_id}/{msg_id + 1}?bot={preset_name}"
+
+    if require_input:
+        return new_input_scene(
+            sess_id=sess_id,
+            bg_pic=preset.bg_picture_path,
+            l2d_path=preset.live2d_model_path,
+            speaker=preset.speaker,
+            lines=msg_motion_expression_list,
+            listening=listening,
+            next_url=next_jump_url,
+        )
+    else:
+        return answer_scene(
+            sess_id=sess_id,
+            bg_pic=preset.bg_picture_path,
+            l2d_path=preset.live2d_model_path,
+            speaker=preset.speaker,
+            lines=msg_motion_expression_list,
+            next_url=next_jump_url,
+        )
+
+
+async def publish_scene(
+    cache: Cache, sess_id: UUID, msg_id: int, script: str, last_mood: str
+):
+    """cache the scene so that next.txt can fetch it"""
+    result_to_cache = {
+        "script": script,
+        "last_mood": last_mood,
+        # wall clock, fetched by next.txt of any worker
+        "published_at": time.time(),
+    }
+    cache_key = f"msgmood:{sess_id.hex}:{msg_id}"
+    web_logger.debug(f"caching message chunk to {cache_key}")
+    await cache.set(cache_key, result_to_cache, ttl=key_ttl(cache_key))
+    await readiness.publish(cache_key)
+    trace_event("scene.published", "scene", msg_id=msg_id)
+
+
 async def msg_mood_to_script(
     settings: Annotated[AppSettings, Depends(get_settings)],
     sess_id: UUID,
@@ -105,92 +228,184 @@ async def msg_mood_to_script(
     preset = settings.bot_preset.get(preset_name)
 
     # choose motion/expression set
-    msg_list = []
-    motion_list = []
-    expression_list = []
-    voice_list = []
+    msg_motion_expression_list = []
     for msg, mood in msg_mood_list:
-        msg_list.append(msg)
         motion, expression = preset.random_motion(mood).split(":")
-        motion_list.append(motion)
-        expression_list.append(expression)
-
-        # we put tts while processing every sentences (normally there would be only one)
-        # （）represent mental activity, so stripped off
-        msg_aloud = remove_parathesis(msg, replace='……')
-        if msg_aloud:
-            voice_content = await tts(msg_aloud, preset.voice)
-        else:
-            # won't get voice for empty message
-            voice_content = None
-
-        # TODO make a null sound
-        voice_cachekey = get_voice_cachekey(msg=msg, sess_id=sess_id.hex)
-        if voice_content and (cache is not None):
-            await cache.set(voice_cachekey, base64.a85encode(voice_content).decode())
-            web_logger.debug(f"tts cached: {voice_cachekey}")
-
-        voice_url = f"http://{settings.host}:{settings.port}/webgal/voice.mp3/{sess_id.hex}/{voice_cachekey.split(':', maxsplit=2)[2]}"
-        voice_list.append(voice_url)
-
-    if require_input:
-        this_template = "new_input.txt"
-        next_endpoint = "chat.txt"
-    else:
-        this_template = "answer.txt"
-        next_endpoint = "next.txt"
-
-    next_jump_url = f"http://{settings.host}:{settings.port}/webgal/{next_endpoint}/{sess_id.hex}/{msg_id + 1}?bot={preset_name}"
+        voice_url = prepare_voice(settings, preset, preset_name, sess_id, msg, cache)
+        msg_motion_expression_list.append((msg, motion, expression, voice_url))
 
     # listening is a pending action when waiting for
     listening = preset.random_motion("listening").split(":")
 
-    template = jinja2_env.get_template(this_template)
-    script = template.render(
-        sess_id=sess_id.hex,
-        msg_motion_expression_list=zip(msg_list, motion_list, expression_list, voice_list),
-        l2d_path=preset.live2d_model_path,
-        speaker=preset.speaker,
-        next_url=next_jump_url,
-        listening=listening,
-        bg_pic=preset.bg_picture_path,
+    script = render_scene(
+        settings,
+        preset,
+        preset_name,
+        sess_id.hex,
+        msg_id,
+        msg_motion_expression_list,
+        listening,
+        require_input=require_input,
     )
 
     web_logger.debug(f"generate {sess_id}/{msg_id}:\n{script}")
     if cache is not None:
         # we should cache the results
         # NOTE: if this message has no messages (unlikely), fallback to listening
-        result_to_cache = {
-            "script": script,
-            "last_mood": msg_mood_list[-1][1]
-            if len(msg_mood_list) > 0
-            else "listening",
-        }
-        cache_key = f"msgmood:{sess_id.hex}:{msg_id}"
-        web_logger.debug(f"caching message chunk to {cache_key}")
-        await cache.set(cache_key, result_to_cache)
+        await publish_scene(
+            cache,
+            sess_id,
+            msg_id,
+            script,
+            last_mood=msg_mood_list[-1][1] if len(msg_mood_list) > 0 else "listening",
+        )
 
     return script
 
 
-async def get_mood_for_sentence(
-    mood_bot: ChatSession, prompt: str, settings: AppSettings
+class PresetWarmAssets:
+    """pre-rendered scenes and voices of fixed lines of a preset"""
+
+    def __init__(self) -> None:
+        # msg -> shared voice key
+        self.voices: dict[str, str] = {}
+        # welcome scenes of every motion choices, with SESS_ID_PLACEHOLDER
+        self.welcome_scripts: list[str] = []
+        # bye message -> mood -> scenes of every motion choices
+        self.bye_scripts: dict[str, dict[str, list[str]]] = {}
+
+    def welcome_script(self, sess_id: UUID):
+        return random.choice(self.welcome_scripts).replace(
+            SESS_ID_PLACEHOLDER, sess_id.hex
+        )
+
+
+# voice keys of fixed lines, md5 hex never starts with it
+WARM_VOICE_PREFIX = "w"
+# stamped by session id of new sessions
+SESS_ID_PLACEHOLDER = "__sess_id__"
+# preset_name -> assets, filled by `warmup_presets`
+warm_assets: dict[str, PresetWarmAssets] = {}
+
+
+async def warmup_voice(
+    settings: AppSettings, preset: L2dBotPreset, preset_name: str, msg: str, cache: Cache
 ):
-    """get mood for a single sentence, nothing else"""
-    mood_gen = (
-        await mood_bot.get_answer_a(
-            settings=settings, prompt=prompt, preset_name="mood_analyzer"
+    """synthesize a fixed line into the shared voice key, return the key or None if failed"""
+    audio_store = get_audio_store()
+    if audio_store is not None:
+        msg_aloud = remove_parathesis(msg, replace='……')
+        voice_key = audio_key(msg_aloud, preset.voice)
+        audio_store.pin(voice_key)
+        if await audio_store.get(voice_key):
+            return voice_key
+        tts_jobs.submit(voice_key, msg_aloud, preset.voice, cache, audio_store)
+        voice_content = await tts_jobs.wait(voice_key, timeout=settings.warmup_timeout)
+        return voice_key if voice_content else None
+
+    voice_key = (
+        WARM_VOICE_PREFIX + hashlib.md5(f"{preset_name}|{msg}".encode()).hexdigest()[:12]
+    )
+    cache_key = get_voice_cachekey(sess_id="", hash=voice_key)
+    if await cache.get(cache_key, None):
+        # kept by cache from last start
+        return voice_key
+
+    tts_jobs.submit(cache_key, remove_parathesis(msg, replace='……'), preset.voice, cache)
+    voice_content = await tts_jobs.wait(cache_key, timeout=settings.warmup_timeout)
+    return voice_key if voice_content else None
+
+
+async def warmup_preset(
+    settings: AppSettings, preset: L2dBotPreset, preset_name: str, cache: Cache
+):
+    assets = PresetWarmAssets()
+    fixed_lines = [
+        msg
+        for msg in (preset.welcome_message, preset.bye_message, preset.hangup_message)
+        if msg
+    ]
+    if preset.voice is not None:
+        voice_keys = await asyncio.gather(
+            *[
+                warmup_voice(settings, preset, preset_name, msg, cache)
+                for msg in fixed_lines
+            ]
         )
-    )()
-    mood = ""
-    async for mood_chunk in mood_gen:
-        if mood_chunk is not None:
-            mood += mood_chunk
-        else:
-            break
+        assets.voices = {
+            msg: voice_key
+            for msg, voice_key in zip(fixed_lines, voice_keys)
+            if voice_key is not None
+        }
+
+    # voice of fixed lines don't depend on session
+    shared_sess_id = UUID(int=0)
+    # without a warm voice, welcome is rendered per session to synthesize its voice
+    if preset.welcome_message in assets.voices:
+        voice_url = get_voice_url(
+            settings, shared_sess_id.hex, assets.voices[preset.welcome_message]
+        )
+        for motion_expression in preset.mood.get("高兴", []):
+            motion, expression = motion_expression.split(":")
+            for listening in preset.mood.get("listening", []):
+                assets.welcome_scripts.append(
+                    render_scene(
+                        settings,
+                        preset,
+                        preset_name,
+                        SESS_ID_PLACEHOLDER,
+                        0,
+                        [(preset.welcome_message, motion, expression, voice_url)],
+                        listening.split(":"),
+                        require_input=True,
+                    )
+                )
+
+    for msg in (preset.bye_message, preset.hangup_message):
+        if not msg:
+            continue
+        voice_url = (
+            get_voice_url(settings, shared_sess_id.hex, assets.voices[msg])
+            if msg in assets.voices
+            else ""
+        )
+        assets.bye_scripts[msg] = {
+            mood: [
+                render_bye_script(preset, msg, *motion_expression.split(":"), voice=voice_url)
+                for motion_expression in motion_expressions
+            ]
+            for mood, motion_expressions in preset.mood.items()
+        }
+
+    return assets
+
+
+async def warmup_presets(settings: AppSettings, cache: Cache):
+    """pre-render fixed scenes and synthesize fixed lines of all L2D presets"""
+    start = time.perf_counter()
+    for preset_name, preset in settings.bot_preset.items():
+        if not isinstance(preset, L2dBotPreset) or not preset.warmup:
+            continue
 
-    web_logger.debug(f"mood query: {prompt}|{mood}|")
-    return mood
+        preset_start = time.perf_counter()
+        try:
+            warm_assets[preset_name] = await warmup_preset(
+                settings, preset, preset_name, cache
+            )
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as err:
+            web_logger.warning(f"warm-up of {preset_name} failed: {err}", exc_info=True)
+            continue
+
+        assets = warm_assets[preset_name]
+        web_logger.info(
+            f"warm-up of {preset_name}: {len(assets.voices)} voices, "
+            f"{len(assets.welcome_scripts) + sum(len(v) for b in assets.bye_scripts.values() for v in b.values())} scenes "
+            f"in {time.perf_counter() - preset_start:.3f}s"
+        )
+
+    web_logger.info(f"warm-up finished in {time.perf_counter() - start:.3f}s")
 
 
 async def task_get_chat_response_and_mood(
@@ -199,89 +414,139 @@ async def task_get_chat_response_and_mood(
     cache: Cache,
     msg_id: int,
     sess_id: UUID,
+    preset_name: str = "sakiko",
 ):
-    """ """
-    # create a mood bot, we don't cache it
-    async with get_chatsession(
-        create=True,
-        save=False,
-        preset_name="mood_analyzer",
-        settings=settings,
-        cache=cache,
-    ) as mood_bot:
-        remn_text = ""
-        async for chunk in resp_gen:
-            if chunk is None:
-                # we reach the end of this generator
-                break
-            elif len(chunk) == 0:
-                # we don't process empty strings
-                continue
+    """split the streamed answer into sentences, analyze their moods and publish scenes
 
-            remn_text += chunk
-            
-            if len(remn_text) < 20:
-                # only process long sentences
-                # remnant text would be treated as a single sentence
-                continue
+    mood of sentence k is analyzed while the stream goes on, scenes are still published in order
+    """
+    # moods and TTS jobs started below are traced too
+    activate_trace(tracer.get(sess_id.hex, msg_id))
+    preset = settings.bot_preset.get(preset_name)
+    # stateless classifier, only the sentence itself is sent
+    mood_classifier = get_mood_classifier()
+
+    async def fallback_classify(sent: str):
+        # this is a fallback for missing mood analyzer
+        return ""
+
+    mood_pipeline = MoodPipeline(
+        mood_classifier.classify if mood_classifier.available else fallback_classify,
+        concurrency=settings.mood_concurrency,
+        classify_batch=mood_classifier.classify_batch
+        if mood_classifier.batch_available
+        else None,
+        batch_size=settings.mood_batch_size,
+        batch_wait=settings.mood_batch_wait,
+        # sentences with obvious mood are answered in-process
+        local_classify=make_local_classify(
+            tier=preset.mood_tier,
+            threshold=preset.mood_threshold,
+            engine=preset.mood_engine,
+        ),
+        # repeated lines across sessions skip the analyzer
+        memo=get_mood_memo(cache, mood_classifier)
+        if settings.mood_cache_ttl > 0
+        else None,
+        batch_memo=get_mood_memo(cache, mood_classifier, batch=True)
+        if settings.mood_cache_ttl > 0 and mood_classifier.batch_available
+        else None,
+    )
 
-            # we can always check if we have to split
-            sentences = text_split_sentence(remn_text)
-            for sent in sentences[:-1]:
-                # sometimes there are empty sentence, we don't process them
-                if not sent.strip():
-                    continue
-
-                # each sent is a complete sentence
-                # here we block the mood analyzer (since this is threaded background)
-                if mood_bot is not None:
-                    mood = await get_mood_for_sentence(
-                        prompt=sent, settings=settings, mood_bot=mood_bot
+    async def publish_scenes():
+        """sentences ready together are published as one multi-line scene, msg_id advances per scene"""
+        nonlocal msg_id
+        loop = asyncio.get_running_loop()
+        results = mood_pipeline.results()
+        next_result: asyncio.Future | None = None
+        first_scene = True
+        final = False
+        try:
+            while not final:
+                try:
+                    sent, mood, final = await (next_result or anext(results))
+                except StopAsyncIteration:
+                    break
+                next_result = None
+                scene = [(sent, mood)]
+                # first scene goes out at once, so slow models keep their first sentence latency
+                deadline = loop.time() + (0 if first_scene else settings.scene_coalesce_window)
+                cache_key = f"msgmood:{sess_id.hex}:{msg_id}"
+                while not final and len(scene) < settings.scene_max_lines:
+                    # only take ready sentences if the client is waiting for this scene
+                    timeout = (
+                        0
+                        if readiness.has_waiter(cache_key)
+                        else max(0, deadline - loop.time())
                     )
-
-                else:
-                    # this is a fallback for bot returning invalid mood
-                    mood = ""
-
-                web_logger.debug(f"mood analyze: {sent}|{mood}|")
-                # now we have a set of sent, mood for next round, send them to next
-                # TODO now send to cache every sentence, should we batch it?
+                    next_result = next_result or asyncio.ensure_future(anext(results))
+                    done, _ = await asyncio.wait({next_result}, timeout=timeout)
+                    if not done:
+                        break
+                    finished, next_result = next_result, None
+                    try:
+                        sent, mood, final = finished.result()
+                    except StopAsyncIteration:
+                        break
+                    scene.append((sent, mood))
+
+                web_logger.debug(f"mood analyze: {scene}")
+                # the last one should always return a require_input=True
                 await msg_mood_to_script(
                     settings=settings,
                     sess_id=sess_id,
-                    msg_mood_list=[(sent, mood)],
+                    msg_mood_list=[(sent, mood) for sent, mood in scene if sent],
                     msg_id=msg_id,
-                    require_input=False,
+                    preset_name=preset_name,
+                    require_input=final,
                     cache=cache,
                 )
                 msg_id += 1
+                first_scene = False
+        finally:
+            # cancelled halfway
+            if next_result is not None:
+                next_result.cancel()
+
+    publisher = asyncio.create_task(publish_scenes())
+    try:
+        # only newly arrived text is scanned, finished sentences come out immediately
+        splitter = IncrementalSentenceSplitter()
+        async for chunk in resp_gen:
+            if chunk is None:
+                # we reach the end of this generator
+                break
+            elif len(chunk) == 0:
+                # we don't process empty strings
+                continue
 
-            # last sentence might be not complete
-            remn_text = sentences[-1]
+            for sent in splitter.feed(chunk):
+                # sometimes there are empty sentence, we don't process them
+                if sent.strip():
+                    trace_event("sentence", "split", chars=len(sent))
+                    mood_pipeline.submit(sent)
+
+        # last sentence might be not complete
+        sentences = splitter.flush()
+        for sent in sentences[:-1]:
+            if sent.strip():
+                trace_event("sentence", "split", chars=len(sent))
+                mood_pipeline.submit(sent)
 
         # now remn text might still be non empty
-        if remn_text:
-            if mood_bot is not None:
-                mood = await get_mood_for_sentence(
-                    prompt=remn_text, settings=settings, mood_bot=mood_bot
-                )
-            else:
-                # this is a fallback for bot returning invalid mood
-                mood = ""
-        else:
-            mood = ""
+        remn_text = sentences[-1] if sentences else ""
+        trace_event("sentence", "split", chars=len(remn_text), final=True)
+        mood_pipeline.submit(remn_text, final=True)
 
-        final_msg_mood_list = [(remn_text, mood)] if remn_text else []
-        # but we should always return a require_input=True
-        await msg_mood_to_script(
-            settings=settings,
-            sess_id=sess_id,
-            msg_mood_list=final_msg_mood_list,
-            msg_id=msg_id,
-            require_input=True,
-            cache=cache,
-        )
-        msg_id += 1
+    except BaseException:
+        publisher.cancel()
+        mood_pipeline.cancel()
+        raise
+
+    finally:
+        mood_pipeline.close()
+
+    await publisher
 
 
 @webgal_route.get("/newchat.txt", response_class=PlainTextResponse)
@@ -300,15 +565,21 @@ async def new_session(
     preset = settings.bot_preset.get(preset_name)
     web_logger.debug(f"request new bot, preset={preset_name}")
     #
-    resp = await msg_mood_to_script(
-        settings=settings,
-        sess_id=bot.meta.id,
-        msg_mood_list=[(preset.welcome_message, '高兴')],
-        msg_id=0,
-        cache=cache,
-        preset_name=preset_name,
-        require_input=True,
-    )
+    assets = warm_assets.get(preset_name)
+    if assets is not None and assets.welcome_scripts:
+        # pre-rendered, only session id is stamped in
+        resp = assets.welcome_script(bot.meta.id)
+        await publish_scene(cache, bot.meta.id, 0, resp, last_mood='高兴')
+    else:
+        resp = await msg_mood_to_script(
+            settings=settings,
+            sess_id=bot.meta.id,
+            msg_mood_list=[(preset.welcome_message, '高兴')],
+            msg_id=0,
+            cache=cache,
+            preset_name=preset_name,
+            require_input=True,
+        )
 
     return resp
 
@@ -329,15 +600,29 @@ async def continue_content(
     """
     preset = settings.bot_preset.get(preset_name)
     cache_key = f"msgmood:{sess_id.hex}:{msg_id}"
-    for _ in range(5):
-        result_from_cache = await cache.get(cache_key, None)
-        if result_from_cache is not None:
-            break
-        await asyncio.sleep(0.5)
-    else:
+    # long-poll, returned as soon as the scene is published
+    wait_started = time.perf_counter()
+    result_from_cache = await readiness.wait(
+        cache_key,
+        lambda: cache.get(cache_key, None),
+        timeout=settings.next_wait_timeout,
+    )
+    waited = time.perf_counter() - wait_started
+    next_wait_seconds.observe(waited)
+    trace = tracer.latest(sess_id.hex)
+    if trace is not None and msg_id >= trace.msg_id:
+        trace.event(
+            "scene.fetched" if result_from_cache is not None else "scene.pending",
+            "client",
+            dur=waited,
+            msg_id=msg_id,
+        )
+    if result_from_cache is None:
+        cache_lookups_total.inc("scene", "miss")
         if pending_counter < 10:
             # return a pending script rather than exit if answer is not ready
             web_logger.debug(f"req next.txt: {cache_key} not hit")
+            next_pending_total.inc()
             next_jump_url = (
                 f"http://{settings.host}:{settings.port}/webgal/next.txt/{sess_id.hex}/{msg_id}?bot={preset_name}&n={pending_counter + 1}"
             )
@@ -352,9 +637,14 @@ async def continue_content(
             )
         else:
             # fail to hit cache too many times, backend might be down
-            return await bye_script(preset=preset, last_mood=last_mood, bye_message="看来您那里信号很不好呢，我这边先挂了，祝您生活愉快。")
+            return await bye_script(preset=preset, last_mood=last_mood, bye_message=preset.hangup_message, preset_name=preset_name)
 
     web_logger.debug(f"get a cache result of {sess_id}/{msg_id}")
+    cache_lookups_total.inc("scene", "hit")
+    if "published_at" in result_from_cache:
+        scene_fetch_delay_seconds.observe(
+            max(0.0, time.time() - result_from_cache["published_at"])
+        )
 
     return result_from_cache.get("script")
 
@@ -386,7 +676,7 @@ async def chat_llm(
     elif prompt == "再见":
         # byebye sakiko
         web_logger.debug(f"before bye script: {last_mood = }")
-        return await bye_script(preset=preset, last_mood=last_mood)
+        return await bye_script(preset=preset, last_mood=last_mood, preset_name=preset_name)
 
     elif prompt == "{prompt}" or pending != '1':
         # NOTE: this branch only occur in WebGAL prefetching without templates
@@ -396,6 +686,8 @@ async def chat_llm(
         web_logger.debug(f"prefetching on newchat: {sess_id}/{msg_id}")
         return exit_script()
 
+    activate_trace(tracer.begin(sess_id.hex, msg_id, preset_name))
+    trace_event("chat.txt", "request", prompt_chars=len(prompt))
     resp_gen = (
         await bot.get_answer_a(
             settings=settings,
@@ -411,6 +703,7 @@ async def chat_llm(
         cache=cache,
         msg_id=msg_id,
         sess_id=sess_id,
+        preset_name=preset_name,
     )
 
     redirect_url = f"/webgal/next.txt/{sess_id.hex}/{msg_id}?bot={preset_name}&first_answer=1"
@@ -424,21 +717,75 @@ async def get_voice_file(
     cache: Annotated[Cache, Depends(get_cache)],
 ):
     """
+    voice is synthesized in background after the scene is published,
+    so follow the in-flight synthesis (streaming) or wait for it if not ready
     """
-    # since we put voice in cache before we respond scripts, we won't wait for voice to be available
-    cache_key = get_voice_cachekey(hash=voice_key, sess_id=sess_id.hex)
-    result_from_cache = await cache.get(cache_key, None)
-    if result_from_cache is not None:
+    audio_store = get_audio_store()
+    # content addressed voices are on disk, the key of their job
+    stored = audio_store is not None and is_audio_key(voice_key)
+    cache_key = voice_key if stored else get_voice_cachekey(hash=voice_key, sess_id=sess_id.hex)
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    deadline = started + settings.tts_wait_timeout
+    trace = tracer.latest(sess_id.hex)
+
+    def trace_fetch(source: str):
+        if trace is not None:
+            trace.event("voice.fetched", "client", dur=loop.time() - started, source=source)
+
+    while True:
+        job = tts_jobs.get(cache_key)
+        if job is not None:
+            # in-flight job of this process, audio is streamed as it is synthesized
+            await job.wait_update(0, timeout=max(0, deadline - loop.time()))
+            if job.chunks:
+                web_logger.debug(f"tts job hit: {cache_key}")
+                cache_lookups_total.inc("voice", "job")
+                trace_fetch("job")
+                return StreamingResponse(
+                    job.iter_chunks(timeout=settings.tts_wait_timeout),
+                    media_type=job.media_type,
+                )
+
+        if stored:
+            result_from_cache = await audio_store.get(voice_key)
+        else:
+            result_from_cache = await cache.get(cache_key, None)
+        if result_from_cache is not None or loop.time() >= deadline:
+            break
+        if not await cache.exists(pending_key(cache_key)):
+            # not being synthesized anywhere (expired, from before a restart or mistyped)
+            break
+        # synthesized by another worker
+        await asyncio.sleep(settings.tts_poll_interval)
+
+    # empty string marks a voice that can't be synthesized
+    if stored and result_from_cache:
+        web_logger.debug(f"tts disk hit: {cache_key}")
+        cache_lookups_total.inc("voice", "hit")
+        trace_fetch("disk")
+        # sent from the file, Range requests included
+        return FileResponse(
+            result_from_cache,
+            media_type=audio_media_type(voice_key),
+            headers={"Cache-Control": "public, max-age=31536000, immutable"},
+        )
+    elif result_from_cache:
         web_logger.debug(f"tts cache hit: {cache_key}")
-        return Response(content=base64.a85decode(result_from_cache.encode()), media_type="audio/mpeg")
+        cache_lookups_total.inc("voice", "hit")
+        trace_fetch("cache")
+        voice_content = decode_voice(result_from_cache)
+        return Response(content=voice_content, media_type=guess_audio_media_type(voice_content))
     else:
         web_logger.debug(f"tts fail to hit: {cache_key}")
+        cache_lookups_total.inc("voice", "miss")
+        trace_fetch("miss")
         raise HTTPException(404, f"voice {cache_key} not found")
-    
+
 
 @webgal_route.get("/readme.txt")
 async def readme(cache: Annotated[Cache, Depends(get_cache)]):
-    total_token = await cache.get("total_token", 0)
+    total_token = (await usage_meter.read(cache))["total_token"]
 
     template = jinja2_env.get_template("readme.txt")
     script = template.render(
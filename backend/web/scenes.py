@@ -0,0 +1,103 @@
+"""WebGAL scene scripts
+
+All templates are loaded from one shared jinja2 environment with a bytecode cache, templates are
+only checked for changes in debug mode.
+
+The hot scenes (`answer.txt`, `new_input.txt`, `pending.txt`) are built directly by the functions
+below, their outputs are identical to rendering the templates (see `tests/test_scenes.py`).
+Edit both when changing these scenes.
+"""
+
+import os
+from typing import Sequence
+import jinja2
+from .config import get_settings
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+
+# chars of a text line in WebGAL, longer sentences are split into lines
+LINE_LENGTH = 72
+
+# (sentence, motion, expression, voice url)
+SceneLine = tuple[str, str, str, str]
+
+
+def create_jinja2_env(debug: bool = False) -> jinja2.Environment:
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=jinja2.FileSystemBytecodeCache(),
+        # stat template files on every `get_template` only when debugging
+        auto_reload=debug,
+    )
+
+
+jinja2_env = create_jinja2_env(get_settings().debug)
+
+
+def _figure(l2d_path: str, motion: str, expression: str, animation=True):
+    return (
+        f"changeFigure:{l2d_path}{' -animationFlag=on' if animation else ''} "
+        f'-transform={{"position":{{"y":-250}}}} '
+        f"-motion={motion or 'thinking01'} -expression={expression or 'thinking02'}"
+    )
+
+
+def _answer_body(
+    sess_id: str, bg_pic: str, l2d_path: str, speaker: str, lines: Sequence[SceneLine]
+) -> list[str]:
+    parts = [
+        f"setVar:sess={sess_id}\nsetVar:prompt=\nsetVar:pending=0\nchangeBg:{bg_pic} -next\n"
+    ]
+    for sent, motion, expression, voice in lines:
+        parts.append(
+            f"\n{_figure(l2d_path, motion, expression)} -next;\nplayEffect:{voice} -next;\n;    "
+        )
+        for i in range(0, len(sent), LINE_LENGTH):
+            parts.append(f"\n{speaker}:{sent[i:i + LINE_LENGTH]} -center\n;    ")
+        parts.append("\n")
+    parts.append("\n;")
+    return parts
+
+
+def answer_scene(
+    sess_id: str,
+    bg_pic: str,
+    l2d_path: str,
+    speaker: str,
+    lines: Sequence[SceneLine],
+    next_url: str,
+) -> str:
+    """same as `answer.txt`: say lines and jump to next_url"""
+    parts = _answer_body(sess_id, bg_pic, l2d_path, speaker, lines)
+    parts.append(f"\nchangeScene:{next_url} -next\n;")
+    return "".join(parts)
+
+
+def new_input_scene(
+    sess_id: str,
+    bg_pic: str,
+    l2d_path: str,
+    speaker: str,
+    lines: Sequence[SceneLine],
+    listening: Sequence[str],
+    next_url: str,
+) -> str:
+    """same as `new_input.txt`: say lines, then ask for user input and send it to next_url"""
+    parts = _answer_body(sess_id, bg_pic, l2d_path, speaker, lines)
+    parts.append(
+        "\ngetUserInput:prompt -title=🔊🔊🔊 -buttonText=📞\nsetVar:pending=1\n"
+        f"{_figure(l2d_path, listening[0], listening[1], animation=False)} -next\n"
+        f":{{prompt}} -next\nchangeScene:{next_url}&p={{prompt}}&pending={{pending}} -next\n;"
+    )
+    return "".join(parts)
+
+
+def pending_scene(
+    sess_id: str, l2d_path: str, motion: str, expression: str, next_url: str
+) -> str:
+    """same as `pending.txt`: a figure while waiting, then fetch next_url again"""
+    return (
+        f"setVar:sess={sess_id}\nsetVar:prompt=\nsetVar:pending=0\nsetVar:rand=random()\n"
+        f"{_figure(l2d_path, motion, expression)}\n"
+        f"changeScene:{next_url}&rand={{rand}} -next"
+    )
@@ -0,0 +1,313 @@
+"""Storage layout of chat sessions
+
+- `RedisSessionStore`: meta in hash `sess:{id}`, history in list `sess:{id}:history`
+  (RPUSH new messages, LTRIM to `max_memory`). A load or a save is one pipelined round trip.
+- `CacheSessionStore`: the same layout on plain aiocache values, for `SimpleMemoryCache`
+
+Saves are buffered by `SessionWriteBuffer` and merged per session within a short window. Saves
+of a session with a turn in progress are held until the turn's flush, so the saves of a turn
+become one write. The buffer is flushed at the end of a turn, before loading a session and at
+shutdown.
+
+Live sessions are kept in `SessionL1Cache` and revalidated by the version stamp in the meta.
+
+Sessions saved by older versions (`session:{id}` + `history:{id}:{i}`) are migrated on load,
+see `ChatSession.load_from_redis_cache`.
+"""
+
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+from aiocache import Cache, RedisCache
+from .config import get_settings
+from .lifecycle import key_ttl
+from .metrics import registry, cache_lookups_total
+from .logger import model_logger
+
+
+def meta_key(sess_id: str):
+    return f"sess:{sess_id}"
+
+
+def history_key(sess_id: str):
+    return f"sess:{sess_id}:history"
+
+
+# field of the meta hash, incremented by every write of the session
+VERSION_FIELD = "_version"
+
+
+class RedisSessionStore:
+    def __init__(self, client) -> None:
+        # redis.asyncio client of the RedisCache
+        self.client = client
+
+    async def load(self, sess_id: str) -> tuple[dict, list[bytes], int] | None:
+        """(meta, message records, version), None if not found"""
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(meta_key(sess_id))
+            pipe.lrange(history_key(sess_id), 0, -1)
+            meta, history = await pipe.execute()
+
+        if not meta:
+            return None
+
+        meta = {k.decode(): json.loads(v) for k, v in meta.items()}
+        return (
+            meta,
+            # message records, or JSON of older versions
+            list(history),
+            meta.pop(VERSION_FIELD, 0),
+        )
+
+    async def version(self, sess_id: str) -> int | None:
+        version = await self.client.hget(meta_key(sess_id), VERSION_FIELD)
+        return int(version) if version is not None else None
+
+    async def save(
+        self, sess_id: str, meta: dict | None, new_messages: list[str], max_memory: int
+    ) -> int:
+        """meta is None if unchanged, returns the new version"""
+        async with self.client.pipeline(transaction=True) as pipe:
+            if meta is not None:
+                pipe.hset(
+                    meta_key(sess_id),
+                    mapping={
+                        k: json.dumps(v, ensure_ascii=False) for k, v in meta.items()
+                    },
+                )
+            if new_messages:
+                pipe.rpush(history_key(sess_id), *new_messages)
+                if max_memory > 0:
+                    pipe.ltrim(history_key(sess_id), -max_memory, -1)
+            pipe.hincrby(meta_key(sess_id), VERSION_FIELD, 1)
+            ttl = key_ttl(meta_key(sess_id))
+            if ttl is not None:
+                # idle sessions expire
+                pipe.expire(meta_key(sess_id), ttl)
+                pipe.expire(history_key(sess_id), ttl)
+                results = await pipe.execute()
+                return results[-3]
+
+            results = await pipe.execute()
+
+        return results[-1]
+
+
+class CacheSessionStore:
+    def __init__(self, cache: Cache) -> None:
+        self.cache = cache
+
+    async def load(self, sess_id: str) -> tuple[dict, list[str], int] | None:
+        meta = await self.cache.get(meta_key(sess_id))
+        if meta is None:
+            return None
+
+        # not to modify the stored one (SimpleMemoryCache without serializer)
+        meta = dict(meta)
+        version = meta.pop(VERSION_FIELD, 0)
+        return meta, await self.cache.get(history_key(sess_id), []), version
+
+    async def version(self, sess_id: str) -> int | None:
+        meta = await self.cache.get(meta_key(sess_id))
+        return meta.get(VERSION_FIELD, 0) if meta is not None else None
+
+    async def save(
+        self, sess_id: str, meta: dict | None, new_messages: list[str], max_memory: int
+    ) -> int:
+        """meta is None if unchanged, returns the new version"""
+        # not atomic, only for a single process
+        stored_meta = await self.cache.get(meta_key(sess_id), {})
+        version = stored_meta.get(VERSION_FIELD, 0) + 1
+        # history is rewritten even if unchanged, to renew its TTL with meta
+        history = await self.cache.get(history_key(sess_id), [])
+        history.extend(new_messages)
+        if max_memory > 0:
+            history = history[-max_memory:]
+
+        await self.cache.multi_set(
+            [
+                (meta_key(sess_id), dict(meta or stored_meta, **{VERSION_FIELD: version})),
+                (history_key(sess_id), history),
+            ],
+            ttl=key_ttl(meta_key(sess_id)),
+        )
+        return version
+
+
+def get_session_store(cache: Cache) -> RedisSessionStore | CacheSessionStore:
+    """store of the cache, redis native layout if cache is redis"""
+    if isinstance(cache, RedisCache):
+        return RedisSessionStore(cache.client)
+    return CacheSessionStore(cache)
+
+
+class SessionWriteBuffer:
+    """write-behind buffer of session saves, saves of a session within `window` seconds are merged"""
+
+    def __init__(self, window: float = 1.0, max_hold: float = 60.0) -> None:
+        self.window = window
+        # sess_id -> monotonic time a turn started, saves wait for its flush (up to max_hold)
+        self._held: dict[str, float] = {}
+        self.max_hold = max_hold
+        # sess_id -> [store, latest meta or None, new messages, max_memory, on_written]
+        self._pending: dict[str, list] = {}
+        self._timers: dict[str, asyncio.Task] = {}
+        self._writing: dict[str, asyncio.Future] = {}
+        # saves requested, merged into a pending one, skipped for nothing changed; writes done
+        self.counters = {"saves": 0, "merged": 0, "skipped": 0, "writes": 0}
+
+    def stats(self):
+        return dict(self.counters, pending=len(self._pending))
+
+    def hold(self, sess_id: str):
+        """a turn of the session started, its saves are written by the flush at the end"""
+        self._held[sess_id] = time.monotonic()
+
+    def release(self, sess_id: str):
+        """the turn ended without a flush (failed), pending saves are written after the window"""
+        self._held.pop(sess_id, None)
+
+    async def save(
+        self,
+        store: RedisSessionStore | CacheSessionStore,
+        sess_id: str,
+        meta: dict | None,
+        new_messages: list[str],
+        max_memory: int,
+        on_written: Callable[[int], None] = None,
+    ):
+        """on_written is called with the new version after the (merged) write"""
+        self.counters["saves"] += 1
+        if meta is None and not new_messages:
+            self.counters["skipped"] += 1
+            return
+
+        pending = self._pending.get(sess_id)
+        if pending is not None:
+            self.counters["merged"] += 1
+            pending[0] = store
+            pending[1] = meta if meta is not None else pending[1]
+            pending[2].extend(new_messages)
+            pending[3] = max_memory
+            pending[4] = on_written or pending[4]
+        else:
+            self._pending[sess_id] = [store, meta, list(new_messages), max_memory, on_written]
+
+        if self.window <= 0:
+            await self.flush(sess_id)
+        elif sess_id not in self._timers:
+            self._timers[sess_id] = asyncio.create_task(self._flush_later(sess_id))
+
+    async def _flush_later(self, sess_id: str):
+        await asyncio.sleep(self.window)
+        while (
+            sess_id in self._held and time.monotonic() - self._held[sess_id] < self.max_hold
+        ):
+            await asyncio.sleep(self.window)
+        # flushing is not cancelled by itself
+        self._timers.pop(sess_id, None)
+        await self._write(sess_id)
+
+    async def _write(self, sess_id: str):
+        pending = self._pending.pop(sess_id, None)
+        if pending is None:
+            return
+
+        store, meta, new_messages, max_memory, on_written = pending
+        writing = asyncio.ensure_future(
+            store.save(sess_id, meta, new_messages, max_memory)
+        )
+        self._writing[sess_id] = writing
+        try:
+            version = await asyncio.shield(writing)
+            self.counters["writes"] += 1
+            if on_written is not None:
+                on_written(version)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as err:
+            model_logger.error(
+                f"session write failed: {sess_id}, {len(new_messages)} messages lost ({err})",
+                exc_info=True,
+            )
+        finally:
+            if self._writing.get(sess_id) is writing:
+                del self._writing[sess_id]
+
+    async def flush(self, sess_id: str | None = None):
+        """write pending saves now, of a session or all sessions"""
+        sess_ids = (
+            list(set(self._pending) | set(self._writing)) if sess_id is None else [sess_id]
+        )
+        for sess_id in sess_ids:
+            self._held.pop(sess_id, None)
+            timer = self._timers.pop(sess_id, None)
+            if timer is not None:
+                timer.cancel()
+            # a write started by the timer is finished first, so writes stay in order
+            writing = self._writing.get(sess_id)
+            if writing is not None:
+                await asyncio.wait([writing])
+            await self._write(sess_id)
+
+
+class SessionL1Cache:
+    """in-process LRU of live sessions, validated by the version stamp of the store
+
+    an entry is only used if its version is still the stored one, so writes of other workers
+    are never missed. A hit costs one small read instead of loading and parsing the session.
+    After a write, the session is only put back if the new version is exactly one past the
+    version it was loaded at, see `ChatSession._on_written`.
+    """
+
+    def __init__(self, size: int = 256) -> None:
+        self.size = size
+        # sess_id -> (version, session)
+        self._sessions: OrderedDict[str, tuple[int, Any]] = OrderedDict()
+        self.counters = {"hits": 0, "stale": 0, "misses": 0}
+
+    def stats(self):
+        return dict(self.counters, size=len(self._sessions))
+
+    async def get(self, store: RedisSessionStore | CacheSessionStore, sess_id: str):
+        """the live session if still valid, otherwise None"""
+        entry = self._sessions.get(sess_id)
+        if entry is None:
+            self.counters["misses"] += 1
+            cache_lookups_total.inc("session", "miss")
+            return None
+
+        if await store.version(sess_id) != entry[0]:
+            # written by another worker
+            self.counters["stale"] += 1
+            cache_lookups_total.inc("session", "stale")
+            self._sessions.pop(sess_id, None)
+            return None
+
+        self.counters["hits"] += 1
+        cache_lookups_total.inc("session", "hit")
+        self._sessions.move_to_end(sess_id)
+        return entry[1]
+
+    def put(self, sess_id: str, version: int, session: Any):
+        if self.size <= 0:
+            return
+        self._sessions[sess_id] = (version, session)
+        self._sessions.move_to_end(sess_id)
+        while len(self._sessions) > self.size:
+            self._sessions.popitem(last=False)
+
+    def discard(self, sess_id: str):
+        self._sessions.pop(sess_id, None)
+
+
+session_writes = SessionWriteBuffer(window=get_settings().session_write_window)
+session_l1 = SessionL1Cache(size=get_settings().session_l1_size)
+registry.gauge(
+    "session_writes_pending",
+    "buffered session saves not yet written",
+    lambda: {(): len(session_writes._pending)},
+)
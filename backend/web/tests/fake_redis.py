@@ -0,0 +1,171 @@
+"""In-memory stand-in of the redis.asyncio client, for the redis code paths without a server
+
+only commands used by the backend are implemented. Values are returned as bytes like a client of
+aiocache's RedisCache (decode_responses=False). Put it behind a real RedisCache with
+`redis_cache()`, so `isinstance(cache, RedisCache)` branches and the serializer are exercised.
+"""
+
+import asyncio
+
+
+def _bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self.data: dict[bytes, object] = {}
+        self.ttls: dict[bytes, int] = {}
+        # (command, key, *args) of every command, pipelined ones included
+        self.commands: list[tuple] = []
+        self._subscribers: dict[bytes, list[asyncio.Queue]] = {}
+
+    def _log(self, *command):
+        self.commands.append(command)
+
+    async def get(self, key):
+        self._log("get", key)
+        return self.data.get(_bytes(key))
+
+    async def exists(self, *keys):
+        return sum(_bytes(key) in self.data for key in keys)
+
+    async def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            deleted += self.data.pop(_bytes(key), None) is not None
+            self.ttls.pop(_bytes(key), None)
+        return deleted
+
+    async def mget(self, *keys):
+        return [self.data.get(_bytes(key)) for key in keys]
+
+    async def set(self, key, value, **kwargs):
+        self._log("set", key)
+        self.data[_bytes(key)] = _bytes(value)
+        return True
+
+    async def hgetall(self, key):
+        self._log("hgetall", key)
+        return dict(self.data.get(_bytes(key), {}))
+
+    async def hget(self, key, field):
+        self._log("hget", key, field)
+        return self.data.get(_bytes(key), {}).get(_bytes(field))
+
+    async def hset(self, key, mapping):
+        self._log("hset", key, *mapping)
+        hash_ = self.data.setdefault(_bytes(key), {})
+        hash_.update({_bytes(k): _bytes(v) for k, v in mapping.items()})
+        return len(mapping)
+
+    async def hincrby(self, key, field, amount=1):
+        self._log("hincrby", key, field, amount)
+        hash_ = self.data.setdefault(_bytes(key), {})
+        value = int(hash_.get(_bytes(field), 0)) + amount
+        hash_[_bytes(field)] = _bytes(value)
+        return value
+
+    async def incrby(self, key, amount=1):
+        self._log("incrby", key, amount)
+        value = int(self.data.get(_bytes(key), 0)) + amount
+        self.data[_bytes(key)] = _bytes(value)
+        return value
+
+    async def rpush(self, key, *values):
+        self._log("rpush", key, len(values))
+        list_ = self.data.setdefault(_bytes(key), [])
+        list_.extend(_bytes(v) for v in values)
+        return len(list_)
+
+    async def ltrim(self, key, start, end):
+        self._log("ltrim", key, start, end)
+        list_ = self.data.get(_bytes(key), [])
+        # inclusive end, like redis
+        list_[:] = list_[start : (end + 1) or None]
+        return True
+
+    async def lrange(self, key, start, end):
+        self._log("lrange", key, start, end)
+        return list(self.data.get(_bytes(key), [])[start : (end + 1) or None])
+
+    async def expire(self, key, seconds):
+        self._log("expire", key, seconds)
+        if _bytes(key) not in self.data:
+            return False
+        self.ttls[_bytes(key)] = seconds
+        return True
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def publish(self, channel, message):
+        queues = self._subscribers.get(_bytes(channel), [])
+        for queue in queues:
+            queue.put_nowait(
+                {"type": "message", "channel": _bytes(channel), "data": _bytes(message)}
+            )
+        return len(queues)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+class FakePipeline:
+    """queues commands, `execute` runs them in order and returns their results"""
+
+    def __init__(self, client: FakeRedis) -> None:
+        self.client = client
+        self._queued = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self._queued.clear()
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+
+        def queue(*args, **kwargs):
+            self._queued.append((command, args, kwargs))
+            return self
+
+        return queue
+
+    async def execute(self):
+        queued, self._queued = self._queued, []
+        return [await command(*args, **kwargs) for command, args, kwargs in queued]
+
+
+class FakePubSub:
+    def __init__(self, client: FakeRedis) -> None:
+        self.client = client
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._channels: list[bytes] = []
+
+    async def subscribe(self, channel):
+        self._channels.append(_bytes(channel))
+        self.client._subscribers.setdefault(_bytes(channel), []).append(self._queue)
+        self._queue.put_nowait({"type": "subscribe", "channel": _bytes(channel), "data": 1})
+
+    async def listen(self):
+        while True:
+            yield await self._queue.get()
+
+    async def aclose(self):
+        for channel in self._channels:
+            self.client._subscribers[channel].remove(self._queue)
+        self._channels.clear()
+
+
+def redis_cache(client: FakeRedis = None):
+    """RedisCache of the codec serializer, talking to a fake client"""
+    from aiocache import RedisCache
+    from ..codec import CacheCodecSerializer
+
+    cache = RedisCache(serializer=CacheCodecSerializer())
+    cache.client = client if client is not None else FakeRedis()
+    return cache
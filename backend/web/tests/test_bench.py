@@ -0,0 +1,242 @@
+"""Microbenchmarks of the per-sentence hot path, checked against `bench_baseline.json`
+
+every case is timed in us/op and divided by a pure python calibration loop timed in the same
+run, so the baseline is comparable across machines. A case fails if its ratio grows beyond
+`BENCH_TOLERANCE` (default 3) times the baseline ratio.
+
+wall-clock timing is flaky on loaded machines, so the check only runs with `RUN_BENCH=1`, and
+is skipped if the python version differs from the baseline's (minor versions compared):
+    RUN_BENCH=1 python -m pytest web/tests/test_bench.py
+update the baseline after an intended change, under `backend/`:
+    UPDATE_BENCH_BASELINE=1 python -m pytest web/tests/test_bench.py
+or print the table:
+    python -m web.tests.test_bench
+"""
+
+import asyncio
+import base64
+import json
+import os
+import random
+import sys
+import time
+import pytest
+from aiocache import SimpleMemoryCache
+from ..codec import decode, encode
+from ..config import get_settings
+from ..models.bot import L2dBotPreset
+from ..models.chat import ChatMessage, ChatSession, ChatSessionMeta
+from ..scenes import jinja2_env
+from ..session_store import session_l1
+from ..webgal_utils import remove_parathesis, text_split_sentence
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+# seconds spent timing every case
+CASE_BUDGET = 0.05
+
+LONG_ANSWER = (
+    "（微微欠身）您好，工号0214，客服小祥为您服务。关于您反映的网络问题，我已经记录下来了——"
+    "请您先检查一下路由器的指示灯是否正常（如果红灯闪烁，说明线路可能存在故障）。"
+    "如果指示灯正常的话，可以尝试重启设备，通常等待两三分钟就能恢复！"
+    "另外，最近这一带在进行线路维护，可能会有短暂的中断……真是非常抱歉给您带来了不便。"
+    "（低头翻阅记录）我看到您的账户上个月也报修过一次，这次我们会安排技术人员优先上门检查。"
+    "请问您明天上午方便吗？还是下午更合适呢？如果还有其他问题，欢迎随时再联系我们，祝您生活愉快。"
+) * 2
+
+SCENE_COMMON = dict(
+    sess_id="0123456789abcdef0123456789abcdef",
+    bg_pic="N（主角相关工作地点）/N9.jpg",
+    l2d_path="mygo_avemujica_v6/sakiko/341_casual-2023_rip/model.json",
+    speaker="客服小祥",
+    next_url="http://127.0.0.1:10228/webgal/next.txt/0123456789abcdef0123456789abcdef/2?bot=sakiko",
+)
+SCENE_LINES = [
+    (
+        "您好，工号0214，客服小祥为您服务，请问有什么可以帮您的吗？" * (i % 3 + 1),
+        "smile03",
+        "smile01",
+        f"http://127.0.0.1:10228/webgal/voice.mp3/0123/{i:012x}",
+    )
+    for i in range(4)
+]
+
+
+def _calibration():
+    return sum(i * i for i in range(200))
+
+
+def make_cases(loop: asyncio.AbstractEventLoop) -> dict:
+    """name -> (callable, is coroutine function)"""
+    preset: L2dBotPreset = get_settings().bot_preset.get("sakiko")
+    answer_template = jinja2_env.get_template("answer.txt")
+    new_input_template = jinja2_env.get_template("new_input.txt")
+    pending_template = jinja2_env.get_template("pending.txt")
+
+    message = ChatMessage(
+        role="assistant", msg=LONG_ANSWER[:200], session=SCENE_COMMON["sess_id"]
+    )
+    message_json = message.model_dump_json()
+    message_record = message.to_record()
+    meta = ChatSessionMeta(system_prompt=LONG_ANSWER, max_memory=30)
+    meta_json = meta.model_dump_json()
+    # 30KB of mp3
+    voice_blob = random.Random(0).randbytes(30 * 1024)
+
+    cache = SimpleMemoryCache()
+    sess = ChatSession(meta=ChatSessionMeta(max_memory=30))
+    for i_msg in range(30):
+        sess.add_message("user" if i_msg % 2 else "assistant", LONG_ANSWER[: 20 + i_msg * 5])
+    loop.run_until_complete(sess.save_to_redis_cache(cache, flush=True))
+    sess_id = sess.meta.id
+
+    async def save_session():
+        sess.add_message("assistant", "好的，请您稍等。")
+        await sess.save_to_redis_cache(cache, flush=True)
+
+    async def load_session_cold():
+        session_l1.discard(sess_id.hex)
+        await ChatSession.load_from_redis_cache(sess_id, cache)
+
+    async def load_session_l1():
+        await ChatSession.load_from_redis_cache(sess_id, cache)
+
+    return {
+        "calibration": (_calibration, False),
+        "text_split_sentence": (lambda: text_split_sentence(LONG_ANSWER), False),
+        "remove_parathesis": (lambda: remove_parathesis(LONG_ANSWER), False),
+        "random_motion": (lambda: preset.random_motion("悲伤"), False),
+        "render answer.txt": (
+            lambda: answer_template.render(
+                msg_motion_expression_list=SCENE_LINES, **SCENE_COMMON
+            ),
+            False,
+        ),
+        "render new_input.txt": (
+            lambda: new_input_template.render(
+                msg_motion_expression_list=SCENE_LINES,
+                listening=["thinking02", "thinking01"],
+                **SCENE_COMMON,
+            ),
+            False,
+        ),
+        "render pending.txt": (
+            lambda: pending_template.render(
+                motion="thinking01", expression="thinking02", **SCENE_COMMON
+            ),
+            False,
+        ),
+        "ChatMessage json round trip": (
+            lambda: ChatMessage.model_validate_json(message.model_dump_json()),
+            False,
+        ),
+        "ChatMessage json load": (lambda: ChatMessage.model_validate_json(message_json), False),
+        "ChatSessionMeta json round trip": (
+            lambda: ChatSessionMeta.model_validate_json(meta.model_dump_json()),
+            False,
+        ),
+        "ChatSessionMeta json load": (
+            lambda: ChatSessionMeta.model_validate_json(meta_json),
+            False,
+        ),
+        "ChatMessage record round trip": (
+            lambda: ChatMessage.from_record(message.to_record()),
+            False,
+        ),
+        "ChatMessage record load": (lambda: ChatMessage.from_record(message_record), False),
+        "a85encode voice 30KB": (lambda: base64.a85encode(voice_blob).decode(), False),
+        "codec voice 30KB round trip": (lambda: decode(encode(voice_blob)), False),
+        "codec scene round trip": (
+            lambda: decode(encode({"script": LONG_ANSWER, "last_mood": "高兴"})),
+            False,
+        ),
+        "save_to_redis_cache (memory)": (save_session, True),
+        "load_from_redis_cache (memory, cold)": (load_session_cold, True),
+        "load_from_redis_cache (memory, L1 hit)": (load_session_l1, True),
+    }
+
+
+def _time(func, is_async: bool, loop: asyncio.AbstractEventLoop, number: int) -> float:
+    if not is_async:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        return time.perf_counter() - started
+
+    async def run():
+        started = time.perf_counter()
+        for _ in range(number):
+            await func()
+        return time.perf_counter() - started
+
+    return loop.run_until_complete(run())
+
+
+def run_benchmarks(budget: float = CASE_BUDGET) -> dict[str, float]:
+    """us/op of every case, best of 3 runs"""
+    loop = asyncio.new_event_loop()
+    results = {}
+    try:
+        for name, (func, is_async) in make_cases(loop).items():
+            # warm up and calibrate the number of calls for the budget
+            once = max(_time(func, is_async, loop, 1), 1e-7)
+            number = max(1, int(budget / 3 / once))
+            results[name] = (
+                min(_time(func, is_async, loop, number) for _ in range(3)) / number * 1e6
+            )
+    finally:
+        loop.close()
+    return results
+
+
+def to_baseline(results: dict[str, float]) -> dict:
+    calibration = results["calibration"]
+    return {
+        "python": sys.version.split()[0],
+        "calibration_us": round(calibration, 4),
+        "cases": {
+            name: {"us": round(us, 4), "ratio": round(us / calibration, 4)}
+            for name, us in results.items()
+            if name != "calibration"
+        },
+    }
+
+
+def _minor_version(version: str) -> str:
+    return ".".join(version.split(".")[:2])
+
+
+@pytest.mark.skipif(
+    not (os.environ.get("RUN_BENCH") or os.environ.get("UPDATE_BENCH_BASELINE")),
+    reason="wall-clock benchmark, run with RUN_BENCH=1",
+)
+def test_hot_path_benchmarks():
+    if os.environ.get("UPDATE_BENCH_BASELINE"):
+        current = to_baseline(run_benchmarks())
+        with open(BASELINE_PATH, "w", encoding="utf-8") as fp:
+            json.dump(current, fp, ensure_ascii=False, indent=2)
+            fp.write("\n")
+        return
+
+    with open(BASELINE_PATH, "r", encoding="utf-8") as fp:
+        baseline = json.load(fp)
+    if _minor_version(baseline["python"]) != _minor_version(sys.version.split()[0]):
+        pytest.skip(f"baseline is of python {baseline['python']}")
+
+    current = to_baseline(run_benchmarks())
+
+    tolerance = float(os.environ.get("BENCH_TOLERANCE", 3))
+    regressions = {
+        name: f"{result['ratio']} > {baseline['cases'][name]['ratio']} x {tolerance}"
+        for name, result in current["cases"].items()
+        if name in baseline["cases"]
+        and result["ratio"] > baseline["cases"][name]["ratio"] * tolerance
+    }
+    assert not regressions, f"slower than baseline: {regressions}"
+    # new cases need a baseline
+    assert set(current["cases"]) <= set(baseline["cases"]), "run with UPDATE_BENCH_BASELINE=1"
+
+
+if __name__ == "__main__":
+    results = run_benchmarks(budget=0.3)
+    for name, us in results.items():
+        print(f"{name:42s} {us:10.3f} us/op {us / results['calibration']:8.2f} x calibration")
@@ -19,4 +19,286 @@ def test_cache(cache):
     loop = asyncio.get_event_loop()
     loop.run_until_complete(cache.set('test key', 'test value'))
 
-    
\ No newline at end of file
+    
+
+def test_readiness_bus():
+    from aiocache import SimpleMemoryCache
+    from ..notify import ReadinessBus
+
+    async def run():
+        bus = ReadinessBus()
+        cache = SimpleMemoryCache()
+        await bus.start(cache)
+
+        async def produce():
+            await asyncio.sleep(0.1)
+            await cache.set("k", "v")
+            await bus.publish("k")
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        producer = asyncio.create_task(produce())
+        # woken by publish, far before timeout
+        assert await bus.wait("k", lambda: cache.get("k"), timeout=5) == "v"
+        assert loop.time() - start < 1
+        await producer
+        assert not bus.has_waiter("k")
+
+        # already cached, no wait
+        assert await bus.wait("k", lambda: cache.get("k"), timeout=5) == "v"
+        # never published
+        assert await bus.wait("x", lambda: cache.get("x"), timeout=0.1) is None
+        await bus.stop()
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+    from .fake_redis import FakeRedis, redis_cache
+
+    async def run_redis():
+        # two workers sharing a redis
+        client = FakeRedis()
+        cache_a, cache_b = redis_cache(client), redis_cache(client)
+        bus_a, bus_b = ReadinessBus(), ReadinessBus()
+        await bus_a.start(cache_a)
+        await bus_b.start(cache_b)
+        # let the listeners subscribe
+        await asyncio.sleep(0.01)
+
+        async def produce():
+            await asyncio.sleep(0.1)
+            await cache_a.set("k", "v")
+            await bus_a.publish("k")
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        producer = asyncio.create_task(produce())
+        # woken by the channel, not by its own event
+        assert await bus_b.wait("k", lambda: cache_b.get("k"), timeout=5) == "v"
+        assert loop.time() - start < 1
+        await producer
+        assert not bus_b.has_waiter("k")
+
+        await bus_a.stop()
+        await bus_b.stop()
+        assert client._subscribers[bus_a.channel.encode()] == []
+
+    asyncio.new_event_loop().run_until_complete(run_redis())
+
+
+def test_cache_lifecycle():
+    from aiocache import SimpleMemoryCache
+    from ..lifecycle import key_family, key_ttl, cache_usage, CacheSweeper
+    from ..config import get_settings
+
+    settings = get_settings()
+    assert key_family("voice:shared:w0123") == "voice_shared"
+    assert key_ttl("voice:shared:w0123") is None
+    assert key_ttl("voice:0123:abcd") == (settings.voice_ttl or None)
+    assert key_ttl("msgmood:0123:1") == (settings.scene_ttl or None)
+
+    async def run():
+        cache = SimpleMemoryCache()
+        await cache.set("msgmood:a:1", "x" * 10)
+        await cache.set("voice:a:b", "y" * 100, ttl=60)
+        await cache.set("sess:a", "z" * 20, ttl=60)
+
+        usage = await cache_usage(cache)
+        assert usage["families"]["voice"] == {"keys": 1, "bytes": 100, "ttl": key_ttl("voice:a:b")}
+        assert usage["total_bytes"] == 130
+
+        # over budget: scenes and voices are evicted oldest first, sessions are kept
+        sweeper = CacheSweeper(cache, interval=60, max_bytes=50)
+        await sweeper.sweep()
+        assert await cache.get("msgmood:a:1") is None
+        assert await cache.get("voice:a:b") is None
+        assert await cache.get("sess:a") is not None
+        assert sweeper.counters["evicted"] == 2
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_usage_meter():
+    from types import SimpleNamespace
+    from aiocache import SimpleMemoryCache
+    from ..usage import UsageMeter
+
+    def usage(prompt, completion, cached=0):
+        return SimpleNamespace(
+            prompt_tokens=prompt,
+            completion_tokens=completion,
+            total_tokens=prompt + completion,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached),
+        )
+
+    async def run():
+        cache = SimpleMemoryCache()
+        # counted by older versions
+        await cache.set("total_token", 100)
+        meter = UsageMeter()
+        meter.record(usage(10, 5, cached=8), "chat", "sakiko", "deepseek")
+        meter.record(usage(10, 5), "chat", "sakiko", "deepseek")
+        meter.record(usage(3, 1), "mood", "mood_analyzer", "deepseek")
+        meter.record(None, "chat", "sakiko", "deepseek")
+
+        # not flushed yet, still readable
+        assert (await meter.read(cache))["total_token"] == 134
+        await meter.flush(cache)
+        await meter.flush(cache)
+        result = await meter.read(cache)
+        assert result["total_token"] == 134
+        assert result["scopes"] == {"chat": 30, "mood": 4}
+        assert {
+            "scope": "chat", "preset": "sakiko", "llm_name": "deepseek",
+            "prompt": 20, "completion": 10, "cached": 8, "total": 30,
+        } in result["breakdown"]
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+    from .fake_redis import FakeRedis, redis_cache
+    from ..usage import USAGE_KEY
+
+    async def run_redis():
+        client = FakeRedis()
+        cache = redis_cache(client)
+        # plain counter of older versions
+        await client.set("total_token", b"100")
+        meter, other_worker = UsageMeter(), UsageMeter()
+        meter.record(usage(10, 5, cached=8), "chat", "sakiko", "deepseek")
+        meter.record(usage(3, 1), "mood", "mood_analyzer", "deepseek")
+        assert (await meter.read(cache))["total_token"] == 119
+
+        # one pipeline of HINCRBY per field and INCRBY of the total
+        await meter.flush(cache)
+        assert ("incrby", "total_token", 19) in client.commands
+        assert ("hincrby", USAGE_KEY, "chat|sakiko|deepseek|cached", 8) in client.commands
+        n_commands = len(client.commands)
+        await meter.flush(cache)
+        assert len(client.commands) == n_commands
+
+        # counters of workers add up
+        other_worker.record(usage(10, 5), "chat", "sakiko", "deepseek")
+        await other_worker.flush(cache)
+        result = await meter.read(cache)
+        assert result["total_token"] == 134
+        assert result["scopes"] == {"chat": 30, "mood": 4}
+        assert {
+            "scope": "chat", "preset": "sakiko", "llm_name": "deepseek",
+            "prompt": 20, "completion": 10, "cached": 8, "total": 30,
+        } in result["breakdown"]
+
+    asyncio.new_event_loop().run_until_complete(run_redis())
+
+
+def test_metrics_exposition():
+    from ..metrics import MetricsRegistry
+
+    registry = MetricsRegistry()
+    hist = registry.histogram("latency_seconds", "latency", ("tier",), buckets=(0.1, 1.0))
+    counter = registry.counter("lookups_total", "lookups", ("kind", "result"))
+    registry.gauge("in_flight", "jobs", lambda: {(): 2})
+
+    hist.observe(0.05, "llm")
+    hist.observe(0.5, "llm")
+    hist.observe(5, "llm")
+    counter.inc("voice", 'hit"')
+
+    text = registry.expose()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{tier="llm",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{tier="llm",le="1.0"} 2' in text
+    assert 'latency_seconds_bucket{tier="llm",le="+Inf"} 3' in text
+    assert 'latency_seconds_count{tier="llm"} 3' in text
+    assert 'latency_seconds_sum{tier="llm"} 5.55' in text
+    assert 'lookups_total{kind="voice",result="hit\\""} 1' in text
+    assert "in_flight 2" in text
+    with pytest.raises(ValueError):
+        registry.counter("lookups_total", "again")
+
+
+def test_admin_token():
+    from fastapi.testclient import TestClient
+    from .. import create_app
+    from ..config import get_settings
+
+    app = create_app()
+    client = TestClient(app)
+    settings = get_settings()
+
+    # admin endpoints are disabled without a token, metrics are open
+    app.dependency_overrides[get_settings] = lambda: settings.model_copy(
+        update={"admin_token": "", "metrics_token": ""}
+    )
+    assert client.get("/admin/traces?token=").status_code == 404
+    assert client.get("/metrics").status_code == 200
+
+    app.dependency_overrides[get_settings] = lambda: settings.model_copy(
+        update={"admin_token": "secret", "metrics_token": "scrape"}
+    )
+    assert client.get("/admin/traces").status_code == 403
+    assert client.get("/admin/traces?token=secret").status_code == 200
+    # the admin token doesn't open metrics
+    assert client.get("/metrics?token=secret").status_code == 401
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape"}).status_code == 200
+    assert client.get("/metrics?token=scrape").status_code == 200
+
+
+def test_tracer_ring_buffer():
+    from ..tracing import Tracer, activate_trace, trace_event
+
+    tracer = Tracer(size=2)
+    first = tracer.begin("a", 1, "sakiko")
+    tracer.begin("b", 1, "sakiko")
+    activate_trace(tracer.begin("a", 3, "sakiko"))
+    trace_event("llm.first_token", "llm")
+    trace_event("tts", "tts", dur=0.5, provider="fish")
+    activate_trace(None)
+    # no-op outside a turn
+    trace_event("ignored", "llm")
+
+    # the oldest turn is evicted, later scenes go to the latest turn of a session
+    assert tracer.get("a", 1) is None
+    assert tracer.latest("a") is not first
+    assert [t.msg_id for t in tracer.traces("a")] == [3]
+    trace = tracer.traces()[0]
+    assert [e["name"] for e in trace.to_dict()["events"]] == ["llm.first_token", "tts"]
+    assert set(trace.first_offsets()) == {"llm.first_token", "tts"}
+
+    events = tracer.chrome([trace])["traceEvents"]
+    spans = [e for e in events if e["ph"] == "X"]
+    assert spans[0]["dur"] == 500000 and spans[0]["args"] == {"provider": "fish"}
+    assert {e["args"]["name"] for e in events if e["name"] == "thread_name"} == {"llm", "tts"}
+
+
+def test_cache_codec():
+    import base64
+    import json
+    from aiocache import SimpleMemoryCache
+    from ..codec import CacheCodecSerializer, decode, encode, CODEC_VERSION
+    from ..tts import decode_voice
+
+    scene = {"script": "changeScene:next.txt -next", "last_mood": "高兴", "published_at": 1.5}
+    assert decode(encode(scene)) == scene
+    # audio is kept raw and never compressed
+    audio = bytes(4096)
+    assert encode(audio)[:2] == bytes((CODEC_VERSION, 0)) and audio in encode(audio)
+    assert decode(encode(audio)) == audio
+    # large values are compressed
+    history = ["您好，工号0214，客服小祥为您服务。" * 10] * 30
+    assert encode(history)[1] == 1 and len(encode(history)) < len(json.dumps(history)) / 10
+    assert decode(encode(history, compression="none")) == history
+    # JSON entries of older versions
+    assert decode(json.dumps(scene).encode()) == scene
+    assert decode("134") == 134
+    assert decode_voice(base64.a85encode(audio).decode()) == audio
+
+    async def run():
+        cache = SimpleMemoryCache(serializer=CacheCodecSerializer())
+        await cache.set("msgmood:a:1", scene)
+        await cache.set("voice:a:b", audio)
+        assert await cache.get("msgmood:a:1") == scene
+        assert await cache.get("voice:a:b") == audio
+        assert isinstance(cache._cache["msgmood:a:1"], bytes)
+
+    asyncio.new_event_loop().run_until_complete(run())
@@ -24,4 +24,48 @@ def test_split():
         for sent in split_result:
             print('|',remove_parathesis(sent),'|',sep='')
 
-        assert ''.join(split_result) == example
\ No newline at end of file
+        assert ''.join(split_result) == example
+
+def test_incremental_split():
+    import random
+    from ..webgal_utils import IncrementalSentenceSplitter
+
+    examples = [
+        "你好，我是客服小祥。有什么可以帮忙的吗？",
+        "一句话。这句话没有标点",
+        "。！？",
+        "这句话不在。（这句话在括号里。）",
+        "这句没有标点不在（这句话在括号里。）",
+        "（这句话在括号里。）这句话不在。",
+        "（挂断电话后，祥子长舒一口气，脸上的职业假笑瞬间消失。她揉了",
+        "至于其他安排...（祥子心中闪过一丝疲惫，但随即恢复了坚毅）还是专注于眼前的任务吧，其他的暂时不去想了。",
+        "第一行\n\n\n第二行(ascii。括号)结束。\n",
+        "(没有右括号。后面。",
+    ]
+    # random texts of the characters that matter
+    rng = random.Random(0)
+    examples += [
+        "".join(rng.choice("ab，。？！；\n（）()") for _ in range(rng.randint(0, 16)))
+        for _ in range(2000)
+    ]
+
+    for example in examples:
+        expected = text_split_sentence(example)
+
+        splitter = IncrementalSentenceSplitter()
+        pos = 0
+        result = []
+        while pos < len(example):
+            step = rng.randint(1, 5)
+            result.extend(splitter.feed(example[pos : pos + step]))
+            pos += step
+        result.extend(splitter.flush())
+
+        assert result == expected, example
+
+    # finished sentences come out as soon as they are closed
+    splitter = IncrementalSentenceSplitter()
+    assert splitter.feed("你好。") == []
+    assert splitter.feed("我是") == ["你好。"]
+    assert splitter.feed("（括号）") == []
+    assert splitter.flush() == ["我是（括号）"]
@@ -16,6 +16,16 @@ def settings():
 def cache():
     return get_cache()
 
+@pytest.fixture(autouse=True)
+def session_writes(monkeypatch):
+    # a write left running by the event loop of one test is never finished by later ones
+    from ..session_store import SessionWriteBuffer
+    from ..models import chat as chat_module
+
+    buffer = SessionWriteBuffer()
+    monkeypatch.setattr(chat_module, "session_writes", buffer)
+    return buffer
+
 
 async def _test_chat(chat_session: ChatSession, cache):
     await chat_session.save_to_redis_cache(cache)
@@ -55,3 +65,395 @@ def test_chats(settings, cache):
     assert len(sess_new2.messages) == 4
 
     print([(msg.role, msg.msg) for msg in sess_new2.messages])
+
+
+def test_llm_client_pool(settings):
+    from ..llm_client import get_llm_client, close_llm_clients
+
+    llm_name = settings.bot_preset.get('sakiko').llm_name
+    client = get_llm_client(llm_name)
+    # the same client (and connection pool) is reused
+    assert get_llm_client(llm_name) is client
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(close_llm_clients())
+    assert get_llm_client(llm_name) is not client
+
+
+def test_session_store(settings):
+    from aiocache import SimpleMemoryCache
+
+    async def run():
+        cache = SimpleMemoryCache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'), max_memory=3)
+        for i in range(4):
+            sess.add_message('user', f'q{i}')
+            await sess.save_to_redis_cache(cache)
+        sess.add_message('assistant', 'a3')
+        await sess.save_to_redis_cache(cache)
+        # nothing new
+        await sess.save_to_redis_cache(cache)
+
+        loaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert loaded.meta == sess.meta
+        # history is trimmed to max_memory
+        assert [msg.msg for msg in loaded.messages] == ['q2', 'q3', 'a3']
+
+        with pytest.raises(IndexError):
+            await ChatSession.load_from_redis_cache(ChatSession().meta.id.hex, cache)
+
+        # sessions of the old key scheme are migrated on load
+        old = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        old.add_message('user', 'old question')
+        sess_hex = old.meta.id.hex
+        await cache.set(f"session:{sess_hex}", old.meta.model_dump_json())
+        await cache.multi_set([
+            (f"history:{sess_hex}:{i}", msg.model_dump_json())
+            for i, msg in enumerate(old.messages)
+        ])
+        migrated = await ChatSession.load_from_redis_cache(old.meta.id, cache)
+        assert migrated.messages == old.messages
+        assert not await cache.exists(f"session:{sess_hex}")
+        assert (await ChatSession.load_from_redis_cache(old.meta.id, cache)).messages == old.messages
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_redis_session_store(settings, monkeypatch):
+    from ..session_store import RedisSessionStore, SessionL1Cache, meta_key, history_key
+    from ..models import chat as chat_module
+    from .. import session_store as store_module
+    from .fake_redis import FakeRedis, redis_cache
+
+    async def run():
+        client = FakeRedis()
+        store = RedisSessionStore(client)
+        sess_hex = ChatSession().meta.id.hex
+
+        # idle sessions expire, the version is read before the EXPIRE results
+        assert await store.save(sess_hex, {"name": "小祥", "n": 1}, ["m0", "m1", "m2"], 2) == 1
+        assert ("ltrim", history_key(sess_hex), -2, -1) in client.commands
+        assert set(client.ttls) == {meta_key(sess_hex).encode(), history_key(sess_hex).encode()}
+        assert await store.save(sess_hex, None, ["m3"], 2) == 2
+        assert await store.version(sess_hex) == 2
+
+        # hash values are JSON, history is trimmed to max_memory
+        meta, history, version = await store.load(sess_hex)
+        assert meta == {"name": "小祥", "n": 1}
+        assert history == [b"m2", b"m3"]
+        assert version == 2
+
+        # without TTL the version is the last result, nothing expires
+        monkeypatch.setattr(store_module, "key_ttl", lambda key: None)
+        client.ttls.clear()
+        assert await store.save(sess_hex, None, ["m4"], 0) == 3
+        assert client.ttls == {}
+        assert (await store.load(sess_hex))[1] == [b"m2", b"m3", b"m4"]
+
+        assert await store.load("unknown") is None
+        assert await store.version("unknown") is None
+
+        # round trip of a session through the redis layout
+        monkeypatch.setattr(chat_module, "session_l1", SessionL1Cache(size=8))
+        cache = redis_cache(client)
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'), max_memory=3)
+        for i in range(3):
+            sess.add_message('user', f'q{i}')
+        await sess.save_to_redis_cache(cache, flush=True)
+        monkeypatch.setattr(chat_module, "session_l1", SessionL1Cache(size=8))
+        loaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert loaded is not sess
+        assert loaded.meta == sess.meta
+        assert loaded.messages == sess.messages[-3:]
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_session_write_behind(settings, monkeypatch):
+    from aiocache import SimpleMemoryCache
+    from ..session_store import SessionWriteBuffer, CacheSessionStore
+    from ..models import chat as chat_module
+
+    writes = []
+
+    class CountingStore(CacheSessionStore):
+        async def save(self, sess_id, meta, new_messages, max_memory):
+            writes.append((meta is not None, len(new_messages)))
+            return await super().save(sess_id, meta, new_messages, max_memory)
+
+    buffer = SessionWriteBuffer(window=10)
+    monkeypatch.setattr(chat_module, "session_writes", buffer)
+    monkeypatch.setattr(chat_module, "get_session_store", CountingStore)
+
+    async def run():
+        cache = SimpleMemoryCache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        # a turn: saved by dependency teardown, then at the end of stream
+        sess.add_message('user', 'q')
+        await sess.save_to_redis_cache(cache)
+        await sess.save_to_redis_cache(cache)
+        sess.add_message('assistant', 'a')
+        await sess.save_to_redis_cache(cache, flush=True)
+        # welcome, q, a in one write
+        assert writes == [(True, 3)]
+
+        # nothing changed, nothing written
+        await sess.save_to_redis_cache(cache, flush=True)
+        assert len(writes) == 1
+
+        # buffered saves are visible to loads
+        sess.add_message('user', 'q2')
+        await sess.save_to_redis_cache(cache)
+        loaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert [msg.msg for msg in loaded.messages][-3:] == ['q', 'a', 'q2']
+        assert len(writes) == 2
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert buffer.stats()["merged"] == 1
+    assert buffer.stats()["skipped"] == 2
+
+
+def test_session_turn_one_write(settings, monkeypatch):
+    from types import SimpleNamespace
+    from aiocache import SimpleMemoryCache
+    from ..session_store import SessionWriteBuffer, CacheSessionStore
+    from ..models import chat as chat_module
+
+    writes = []
+
+    class CountingStore(CacheSessionStore):
+        async def save(self, sess_id, meta, new_messages, max_memory):
+            writes.append(len(new_messages))
+            return await super().save(sess_id, meta, new_messages, max_memory)
+
+    async def slow_stream():
+        for piece in ("你好", "。"):
+            # the turn lasts longer than the window
+            await asyncio.sleep(0.1)
+            yield SimpleNamespace(
+                usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))]
+            )
+
+    class SlowCompletions:
+        async def create(self, **kwargs):
+            return slow_stream()
+
+    class SlowClient:
+        chat = SimpleNamespace(completions=SlowCompletions())
+
+    buffer = SessionWriteBuffer(window=0.05)
+    monkeypatch.setattr(chat_module, "session_writes", buffer)
+    monkeypatch.setattr(chat_module, "get_session_store", CountingStore)
+    monkeypatch.setattr(chat_module, "get_llm_client", lambda llm_name: SlowClient())
+
+    async def run():
+        cache = SimpleMemoryCache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        resp_gen = await sess.get_answer_a(settings, prompt='q', preset_name='sakiko')
+        # saved by the teardown of chat.txt while the turn goes on in background
+        await sess.save_to_redis_cache(cache)
+        assert [piece async for piece in resp_gen(cache=cache)] == ["你好", "。", None]
+        await asyncio.sleep(0.1)
+        # welcome, q and the answer in one write
+        assert writes == [3]
+
+    asyncio.new_event_loop().run_until_complete(run())
+    assert buffer.stats()["writes"] == 1
+
+
+def test_session_migration_write_behind(settings, monkeypatch):
+    from aiocache import SimpleMemoryCache
+    from ..session_store import SessionL1Cache, SessionWriteBuffer
+    from ..models import chat as chat_module
+
+    monkeypatch.setattr(chat_module, "session_writes", SessionWriteBuffer(window=10))
+    monkeypatch.setattr(chat_module, "session_l1", SessionL1Cache(size=8))
+
+    async def run():
+        cache = SimpleMemoryCache()
+        old = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        old.add_message('user', 'old question')
+        sess_hex = old.meta.id.hex
+        await cache.set(f"session:{sess_hex}", old.meta.model_dump_json())
+        await cache.multi_set([
+            (f"history:{sess_hex}:{i}", msg.model_dump_json())
+            for i, msg in enumerate(old.messages)
+        ])
+        await ChatSession.load_from_redis_cache(old.meta.id, cache)
+        assert not await cache.exists(f"session:{sess_hex}")
+
+        # another worker, with its own buffer and L1, loads it right away
+        monkeypatch.setattr(chat_module, "session_writes", SessionWriteBuffer(window=10))
+        monkeypatch.setattr(chat_module, "session_l1", SessionL1Cache(size=8))
+        loaded = await ChatSession.load_from_redis_cache(old.meta.id, cache)
+        assert loaded.messages == old.messages
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_session_l1(settings, monkeypatch):
+    from aiocache import SimpleMemoryCache
+    from ..session_store import SessionL1Cache, get_session_store
+    from ..models import chat as chat_module
+
+    l1 = SessionL1Cache(size=2)
+    monkeypatch.setattr(chat_module, "session_l1", l1)
+
+    async def run():
+        cache = SimpleMemoryCache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        await sess.save_to_redis_cache(cache, flush=True)
+
+        # live object, validated by version only
+        assert await ChatSession.load_from_redis_cache(sess.meta.id, cache) is sess
+        assert l1.stats()["hits"] == 1
+
+        # written by another worker
+        other = sess.model_copy(deep=True)
+        other.add_message('user', 'from another worker')
+        await get_session_store(cache).save(
+            sess.meta.id.hex, None, [other.messages[-1].model_dump_json()], 30
+        )
+        reloaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert reloaded is not sess
+        assert reloaded.messages[-1].msg == 'from another worker'
+        assert l1.stats()["stale"] == 1
+        assert await ChatSession.load_from_redis_cache(sess.meta.id, cache) is reloaded
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_session_l1_two_writers(settings, monkeypatch):
+    from aiocache import SimpleMemoryCache
+    from ..session_store import SessionL1Cache, SessionWriteBuffer
+    from ..models import chat as chat_module
+
+    monkeypatch.setattr(chat_module, "session_writes", SessionWriteBuffer(window=0))
+    l1_a, l1_b = SessionL1Cache(size=8), SessionL1Cache(size=8)
+
+    def worker(l1):
+        monkeypatch.setattr(chat_module, "session_l1", l1)
+
+    class FailingCompletions:
+        async def create(self, **kwargs):
+            raise ConnectionError("llm down")
+
+    class FailingClient:
+        chat = type("Chat", (), {"completions": FailingCompletions()})()
+
+    monkeypatch.setattr(chat_module, "get_llm_client", lambda llm_name: FailingClient())
+
+    async def run():
+        cache = SimpleMemoryCache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        worker(l1_a)
+        await sess.save_to_redis_cache(cache, flush=True)
+        sess_a = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        worker(l1_b)
+        sess_b = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert sess_b is not sess_a
+
+        # both write the session, b first
+        sess_b.add_message('user', 'from b')
+        await sess_b.save_to_redis_cache(cache, flush=True)
+        worker(l1_a)
+        sess_a.add_message('user', 'from a')
+        await sess_a.save_to_redis_cache(cache, flush=True)
+        # the version of a's write includes b's, a's object misses b's message
+        assert l1_a.stats()["size"] == 0
+        loaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert loaded is not sess_a
+        assert [msg.msg for msg in loaded.messages][-2:] == ['from b', 'from a']
+
+        # a failed turn leaves an unsaved prompt, the live object is dropped
+        assert l1_a.stats()["size"] == 1
+        with pytest.raises(ConnectionError):
+            await loaded.get_answer_a(settings, prompt='lost', preset_name='sakiko')
+        assert l1_a.stats()["size"] == 0
+        reloaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert reloaded.messages[-1].msg == 'from a'
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_session_l1_redis_version(settings, monkeypatch):
+    from ..session_store import RedisSessionStore, SessionL1Cache, SessionWriteBuffer
+    from ..models import chat as chat_module
+    from .fake_redis import redis_cache
+
+    l1 = SessionL1Cache(size=8)
+    monkeypatch.setattr(chat_module, "session_l1", l1)
+    monkeypatch.setattr(chat_module, "session_writes", SessionWriteBuffer(window=0))
+
+    async def run():
+        cache = redis_cache()
+        sess = ChatSession.from_preset(settings.bot_preset.get('sakiko'))
+        await sess.save_to_redis_cache(cache, flush=True)
+        assert await ChatSession.load_from_redis_cache(sess.meta.id, cache) is sess
+
+        # another worker's store bumps `_version` of the hash
+        other = sess.model_copy(deep=True)
+        other.add_message('user', 'from another worker')
+        version = await RedisSessionStore(cache.client).save(
+            sess.meta.id.hex, None, [other.messages[-1].model_dump_json()], 30
+        )
+        assert version == 2
+
+        reloaded = await ChatSession.load_from_redis_cache(sess.meta.id, cache)
+        assert reloaded is not sess
+        assert reloaded.messages[-1].msg == 'from another worker'
+        assert l1.stats()["stale"] == 1
+        assert await ChatSession.load_from_redis_cache(sess.meta.id, cache) is reloaded
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+
+def test_message_record():
+    from ..models.chat import ChatMessage
+
+    sess = ChatSession()
+    sess.add_message('assistant', '（微笑）您好，工号0214。', mood='高兴')
+    msg = sess.messages[-1]
+    record = msg.to_record()
+    assert ChatMessage.from_record(record) == msg
+    assert len(record) < len(msg.model_dump_json().encode()) * 0.8
+    # JSON of older versions, as str or as bytes from redis
+    assert ChatMessage.from_record(msg.model_dump_json()) == msg
+    assert ChatMessage.from_record(msg.model_dump_json().encode()) == msg
+    # records of version 1 have no tokens, counted when needed
+    from ..codec import packb, unpackb
+    old_record = packb((1, *unpackb(record)[1:-1]))
+    old_msg = ChatMessage.from_record(old_record)
+    assert old_msg.tokens == 0
+    assert old_msg.count_tokens() == msg.tokens > 0
+
+
+def test_context_budget():
+    from ..models.chat import ChatSessionMeta
+    from ..tokens import estimate_message_tokens, estimate_tokens
+
+    assert estimate_tokens("你好，小祥") == 5
+    assert estimate_tokens("hello world") == 3
+
+    sess = ChatSession(meta=ChatSessionMeta(system_prompt="你是客服小祥。", max_memory=30))
+    for i_msg in range(20):
+        sess.add_message("user" if i_msg % 2 else "assistant", "很长的一句话" * (i_msg + 1))
+    system_tokens = estimate_message_tokens("你是客服小祥。")
+
+    # by message count only
+    messages, tokens = sess.build_request()
+    assert len(messages) == 21
+    assert tokens == system_tokens + sum(msg.tokens for msg in sess.messages)
+
+    # newest messages within the budget
+    messages, tokens = sess.build_request(context_budget=300)
+    assert tokens <= 300
+    assert messages[0]["role"] == "system"
+    assert [m["content"] for m in messages[1:]] == [msg.msg for msg in sess.messages[-len(messages) + 1:]]
+    assert len(messages) - 1 < 20
+    next_older = sess.messages[-len(messages)]
+    assert tokens + next_older.tokens > 300
+
+    # the newest message is sent even beyond the budget
+    messages, tokens = sess.build_request(context_budget=10)
+    assert len(messages) == 2 and messages[1]["content"] == sess.messages[-1].msg
@@ -0,0 +1,234 @@
+import pytest
+import asyncio
+import random
+from types import SimpleNamespace
+from .. import mood as mood_module
+from ..config import get_settings
+from ..mood import (
+    MoodPipeline,
+    MoodClassifier,
+    parse_batch_moods,
+    format_batch_mood_prompt,
+    normalize_mood,
+)
+
+pytest_plugins = ("pytest_asyncio",)
+
+
+@pytest.mark.asyncio
+async def test_mood_pipeline_order():
+    running = 0
+    max_running = 0
+
+    async def classify(sent: str):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        # later sentences might finish earlier
+        await asyncio.sleep(random.random() * 0.02)
+        running -= 1
+        return f"mood-{sent}"
+
+    pipeline = MoodPipeline(classify, concurrency=3)
+    sentences = [str(i) for i in range(20)]
+
+    async def produce():
+        for sent in sentences:
+            pipeline.submit(sent)
+            await asyncio.sleep(0)
+        pipeline.submit("", final=True)
+        pipeline.close()
+
+    producer = asyncio.create_task(produce())
+    results = [item async for item in pipeline.results()]
+    await producer
+
+    assert [sent for sent, _, _ in results] == sentences + [""]
+    assert [mood for _, mood, _ in results] == [f"mood-{s}" for s in sentences] + [""]
+    assert [final for _, _, final in results] == [False] * 20 + [True]
+    assert 1 < max_running <= 3
+
+
+def test_parse_batch_moods():
+    assert format_batch_mood_prompt(["你好。", "第二句\n"]) == "1. 你好。\n2. 第二句"
+
+    answer = "1:高兴\n2：【生气】\n\n4. 不知道\n5:悲伤\n9:高兴\n随便说点什么"
+    assert parse_batch_moods(answer, 5) == ["高兴", "生气", None, None, "悲伤"]
+    assert parse_batch_moods("", 2) == [None, None]
+
+
+@pytest.mark.asyncio
+async def test_mood_pipeline_batch():
+    batches = []
+    singles = []
+
+    async def classify(sent: str):
+        singles.append(sent)
+        return "悲伤"
+
+    async def classify_batch(sents: list[str]):
+        batches.append(sents)
+        # malformed answer for sentence "b"
+        return [None if sent == "b" else "高兴" for sent in sents]
+
+    pipeline = MoodPipeline(
+        classify, classify_batch=classify_batch, batch_size=3, batch_wait=10
+    )
+    for sent in "abcde":
+        pipeline.submit(sent)
+    pipeline.submit("f", final=True)
+    pipeline.close()
+
+    results = [item async for item in pipeline.results()]
+    assert [(sent, mood) for sent, mood, _ in results] == [
+        ("a", "高兴"),
+        ("b", "悲伤"),
+        ("c", "高兴"),
+        ("d", "高兴"),
+        ("e", "高兴"),
+        ("f", "高兴"),
+    ]
+    assert batches == [["a", "b", "c"], ["d", "e", "f"]]
+    assert singles == ["b"]
+
+    # flushed by waiting time
+    batches.clear()
+    pipeline = MoodPipeline(
+        classify, classify_batch=classify_batch, batch_size=0, batch_wait=0.01
+    )
+    pipeline.submit("a")
+    pipeline.submit("c")
+    await asyncio.sleep(0.05)
+    pipeline.submit("d", final=True)
+    pipeline.close()
+    results = [item async for item in pipeline.results()]
+    assert batches == [["a", "c"], ["d"]]
+
+
+@pytest.mark.asyncio
+async def test_mood_classifier_stateless(monkeypatch):
+    requests = []
+
+    async def create(model, messages, stream, **params):
+        requests.append(messages)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="【生气】。"))]
+        )
+
+    fake_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(mood_module, "get_llm_client", lambda llm_name: fake_client)
+
+    classifier = MoodClassifier(get_settings())
+    assert await classifier.classify("你怎么可以这么对我？！") == "生气"
+    assert await classifier.classify("第二句。") == "生气"
+
+    # no history: only the fixed system prompt and the sentence itself
+    assert [len(messages) for messages in requests] == [2, 2]
+    assert requests[0][0] == requests[1][0]
+    assert requests[0][0]["role"] == "system"
+    assert requests[1][1] == {"role": "user", "content": "第二句。"}
+
+    assert normalize_mood(" 高兴\n") == "高兴"
+    assert normalize_mood("不知道") == "不知道"
+
+
+@pytest.mark.asyncio
+async def test_local_mood_tier():
+    from ..mood_engine import LexiconMoodEngine, make_local_classify
+
+    engine = LexiconMoodEngine()
+    assert engine.classify("唉，算了，没办法。")[0] == "无奈"
+    assert engine.classify("你怎么可以这么对我？！混蛋！")[0] == "生气"
+    assert engine.classify("今天是星期三") == (None, 0.0)
+
+    assert make_local_classify(tier="llm") is None
+    local_only = make_local_classify(tier="local")
+    assert local_only("今天是星期三") == ""
+    hybrid = make_local_classify(tier="hybrid", threshold=0.5)
+    assert hybrid("唉，算了，没办法。") == "无奈"
+    assert hybrid("今天是星期三") is None
+
+    escalated = []
+
+    async def classify(sent: str):
+        escalated.append(sent)
+        return "坚定"
+
+    pipeline = MoodPipeline(classify, local_classify=hybrid)
+    pipeline.submit("唉，算了，没办法。")
+    pipeline.submit("今天是星期三", final=True)
+    pipeline.close()
+    results = [(sent, mood) async for sent, mood, _ in pipeline.results()]
+    assert results == [("唉，算了，没办法。", "无奈"), ("今天是星期三", "坚定")]
+    assert escalated == ["今天是星期三"]
+
+    # unknown engines are rejected when presets are loaded
+    from pydantic import ValidationError
+    from ..config import get_settings
+    from ..models.bot import L2dBotPreset
+
+    preset = get_settings().bot_preset.get("sakiko").model_dump()
+    with pytest.raises(ValidationError):
+        L2dBotPreset.model_validate(dict(preset, mood_engine="lexicom"))
+
+
+@pytest.mark.asyncio
+async def test_mood_memo():
+    from aiocache import SimpleMemoryCache
+    from ..mood import MoodMemo
+
+    cache = SimpleMemoryCache()
+    memo = MoodMemo(cache, scope="mood_analyzer:test", l1_size=2)
+
+    # parathesis and whitespaces don't matter
+    assert memo.cache_key("（微笑）您好，\n  请问 ") == memo.cache_key("您好， 请问")
+    assert memo.cache_key("（微笑）") is None
+
+    assert await memo.get("您好，请问") is None
+    await memo.set("（微笑）您好，请问", "高兴")
+    # invalid moods are not remembered
+    await memo.set("不知道。", "不知道")
+    assert await memo.get("您好，请问") == "高兴"
+    assert await memo.get("不知道。") is None
+    assert memo.stats() == {"hits_l1": 1, "hits_l2": 0, "misses": 2}
+
+    # another process only has the shared cache
+    memo2 = MoodMemo(cache, scope="mood_analyzer:test")
+    assert await memo2.multi_get(["您好，请问", "新的一句。"]) == ["高兴", None]
+    assert memo2.stats() == {"hits_l1": 0, "hits_l2": 1, "misses": 1}
+
+    queried = []
+
+    async def classify(sent: str):
+        queried.append(sent)
+        return "坚定"
+
+    pipeline = MoodPipeline(classify, memo=memo2)
+    for sent in ["您好，请问", "新的一句。", "新的一句。"]:
+        pipeline.submit(sent)
+        await asyncio.sleep(0.01)
+    pipeline.close()
+    results = [mood async for _, mood, _ in pipeline.results()]
+    assert results == ["高兴", "坚定", "坚定"]
+    assert queried == ["新的一句。"]
+
+    # batched answers are remembered apart from the single sentence analyzer
+    batch_memo = MoodMemo(cache, scope="mood_analyzer_batch:test")
+
+    async def classify_batch(sents: list[str]):
+        return ["生气"] * len(sents)
+
+    pipeline = MoodPipeline(
+        classify,
+        classify_batch=classify_batch,
+        batch_size=2,
+        memo=memo2,
+        batch_memo=batch_memo,
+    )
+    pipeline.submit("您好，请问")
+    pipeline.submit("第三句。", final=True)
+    pipeline.close()
+    results = [mood async for _, mood, _ in pipeline.results()]
+    assert results == ["生气", "生气"]
+    assert await batch_memo.get("第三句。") == "生气"
+    assert await memo2.multi_get(["您好，请问", "第三句。"]) == ["高兴", None]
@@ -72,8 +72,94 @@ def test_webgal():
         assert 'chat.txt' in next_url_path
 
 
+def test_warmup(monkeypatch):
+    import asyncio
+    from uuid import uuid4
+    from aiocache import SimpleMemoryCache
+    from ..config import get_settings
+    from .. import tts as tts_module
+    from .. import audio_store
+    from ..routes import webgal_route
+
+    async def fake_tts_stream(text, voice_preset):
+        yield text.encode()
+
+    monkeypatch.setattr(tts_module, "tts_stream", fake_tts_stream)
+    monkeypatch.setattr(webgal_route, "warm_assets", {})
+    # voices in cache
+    monkeypatch.setattr(audio_store, "_audio_store", None)
+    settings = get_settings()
+    preset = settings.bot_preset.get("sakiko")
+    cache = SimpleMemoryCache()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(webgal_route.warmup_presets(settings, cache))
+    assets = webgal_route.warm_assets["sakiko"]
+
+    # fixed lines are synthesized once into shared keys
+    assert set(assets.voices) >= {preset.welcome_message, preset.hangup_message}
+    voice_key = assets.voices[preset.welcome_message]
+    assert loop.run_until_complete(
+        cache.get(webgal_route.get_voice_cachekey(sess_id=uuid4().hex, hash=voice_key))
+    )
 
-
-
-
-    
\ No newline at end of file
+    # only session id is filled in pre-rendered scenes
+    sess_id = uuid4()
+    script = assets.welcome_script(sess_id)
+    assert f"setVar:sess={sess_id.hex}" in script
+    assert webgal_route.SESS_ID_PLACEHOLDER not in script
+    assert voice_key in script
+
+    script = loop.run_until_complete(
+        webgal_route.bye_script(
+            preset, "高兴", bye_message=preset.hangup_message, preset_name="sakiko"
+        )
+    )
+    assert preset.hangup_message in script
+    assert assets.voices[preset.hangup_message] in script
+    loop.close()
+
+
+def test_scene_coalescing(monkeypatch):
+    import asyncio
+    from uuid import uuid4
+    from aiocache import SimpleMemoryCache
+    from ..config import get_settings
+    from .. import tts as tts_module
+    from ..routes import webgal_route
+
+    async def fake_tts_stream(text, voice_preset):
+        yield text.encode()
+
+    monkeypatch.setattr(tts_module, "tts_stream", fake_tts_stream)
+    settings = get_settings()
+    # no LLM for moods
+    monkeypatch.setattr(settings.bot_preset.get("sakiko"), "mood_tier", "local")
+    monkeypatch.setattr(settings, "scene_max_lines", 3)
+
+    async def resp_gen(delays):
+        for delay in delays:
+            await asyncio.sleep(delay)
+            yield "你好。"
+        yield None
+
+    async def run(delays):
+        cache = SimpleMemoryCache()
+        sess_id = uuid4()
+        await webgal_route.task_get_chat_response_and_mood(
+            resp_gen(delays), settings, cache, 1, sess_id
+        )
+        scenes = []
+        while (scene := await cache.get(f"msgmood:{sess_id.hex}:{len(scenes) + 1}")) is not None:
+            scenes.append(scene["script"])
+        return scenes
+
+    loop = asyncio.new_event_loop()
+    # fast model: first sentence alone, the rest coalesced up to 3 lines
+    scenes = loop.run_until_complete(run([0] + [0.01] * 6))
+    assert [s.count("你好。") for s in scenes] == [1, 3, 3]
+    assert "chat.txt" in scenes[-1] and "next.txt" in scenes[0]
+    # slow model: sentences are published on their own, except the last ones arriving together
+    scenes = loop.run_until_complete(run([0.5] * 4))
+    assert [s.count("你好。") for s in scenes] == [1, 1, 2]
+    loop.close()
@@ -0,0 +1,53 @@
+import pytest
+import random
+from .. import scenes
+
+
+def random_lines(rng: random.Random):
+    sentences = ["", "你好。", "（微笑）" * 20, "啊" * scenes.LINE_LENGTH, "好" * 145, "a{b}c%d"]
+    motions = ["", "smile01", None]
+    return [
+        (rng.choice(sentences), rng.choice(motions), rng.choice(motions), f"http://voice/{i}")
+        for i in range(rng.randint(0, 4))
+    ]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_scenes_golden(seed):
+    """builders must be byte-identical to templates"""
+    rng = random.Random(seed)
+    common = dict(
+        sess_id="0123456789abcdef0123456789abcdef",
+        bg_pic="N（主角相关工作地点）/N9.jpg",
+        l2d_path="sakiko/model.json",
+        speaker="客服小祥",
+        next_url="http://127.0.0.1:10228/webgal/next.txt/0123/2?bot=sakiko",
+    )
+    lines = random_lines(rng)
+
+    template = scenes.jinja2_env.get_template("answer.txt")
+    assert scenes.answer_scene(lines=lines, **common) == template.render(
+        msg_motion_expression_list=lines, **common
+    )
+
+    listening = rng.choice([["thinking02", "thinking01"], ["", ""]])
+    template = scenes.jinja2_env.get_template("new_input.txt")
+    assert scenes.new_input_scene(
+        lines=lines, listening=listening, **common
+    ) == template.render(msg_motion_expression_list=lines, listening=listening, **common)
+
+    motion, expression = rng.choice([("smile03", "smile01"), ("", "")])
+    template = scenes.jinja2_env.get_template("pending.txt")
+    assert scenes.pending_scene(
+        sess_id=common["sess_id"],
+        l2d_path=common["l2d_path"],
+        motion=motion,
+        expression=expression,
+        next_url=common["next_url"],
+    ) == template.render(
+        sess_id=common["sess_id"],
+        l2d_path=common["l2d_path"],
+        motion=motion,
+        expression=expression,
+        next_url=common["next_url"],
+    )
@@ -3,6 +3,7 @@ import edge_tts
 import httpx
 import os
 import tempfile
+import time
 from ..tts import tts
 from ..config import get_settings
 
@@ -84,3 +85,134 @@ async def test_tts_module():
         fp.flush()
         os.system(f"file {fp.name}")
         os.system(f"play {fp.name}")
+
+
+@pytest.mark.asyncio
+async def test_tts_jobs(monkeypatch):
+    import asyncio
+    from aiocache import SimpleMemoryCache
+    from .. import tts as tts_module
+
+    async def slow_tts_stream(text, voice_preset):
+        if text == "silence":
+            return
+        for char in text:
+            await asyncio.sleep(0.02)
+            yield char.encode()
+
+    monkeypatch.setattr(tts_module, "tts_stream", slow_tts_stream)
+    cache = SimpleMemoryCache()
+    jobs = tts_module.TTSJobRegistry()
+
+    job = jobs.submit("voice:sess:a", "你好", None, cache)
+    # the same in-flight job is shared
+    assert jobs.submit("voice:sess:a", "你好", None, cache) is job
+    assert await cache.get("voice:sess:a") is None
+
+    # chunks are readable while synthesizing
+    assert await job.wait_update(0, timeout=1)
+    # other workers know it is worth waiting
+    assert await cache.exists(tts_module.pending_key("voice:sess:a"))
+    assert not job.done
+    chunks = [chunk async for chunk in job.iter_chunks(timeout=1)]
+    assert b"".join(chunks) == "你好".encode()
+
+    assert await jobs.wait("voice:sess:a", timeout=1) == "你好".encode()
+    await asyncio.sleep(0)
+    assert jobs.get("voice:sess:a") is None
+    # teed into cache as a whole, raw bytes
+    assert await cache.get("voice:sess:a") == "你好".encode()
+    assert not await cache.exists(tts_module.pending_key("voice:sess:a"))
+
+    # no voice is marked in cache, waiting requests won't wait for nothing
+    jobs.submit("voice:sess:b", "silence", None, cache)
+    assert await jobs.wait("voice:sess:b", timeout=1) is None
+    assert await cache.get("voice:sess:b") == b""
+
+
+def test_audio_store(tmp_path, monkeypatch):
+    import asyncio
+    import os
+    from uuid import uuid4
+    from aiocache import SimpleMemoryCache
+    from fastapi.testclient import TestClient
+    from .. import create_app
+    from .. import audio_store as audio_store_module
+    from .. import tts as tts_module
+    from ..dependencies import get_cache
+    from ..models.voice import VoicePreset
+
+    fish = VoicePreset(type="fish", api="http://a:8080", voice_line="sakiko")
+    key = audio_store_module.audio_key("你好", fish)
+    # the server is not part of the key, params and text are
+    assert key == audio_store_module.audio_key("你好", fish.model_copy(update={"api": "http://b"}))
+    assert key != audio_store_module.audio_key("你好", fish.model_copy(update={"voice_line": "x"}))
+    assert key != audio_store_module.audio_key("你好呀", fish)
+    assert key.endswith(".mp3") and audio_store_module.is_audio_key(key)
+    assert audio_store_module.audio_key("你好", fish.model_copy(update={"streaming": True})).endswith(".wav")
+    assert not audio_store_module.is_audio_key("../../etc/passwd")
+
+    async def fake_tts_stream(text, voice_preset):
+        if text != "silence":
+            yield text.encode() * 100
+
+    monkeypatch.setattr(tts_module, "tts_stream", fake_tts_stream)
+    store = audio_store_module.DiskAudioStore(str(tmp_path), max_bytes=1000)
+    jobs = tts_module.TTSJobRegistry()
+
+    async def run():
+        assert await store.get(key) is None
+        jobs.submit(key, "你好", fish, None, store)
+        assert await jobs.wait(key, timeout=1) == "你好".encode() * 100
+        path = await store.get(key)
+        assert open(path, "rb").read() == "你好".encode() * 100
+        # a stored line is not synthesized again
+        jobs.submit(key, "你好", fish, None, store)
+        assert await jobs.wait(key, timeout=1) is None
+        assert open(path, "rb").read() == "你好".encode() * 100
+        # no temporary file is left
+        assert os.listdir(os.path.dirname(path)) == [key]
+
+        # failed synthesis is marked by an empty file
+        silence = audio_store_module.audio_key("silence", fish)
+        jobs.submit(silence, "silence", fish, None, store)
+        assert await jobs.wait(silence, timeout=1) is None
+        assert await store.get(silence) == ""
+
+        # least recently used are evicted beyond the cap, pinned are kept
+        store.pin(key)
+        for text in ("a", "b", "c", "d"):
+            await store.put(audio_store_module.audio_key(text, fish), text.encode() * 300)
+        assert await store.get(key)
+        assert await store.get(audio_store_module.audio_key("a", fish)) is None
+        assert await store.get(audio_store_module.audio_key("d", fish))
+        assert store.stats()["bytes"] <= 1000 + 600
+
+    asyncio.new_event_loop().run_until_complete(run())
+
+    # index of a new process is rebuilt from disk
+    reloaded = audio_store_module.DiskAudioStore(str(tmp_path), max_bytes=1000)
+    reloaded.load()
+    assert reloaded.stats()["bytes"] == store.stats()["bytes"]
+
+    # served from the file, with Range
+    monkeypatch.setattr(audio_store_module, "_audio_store", store)
+    app = create_app()
+    app.dependency_overrides[get_cache] = lambda: SimpleMemoryCache()
+    client = TestClient(app)
+    url = f"/webgal/voice.mp3/{uuid4().hex}/{key}"
+    resp = client.get(url)
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "audio/mpeg"
+    assert resp.content == "你好".encode() * 100
+    resp = client.get(url, headers={"Range": "bytes=0-5"})
+    assert resp.status_code == 206
+    assert resp.content == "你好".encode()
+
+    # unknown voices are not waited for
+    started = time.perf_counter()
+    resp = client.get(f"/webgal/voice.mp3/{uuid4().hex}/{'0' * 32}.mp3")
+    assert resp.status_code == 404
+    resp = client.get(f"/webgal/voice.mp3/{uuid4().hex}/0123456789ab")
+    assert resp.status_code == 404
+    assert time.perf_counter() - started < 1
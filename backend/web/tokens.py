@@ -0,0 +1,28 @@
+"""Token estimation of chat messages, without a tokenizer
+
+tokenizers differ by model and most are not available locally, so tokens are estimated:
+every CJK character (or other wide character) is a token, other text is a token per 4
+characters, plus the framing of a message. It is on the high side for DeepSeek and close
+for OpenAI models, so a budget in estimated tokens is a safe upper bound of the prompt.
+"""
+
+import re
+
+# chat format tokens around every message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+CHARS_PER_TOKEN = 4
+# CJK, kana, hangul and fullwidth forms
+_WIDE_CHARS = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    wide = len(_WIDE_CHARS.findall(text))
+    narrow = len(text) - wide
+    return wide + -(-narrow // CHARS_PER_TOKEN)
+
+
+def estimate_message_tokens(text: str) -> int:
+    """tokens of a message in a chat request"""
+    return estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS
@@ -0,0 +1,164 @@
+"""Per-turn traces of the chat pipeline
+
+A turn starts at `chat.txt` and goes on in the background task, `next.txt` polls and `voice.mp3`
+fetches. Its events (first token, sentences, moods, TTS, scenes published and fetched) are
+recorded with wall clock timestamps into a `TurnTrace`, kept in a bounded ring buffer and served
+at `/admin/traces` as JSON or Chrome trace events (open in chrome://tracing or Perfetto).
+
+The trace of the running turn is held in a context variable, tasks created by the turn (mood
+queries, TTS jobs) inherit it, so deeper modules only call `trace_event`. Every worker keeps its
+own traces, client fetches handled by another worker are not seen.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from .config import get_settings
+
+
+class TurnTrace:
+    def __init__(self, sess_id: str, msg_id: int, preset_name: str) -> None:
+        self.sess_id = sess_id
+        self.msg_id = msg_id
+        self.preset_name = preset_name
+        self.started = time.time()
+        # (name, lane, wall clock start, duration or None, args)
+        self.events: list[tuple[str, str, float, float | None, dict]] = []
+
+    def event(self, name: str, lane: str, dur: float = None, **args):
+        """an instant event, or a span that ends now if dur (seconds) is given"""
+        now = time.time()
+        self.events.append((name, lane, now - dur if dur is not None else now, dur, args))
+
+    def first_offsets(self) -> dict[str, float]:
+        """ms from the turn start to the first end of every event, the critical path"""
+        offsets = {}
+        for name, _, start, dur, _ in self.events:
+            offsets.setdefault(name, round((start + (dur or 0) - self.started) * 1000, 3))
+        return offsets
+
+    def to_dict(self):
+        return {
+            "sess_id": self.sess_id,
+            "msg_id": self.msg_id,
+            "preset": self.preset_name,
+            "started": self.started,
+            "first": self.first_offsets(),
+            "events": [
+                {
+                    "name": name,
+                    "lane": lane,
+                    "offset_ms": round((start - self.started) * 1000, 3),
+                    "dur_ms": round(dur * 1000, 3) if dur is not None else None,
+                    **args,
+                }
+                for name, lane, start, dur, args in self.events
+            ],
+        }
+
+    def chrome_events(self, pid: int) -> list[dict]:
+        """one process per turn, one thread per lane"""
+        lanes: dict[str, int] = {}
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "args": {"name": f"{self.preset_name} {self.sess_id}:{self.msg_id}"},
+            }
+        ]
+        for name, lane, start, dur, args in self.events:
+            if lane not in lanes:
+                lanes[lane] = len(lanes)
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": pid,
+                        "tid": lanes[lane],
+                        "args": {"name": lane},
+                    }
+                )
+            event = {
+                "name": name,
+                "cat": lane,
+                "ts": int(start * 1e6),
+                "pid": pid,
+                "tid": lanes[lane],
+                "args": args,
+            }
+            if dur is not None:
+                event.update(ph="X", dur=int(dur * 1e6))
+            else:
+                event.update(ph="i", s="t")
+            events.append(event)
+        return events
+
+
+class Tracer:
+    """ring buffer of the latest `size` turns, 0 to disable"""
+
+    def __init__(self, size: int = 200) -> None:
+        self.size = size
+        # "sess_id:msg_id" -> trace, oldest first
+        self._traces: OrderedDict[str, TurnTrace] = OrderedDict()
+        # sess_id -> latest turn of the session
+        self._latest: dict[str, TurnTrace] = {}
+
+    def begin(self, sess_id: str, msg_id: int, preset_name: str) -> TurnTrace | None:
+        if self.size <= 0:
+            return None
+        trace = TurnTrace(sess_id, msg_id, preset_name)
+        key = f"{sess_id}:{msg_id}"
+        self._traces.pop(key, None)
+        self._traces[key] = trace
+        self._latest[sess_id] = trace
+        while len(self._traces) > self.size:
+            _, evicted = self._traces.popitem(last=False)
+            if self._latest.get(evicted.sess_id) is evicted:
+                del self._latest[evicted.sess_id]
+        return trace
+
+    def get(self, sess_id: str, msg_id: int) -> TurnTrace | None:
+        return self._traces.get(f"{sess_id}:{msg_id}")
+
+    def latest(self, sess_id: str) -> TurnTrace | None:
+        """the running (or last) turn of a session, scenes of later msg_id belong to it"""
+        return self._latest.get(sess_id)
+
+    def traces(self, sess_id: str = None, limit: int = 0) -> list[TurnTrace]:
+        """newest first"""
+        traces = [
+            trace
+            for trace in reversed(self._traces.values())
+            if sess_id is None or trace.sess_id == sess_id
+        ]
+        return traces[:limit] if limit > 0 else traces
+
+    def chrome(self, traces: list[TurnTrace]) -> dict:
+        events = []
+        for i_trace, trace in enumerate(traces):
+            events.extend(trace.chrome_events(pid=i_trace + 1))
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"worker_pid": os.getpid()},
+        }
+
+
+tracer = Tracer(size=get_settings().trace_buffer_size)
+
+_current_trace: ContextVar[TurnTrace | None] = ContextVar("current_trace", default=None)
+
+
+def activate_trace(trace: TurnTrace | None):
+    """events of this context (and tasks created later in it) go to trace"""
+    _current_trace.set(trace)
+
+
+def trace_event(name: str, lane: str, dur: float = None, **args):
+    """record to the trace of the current turn, no-op outside a turn"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.event(name, lane, dur, **args)
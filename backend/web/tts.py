@@ -1,17 +1,26 @@
 import httpx
+import asyncio
+import base64
+import time
 
 try:
     import edge_tts
 except ImportError:
     edge_tts = None
-import io
+from typing import AsyncIterator
 from .config import get_settings
 from .models.voice import VoicePreset
 from .logger import bot_logger
+from .lifecycle import key_ttl
+from .metrics import registry, tts_first_chunk_seconds, tts_seconds
+from .tracing import trace_event
+from .audio_store import DiskAudioStore
+from aiocache import Cache
+from aiocache.serializers import JsonSerializer
 
 
-async def fish_tts(text: str, voice_preset: VoicePreset):
-    """request a sound from fish-speech api
+async def fish_tts_stream(text: str, voice_preset: VoicePreset) -> AsyncIterator[bytes]:
+    """request a sound from fish-speech api, yield audio chunks as they arrive
     TODO: check status of fish api when initialization
     """
     settings = get_settings()
@@ -19,7 +28,8 @@ async def fish_tts(text: str, voice_preset: VoicePreset):
     data = {
         "text": text,
         "chunk_length": 600,
-        "format": "mp3",
+        # fish-speech only streams wav
+        "format": "wav" if voice_preset.streaming else "mp3",
         "mp3_bitrate": 128,
         "references": [],
         "reference_id": voice_preset.voice_line,
@@ -28,7 +38,7 @@ async def fish_tts(text: str, voice_preset: VoicePreset):
         "normalize": True,
         "opus_bitrate": -1000,
         "latency": "normal",
-        "streaming": False,
+        "streaming": voice_preset.streaming,
         "max_new_tokens": 4096,
         "top_p": 0.7,
         "repetition_penalty": 1.2,
@@ -37,9 +47,16 @@ async def fish_tts(text: str, voice_preset: VoicePreset):
 
     proxy_url = settings.proxy_url if settings.proxy_url != "" else None
     async with httpx.AsyncClient(proxy=proxy_url) as client:
-        resp = await client.post(f"{voice_preset.api}/v1/tts", json=data)
+        async with client.stream(
+            "POST", f"{voice_preset.api}/v1/tts", json=data
+        ) as resp:
+            async for chunk in resp.aiter_bytes():
+                yield chunk
 
-    return resp.content
+
+async def fish_tts(text: str, voice_preset: VoicePreset):
+    """request a sound from fish-speech api"""
+    return b"".join([chunk async for chunk in fish_tts_stream(text, voice_preset)])
 
 
 async def online_mahiruoshi_api(text: str, speaker: str):
@@ -57,7 +74,7 @@ async def online_mahiruoshi_api(text: str, speaker: str):
     return resp.content
 
 
-async def edge_run_tts(text: str, voice_preset: VoicePreset):
+async def edge_tts_stream(text: str, voice_preset: VoicePreset) -> AsyncIterator[bytes]:
     # TODO validate first
     voice_line = voice_preset.voice_line
     if not voice_line.startswith(("zh-", "jp-")):
@@ -67,37 +84,239 @@ async def edge_run_tts(text: str, voice_preset: VoicePreset):
     settings = get_settings()
     proxy_url = settings.proxy_url if settings.proxy_url != "" else None
     communicate = edge_tts.Communicate(text, voice_line, rate="+30%", pitch="-10Hz", proxy=proxy_url)
-    voice_io = io.BytesIO()
 
     async for chunk in communicate.stream():
         if chunk["type"] == "audio":
-            voice_io.write(chunk["data"])
-    voice_io.seek(0)
-    return voice_io.read()
+            yield chunk["data"]
+
+
+async def edge_run_tts(text: str, voice_preset: VoicePreset):
+    return b"".join([chunk async for chunk in edge_tts_stream(text, voice_preset)])
+
+
+def tts_media_type(voice_preset: VoicePreset | None):
+    if voice_preset is not None and voice_preset.type == "fish" and voice_preset.streaming:
+        return "audio/wav"
+    return "audio/mpeg"
+
+
+def encode_voice(cache: Cache, voice_content: bytes) -> bytes | str:
+    """audio as stored in cache, raw bytes unless cache values are JSON"""
+    if isinstance(getattr(cache, "serializer", None), JsonSerializer):
+        return base64.a85encode(voice_content).decode()
+    return voice_content
+
+
+def decode_voice(cached: bytes | str) -> bytes:
+    """audio of a cached voice, a85 text of older versions is decoded"""
+    if isinstance(cached, str):
+        return base64.a85decode(cached.encode())
+    return cached
+
+
+def guess_audio_media_type(voice_content: bytes):
+    """media type of cached audio"""
+    return "audio/wav" if voice_content[:4] == b"RIFF" else "audio/mpeg"
+
+
+async def tts_stream(text: str, voice_preset: VoicePreset) -> AsyncIterator[bytes]:
+    """yield audio chunks, nothing for disabled tts. Errors are raised"""
+    if voice_preset is None:
+        return
+
+    if voice_preset.type == "fish":
+        async for chunk in fish_tts_stream(text, voice_preset):
+            yield chunk
+
+    elif voice_preset.type == 'mahiruoshi':
+        # use mahiruoshi's huggingface API, not streamed
+        yield await online_mahiruoshi_api(text, voice_preset.voice_line)
+
+    elif voice_preset.type == "edge":
+        if edge_tts is not None:
+            async for chunk in edge_tts_stream(text, voice_preset):
+                yield chunk
+
+    # other recognized type indicates disabled tts
 
 
 async def tts(text: str, voice_preset: VoicePreset):
     """ """
     try:
-        if voice_preset.type == "fish":
-            return await fish_tts(text, voice_preset)
-
-        elif voice_preset.type == 'mahiruoshi':
-            # use mahiruoshi's huggingface API
-            return await online_mahiruoshi_api(text, voice_preset.voice_line)
-
-        elif voice_preset.type == "edge":
-            ""
-            if edge_tts is not None:
-                return await edge_run_tts(text, voice_preset)
-            else:
-                return None
-        else:
-            # other recognized type indicates disabled tts
-            return None
+        voice_content = b"".join([chunk async for chunk in tts_stream(text, voice_preset)])
+        return voice_content or None
 
     except (SystemExit, KeyboardInterrupt):
         raise
     except Exception as err:
         bot_logger.warning(f"TTS err encountered: {err}", exc_info=True)
         return None
+
+
+class TTSJob:
+    """audio chunks of an in-flight synthesis, can be read while being written"""
+
+    def __init__(self, media_type: str = "audio/mpeg") -> None:
+        self.media_type = media_type
+        self.chunks: list[bytes] = []
+        self.done = False
+        # replaced every time it is set, so waiters see every update
+        self._updated = asyncio.Event()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def feed(self, chunk: bytes):
+        if chunk:
+            self.chunks.append(chunk)
+            self._notify()
+
+    def finish(self):
+        self.done = True
+        self._notify()
+
+    async def wait_update(self, n_chunks: int, timeout: float) -> bool:
+        """wait until there are more than n_chunks or done, False if timeout"""
+        updated = self._updated
+        if len(self.chunks) > n_chunks or self.done:
+            return True
+        try:
+            await asyncio.wait_for(updated.wait(), timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def iter_chunks(self, timeout: float) -> AsyncIterator[bytes]:
+        """chunks from the beginning, follow the synthesis until done (or stalled for timeout)"""
+        i_chunk = 0
+        while True:
+            while i_chunk < len(self.chunks):
+                yield self.chunks[i_chunk]
+                i_chunk += 1
+            if self.done or not await self.wait_update(i_chunk, timeout):
+                return
+
+
+def pending_key(job_key: str) -> str:
+    """marks a voice being synthesized by some worker, so requests know it is worth waiting"""
+    return f"voice:pending:{job_key.removeprefix('voice:')}"
+
+
+class TTSJobRegistry:
+    """background synthesis jobs keyed by voice cache key
+
+    scenes are published with their voice URL right away, the audio is synthesized and cached
+    in background. Voice requests follow the in-flight job instead of failing.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: dict[str, tuple[TTSJob, asyncio.Task]] = {}
+
+    async def _synthesize(
+        self,
+        job: TTSJob,
+        cache_key: str,
+        text: str,
+        voice_preset: VoicePreset,
+        cache: Cache,
+        audio_store: DiskAudioStore | None = None,
+    ):
+        provider = getattr(voice_preset, "type", None) or "none"
+        if audio_store is not None and await audio_store.get(cache_key) is not None:
+            # stored already (or failed recently), requests read the file
+            job.finish()
+            return None
+        if cache is not None:
+            # outlives the wait of voice requests, a crashed worker's marker expires soon
+            await cache.set(
+                pending_key(cache_key), 1, ttl=max(1, int(get_settings().tts_wait_timeout * 3))
+            )
+        started = time.perf_counter()
+        try:
+            async for chunk in tts_stream(text, voice_preset):
+                if not job.chunks:
+                    tts_first_chunk_seconds.observe(time.perf_counter() - started, provider)
+                job.feed(chunk)
+            elapsed = time.perf_counter() - started
+            tts_seconds.observe(elapsed, provider)
+            trace_event("tts", "tts", dur=elapsed, provider=provider, key=cache_key)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except Exception as err:
+            bot_logger.warning(f"TTS err encountered: {err}", exc_info=True)
+            # partial audio is not kept
+            job.chunks = []
+        finally:
+            job.finish()
+
+        voice_content = b"".join(job.chunks)
+        if audio_store is not None:
+            # keyed by content, an empty file marks a line that can't be synthesized
+            try:
+                await audio_store.put(cache_key, voice_content)
+                bot_logger.debug(f"tts stored: {cache_key}")
+            except OSError as err:
+                bot_logger.warning(f"failed to store voice {cache_key}: {err}")
+        elif cache is not None:
+            # whole audio for later requests,
+            # empty value tells waiting requests there would be no voice
+            await cache.set(
+                cache_key, encode_voice(cache, voice_content), ttl=key_ttl(cache_key)
+            )
+            bot_logger.debug(f"tts cached: {cache_key}")
+        if cache is not None:
+            await cache.delete(pending_key(cache_key))
+        return voice_content or None
+
+    def submit(
+        self,
+        cache_key: str,
+        text: str,
+        voice_preset: VoicePreset,
+        cache: Cache,
+        audio_store: DiskAudioStore | None = None,
+    ) -> TTSJob:
+        """start synthesis in background, the same in-flight job is shared
+
+        the audio goes to `audio_store` under the audio key if given, else to cache
+        """
+        if cache_key in self._jobs:
+            return self._jobs[cache_key][0]
+
+        job = TTSJob(media_type=tts_media_type(voice_preset))
+        task = asyncio.create_task(
+            self._synthesize(job, cache_key, text, voice_preset, cache, audio_store)
+        )
+        self._jobs[cache_key] = (job, task)
+        # the result is stored after the job is done
+        task.add_done_callback(lambda _: self._jobs.pop(cache_key, None))
+        return job
+
+    def get(self, cache_key: str) -> TTSJob | None:
+        job_task = self._jobs.get(cache_key)
+        return job_task[0] if job_task is not None else None
+
+    async def wait(self, cache_key: str, timeout: float) -> bytes | None:
+        """wait for the whole audio of in-flight job of this process, None if there is no job or timeout"""
+        job_task = self._jobs.get(cache_key)
+        if job_task is None:
+            return None
+        try:
+            return await asyncio.wait_for(asyncio.shield(job_task[1]), timeout=timeout)
+        except asyncio.TimeoutError:
+            bot_logger.warning(f"tts job timeout: {cache_key}")
+            return None
+
+    def cancel_all(self):
+        for _, task in list(self._jobs.values()):
+            task.cancel()
+        self._jobs.clear()
+
+
+tts_jobs = TTSJobRegistry()
+registry.gauge(
+    "tts_jobs_in_flight",
+    "synthesis jobs running in this process",
+    lambda: {(): len(tts_jobs._jobs)},
+)
@@ -0,0 +1,128 @@
+"""Token usage metering
+
+Usage of every LLM response is counted in process by (scope, preset, llm_name, token type), and
+flushed to the cache periodically:
+- redis: HINCRBY on hash `usage:tokens` and INCRBY on `total_token` in one pipeline, so
+  concurrent workers never lose updates
+- other caches: read-modify-write by the single flusher of this process
+
+scope is `chat` for answers and `mood` for the mood analyzer. Token types are `prompt`,
+`completion`, `cached` (prompt tokens hit by provider side cache) and `total`.
+"""
+
+import asyncio
+from collections import Counter
+from aiocache import Cache, RedisCache
+from .logger import model_logger
+
+USAGE_KEY = "usage:tokens"
+# total of all scopes, kept as a plain counter for older versions
+TOTAL_KEY = "total_token"
+TOKEN_TYPES = ("prompt", "completion", "cached", "total")
+
+
+def usage_tokens(usage) -> dict[str, int]:
+    """token counts of an openai `CompletionUsage`"""
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details is not None else None
+    if cached is None:
+        # deepseek reports cache hits on its own field
+        cached = getattr(usage, "prompt_cache_hit_tokens", None)
+
+    return {
+        "prompt": getattr(usage, "prompt_tokens", None) or 0,
+        "completion": getattr(usage, "completion_tokens", None) or 0,
+        "cached": cached or 0,
+        "total": getattr(usage, "total_tokens", None) or 0,
+    }
+
+
+class UsageMeter:
+    def __init__(self) -> None:
+        # "scope|preset|llm_name|type" -> tokens, not yet flushed
+        self._counts: Counter[str] = Counter()
+        self._lock = asyncio.Lock()
+
+    def record(self, usage, scope: str, preset_name: str, llm_name: str):
+        """count usage of a response, usage is ignored if None"""
+        if usage is None:
+            return
+        for token_type, n in usage_tokens(usage).items():
+            if n:
+                self._counts[f"{scope}|{preset_name}|{llm_name}|{token_type}"] += n
+
+    async def flush(self, cache: Cache):
+        async with self._lock:
+            counts, self._counts = self._counts, Counter()
+            if not counts:
+                return
+            total = sum(n for field, n in counts.items() if field.endswith("|total"))
+
+            try:
+                if isinstance(cache, RedisCache):
+                    async with cache.client.pipeline(transaction=False) as pipe:
+                        for field, n in counts.items():
+                            pipe.hincrby(USAGE_KEY, field, n)
+                        if total:
+                            pipe.incrby(TOTAL_KEY, total)
+                        await pipe.execute()
+                else:
+                    stored = Counter(await cache.get(USAGE_KEY, {}))
+                    stored.update(counts)
+                    prev_total = await cache.get(TOTAL_KEY, 0)
+                    await cache.multi_set(
+                        [(USAGE_KEY, dict(stored)), (TOTAL_KEY, prev_total + total)]
+                    )
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception as err:
+                # kept for the next flush
+                self._counts.update(counts)
+                model_logger.warning(f"usage flush failed: {err}")
+
+    async def read(self, cache: Cache) -> dict:
+        """aggregated usage of all workers, with counts of this process not yet flushed"""
+        if isinstance(cache, RedisCache):
+            stored = {
+                k.decode(): int(v)
+                for k, v in (await cache.client.hgetall(USAGE_KEY)).items()
+            }
+        else:
+            stored = await cache.get(USAGE_KEY, {})
+        counts = Counter(stored)
+        counts.update(self._counts)
+
+        breakdown: dict[tuple, dict[str, int]] = {}
+        for field, n in counts.items():
+            scope, preset_name, llm_name, token_type = field.split("|")
+            row = breakdown.setdefault(
+                (scope, preset_name, llm_name), dict.fromkeys(TOKEN_TYPES, 0)
+            )
+            row[token_type] = row.get(token_type, 0) + n
+
+        rows = [
+            {"scope": scope, "preset": preset_name, "llm_name": llm_name, **tokens}
+            for (scope, preset_name, llm_name), tokens in sorted(breakdown.items())
+        ]
+        pending_total = sum(n for field, n in self._counts.items() if field.endswith("|total"))
+        return {
+            "total_token": int(await cache.get(TOTAL_KEY, 0) or 0) + pending_total,
+            "scopes": {
+                scope: sum(row["total"] for row in rows if row["scope"] == scope)
+                for scope in sorted({row["scope"] for row in rows})
+            },
+            "breakdown": rows,
+        }
+
+
+usage_meter = UsageMeter()
+
+
+async def run_usage_flusher(cache: Cache, interval: float):
+    """flush usage every interval until cancelled, and once more at the end"""
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            await usage_meter.flush(cache)
+    finally:
+        await usage_meter.flush(cache)
@@ -74,6 +74,11 @@ def text_split_sentence(text: str):
     # TODO sometimes a sentence is too long, consider force splitting even if sentence is not finished
     # remove double newline
     text = text.replace("\n\n", "\n")
+    return _split_normalized_text(text)
+
+
+def _split_normalized_text(text: str):
+    """splitting loop of `text_split_sentence`, double newlines should be removed already"""
     # split by 。or \n
     sentence_buf = []
 
@@ -86,6 +91,119 @@ def text_split_sentence(text: str):
     return sentence_buf
 
 
+class IncrementalSentenceSplitter:
+    """stateful version of `text_split_sentence` for streamed LLM outputs
+
+    `feed` only scans newly arrived characters and returns sentences as soon as they are
+    known to be finished, `flush` returns the remnants at the end of stream.
+    All sentences joined equals `text_split_sentence(full_text)` no matter how the text is chunked.
+    """
+
+    # states of the pending sentence, named after alternatives of `match_first_sentence`
+    EMPTY = 0
+    # starts with （, waiting for ）
+    PARATHESIS = 1
+    # starts with (, waiting for ), a sentence end inside is not final before )
+    PARATHESIS_ASCII = 2
+    # normal text, waiting for a punctuation
+    TEXT = 3
+    # punctuations met, waiting for a non-punctuation to close the sentence
+    PUNCTUATION = 4
+    # （ met before any punctuation, the rest of the text would never be split
+    UNSPLITTABLE = 5
+
+    def __init__(self) -> None:
+        self._pending: list[str] = []
+        self._state = self.EMPTY
+        # the last newline may pair with the next one (`"\n\n" -> "\n"`)
+        self._newline_pair = False
+
+    def feed(self, chunk: str) -> list[str]:
+        """add a piece of text, return finished sentences (might be empty)"""
+        finished = []
+        for ch in chunk:
+            if ch == "\n":
+                if self._newline_pair:
+                    # second newline of a pair is removed
+                    self._newline_pair = False
+                    continue
+                self._newline_pair = True
+            else:
+                self._newline_pair = False
+
+            sentence = self._push(ch)
+            if sentence is not None:
+                finished.append(sentence)
+
+        return finished
+
+    def flush(self) -> list[str]:
+        """end of stream, return all remaining sentences and reset"""
+        text = "".join(self._pending)
+        if self._state == self.PARATHESIS_ASCII:
+            # ) never comes, fallback to the plain rules
+            sentences = _split_normalized_text(text)
+        else:
+            sentences = [text] if text else []
+
+        self._pending = []
+        self._state = self.EMPTY
+        self._newline_pair = False
+        return sentences
+
+    def _pop_pending(self):
+        sentence = "".join(self._pending)
+        self._pending = []
+        self._state = self.EMPTY
+        return sentence
+
+    def _push(self, ch: str) -> str | None:
+        """consume a (normalized) char, return the sentence it finishes"""
+        finished = None
+        if self._state == self.PUNCTUATION:
+            if ch in TEXT_SPLIT_PUNCTUATIONS:
+                self._pending.append(ch)
+                return None
+            # consecutive punctuations end here
+            finished = self._pop_pending()
+
+        state = self._state
+        self._pending.append(ch)
+        if state == self.EMPTY:
+            if ch == "（":
+                self._state = self.PARATHESIS
+            elif ch == "(":
+                self._state = self.PARATHESIS_ASCII
+            elif ch in TEXT_SPLIT_PUNCTUATIONS:
+                self._state = self.PUNCTUATION
+            else:
+                self._state = self.TEXT
+
+        elif state == self.PARATHESIS:
+            if ch == "）":
+                if len(self._pending) > 2:
+                    finished = self._pop_pending()
+                else:
+                    # empty （） never matches
+                    self._state = self.UNSPLITTABLE
+
+        elif state == self.PARATHESIS_ASCII:
+            if ch == ")":
+                if len(self._pending) > 2:
+                    finished = self._pop_pending()
+                else:
+                    # empty () never matches, treat it as normal text
+                    self._state = self.TEXT
+
+        elif state == self.TEXT:
+            if ch in TEXT_SPLIT_PUNCTUATIONS:
+                self._state = self.PUNCTUATION
+            elif ch == "（":
+                self._state = self.UNSPLITTABLE
+
+        return finished
+
+
 def remove_parathesis(sentence:str, replace=''):
     """remove （）from sentence
     """